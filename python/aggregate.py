@@ -0,0 +1,311 @@
+"""
+Reflector heights aggregated over time bins and azimuth sectors.
+
+The retrievals of a ResultsStore are grouped by time bin (hourly, 6 hourly, daily, ...) and azimuth sector, and each
+group is summarised by robust statistics: the retrievals further than `threshold` scaled MADs (median absolute
+deviations) from the median of their group are rejected, then the median, scaled MAD, mean and count of the remaining
+ones are kept. Each bin also has a row for all the sectors together, with sector ALL_SECTORS.
+
+Sectors see the ground from different sides, so their heights can be offset from each other. The bias of a sector is the
+median, over the time bins, of its median minus the median of all the sectors. The bias corrected heights subtract it,
+so the height of a bin does not jump when a sector has no retrievals in it.
+
+Time bins are aligned to midnight, 1 January 1970, of the wall clock times, so widths dividing a day give bins starting
+at midnight. Every group-by is done with sorts and bincounts on the whole arrays.
+
+`Aggregator.update` only recomputes the bins from the first one holding new retrievals on, so appending new days to a
+long record costs as much as aggregating the new days. The bias is computed from the aggregate table, which is small.
+
+usage
+    >>> aggregator = Aggregator('6h', processor.azimuth_bins)
+    >>> aggregator.update(processor.store)
+    >>> aggregator.write_csv("heights_6h.csv")
+"""
+import csv
+import re
+
+import numpy as np
+
+from results import to_datetime64
+
+MAD_SCALE = 1.4826  # the scaled MAD estimates the standard deviation of normally distributed heights
+DEFAULT_THRESHOLD = 3.0
+ALL_SECTORS = -1  # sector of the rows of all the sectors together
+
+aggregate_dt = np.dtype([
+    ('time', 'datetime64[us]'), ('sector', int), ('count', int), ('rejected', int), ('median', float), ('mad', float),
+    ('mean', float),
+])
+
+# columns of the CSV export
+AGGREGATE_COLUMNS = ('time', 'sector', 'azimuth_min', 'azimuth_max', 'count', 'rejected', 'median', 'mad', 'mean',
+                     'corrected')
+
+WIDTH_NAMES = {'hourly': '1h', 'daily': '1d'}
+WIDTH_UNITS = {'min': 'm', 'h': 'h', 'd': 'D'}
+EPOCH = np.datetime64(0, 'us')
+
+
+def bin_width(width):
+    """
+    :param width: bin width as text, e.g. '30min', '6h', '1d', 'hourly' or 'daily', or a numpy.timedelta64
+    :return: numpy.timedelta64 in microseconds
+    """
+    if isinstance(width, np.timedelta64):
+        value = width.astype('timedelta64[us]')
+    else:
+        match = re.fullmatch(r'(\d+)\s*(min|h|d)', WIDTH_NAMES.get(width, width).strip().lower())
+        if match is None:
+            raise ValueError("Invalid bin width '{}', use e.g. 30min, 6h, 1d, hourly or daily.".format(width))
+        value = np.timedelta64(int(match.group(1)), WIDTH_UNITS[match.group(2)]).astype('timedelta64[us]')
+    if value <= np.timedelta64(0, 'us'):
+        raise ValueError("Invalid bin width '{}', it must be positive.".format(width))
+    return value
+
+
+def time_bins(times, width):
+    """
+    :param times: datetime64 array
+    :param width: bin width, numpy.timedelta64
+    :return: start of the bin of each time, datetime64[us]
+    """
+    return EPOCH + (times.astype('datetime64[us]') - EPOCH) // width * width
+
+
+def sector_index(azimuth, azimuth_bins):
+    """
+    Sector of each azimuth, with min_az < azimuth < max_az as in ResultsStore.in_sector, the first one for overlapping
+    sectors.
+
+    :param azimuth: azimuths in degrees
+    :param azimuth_bins: list of (min, max) azimuth ranges in degrees
+    :return: index of the sector in azimuth_bins, -1 outside every sector
+    """
+    sectors = np.full(len(azimuth), -1)
+    for i, (min_az, max_az) in reversed(list(enumerate(azimuth_bins))):
+        sectors[(azimuth > min_az) & (azimuth < max_az)] = i
+    return sectors
+
+
+def group_median(groups, values, n_groups):
+    """
+    Median of the values of each group.
+
+    :param groups: group of each value, 0 to n_groups - 1
+    :param values: values
+    :param n_groups: number of groups
+    :return: median of each group, NaN for groups without values
+    """
+    counts = np.bincount(groups, minlength=n_groups)
+    if values.size == 0:
+        return np.full(n_groups, np.nan)
+    ordered = values[np.lexsort((values, groups))]
+    starts = np.cumsum(counts) - counts
+    last = values.size - 1
+    low = ordered[np.minimum(starts + (counts - 1) // 2, last)]
+    high = ordered[np.minimum(starts + counts // 2, last)]
+    return np.where(counts > 0, (low + high) / 2, np.nan)
+
+
+def robust_stats(groups, values, n_groups, threshold=DEFAULT_THRESHOLD):
+    """
+    Statistics of each group after rejecting the values further than `threshold` scaled MADs from the group median.
+
+    :param groups: group of each value, 0 to n_groups - 1
+    :param values: values
+    :param n_groups: number of groups
+    :param threshold: rejection threshold in scaled MADs
+    :return: dict of 'count', 'rejected', 'median', 'mad' and 'mean' arrays, one value per group
+    """
+    total = np.bincount(groups, minlength=n_groups)
+    deviation = np.abs(values - group_median(groups, values, n_groups)[groups])
+    mad = MAD_SCALE * group_median(groups, deviation, n_groups)
+    kept = deviation <= threshold * mad[groups]
+    groups, values = groups[kept], values[kept]
+
+    median = group_median(groups, values, n_groups)
+    count = np.bincount(groups, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(groups, values, minlength=n_groups) / count
+    return {'count': count, 'rejected': total - count, 'median': median,
+            'mad': MAD_SCALE * group_median(groups, np.abs(values - median[groups]), n_groups), 'mean': mean}
+
+
+def bin_groups(times, azimuth, width, azimuth_bins):
+    """
+    Groups of retrievals by time bin and sector, and by time bin for all the sectors together. Every retrieval inside a
+    sector is a member of two groups, retrievals outside every sector of none.
+
+    :param times: retrieval times, datetime64
+    :param azimuth: retrieval azimuths in degrees
+    :param width: bin width, numpy.timedelta64
+    :param azimuth_bins: list of (min, max) azimuth ranges in degrees
+    :return: (retrieval index of each member, group of each member, start time of each group, sector of each group),
+             the groups sorted by time then sector, ALL_SECTORS first
+    """
+    sectors = sector_index(azimuth, azimuth_bins)
+    inside = np.nonzero(sectors >= 0)[0]
+    numbers = (np.asarray(times)[inside].astype('datetime64[us]') - EPOCH) // width
+    # keyed by bin number and sector + 1, so ALL_SECTORS comes first
+    stride = len(azimuth_bins) + 1
+    keys = np.concatenate((numbers * stride, numbers * stride + sectors[inside] + 1))
+    unique, groups = np.unique(keys, return_inverse=True)
+    return np.concatenate((inside, inside)), groups.ravel(), EPOCH + unique // stride * width, unique % stride - 1
+
+
+def aggregate_rows(times, azimuth, heights, width, azimuth_bins, threshold=DEFAULT_THRESHOLD):
+    """
+    Robust statistics of the retrievals of each time bin and sector, and of each time bin for all the sectors together.
+    Retrievals outside every sector are left out.
+
+    :param times: retrieval times, datetime64
+    :param azimuth: retrieval azimuths in degrees
+    :param heights: reflector heights
+    :param width: bin width, numpy.timedelta64
+    :param azimuth_bins: list of (min, max) azimuth ranges in degrees
+    :param threshold: rejection threshold in scaled MADs
+    :return: aggregate_dt array sorted by time then sector, ALL_SECTORS first
+    """
+    members, groups, bin_times, sectors = bin_groups(times, azimuth, width, azimuth_bins)
+    stats = robust_stats(groups, np.asarray(heights, dtype=float)[members], len(bin_times), threshold)
+
+    rows = np.zeros(len(bin_times), dtype=aggregate_dt)
+    rows['time'] = bin_times
+    rows['sector'] = sectors
+    for name, values in stats.items():
+        rows[name] = values
+    return rows
+
+
+class Aggregator:
+    def __init__(self, width='1d', azimuth_bins=((0, 360),), threshold=DEFAULT_THRESHOLD):
+        """
+        :param width: time bin width, see `bin_width`
+        :param azimuth_bins: list of (min, max) azimuth ranges in degrees, e.g. GNSSProcessor.azimuth_bins
+        :param threshold: retrievals further than this many scaled MADs from the median of their bin are rejected
+        """
+        self.width = bin_width(width)
+        self.azimuth_bins = [tuple(b) for b in azimuth_bins]
+        self.threshold = threshold
+        self.table = np.zeros(0, dtype=aggregate_dt)
+
+        self._store = None  # store of the last update and how many of its retrievals were aggregated
+        self._seen = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def update(self, store, start=None):
+        """
+        Aggregate the retrievals added to a store since the last update, e.g. after `GNSSProcessor.add_results`.
+        The bins from the first one holding a new retrieval on are recomputed from the retrievals of the store, the
+        earlier ones are kept, so the store must hold every retrieval of the bins it updates: whole days for daily bins.
+        A store not updated from before, e.g. one with only the latest days of a saved aggregate, is new as a whole.
+
+        :param store: ResultsStore
+        :param start: recompute the bins from this time (datetime, date or datetime64) on, whatever is new
+        :return: number of rows recomputed
+        """
+        if store is not self._store:
+            self._store, self._seen = store, 0
+        if len(store) < self._seen:
+            raise ValueError("The store holds fewer retrievals than already aggregated, use a new Aggregator.")
+        if start is None:
+            if len(store) == self._seen:
+                return 0
+            start = store['time'][self._seen:].min()
+        start = time_bins(np.array([to_datetime64(start)]), self.width)[0]
+
+        indices = store.between(start)
+        rows = aggregate_rows(store['time'][indices], store['azimuth'][indices], store['reflector_height'][indices],
+                              self.width, self.azimuth_bins, self.threshold)
+        self.table = np.concatenate((self.table[self.table['time'] < start], rows))
+        self._seen = len(store)
+        return len(rows)
+
+    def sector_bias(self):
+        """
+        Height bias of each sector: the median, over the time bins, of the sector median minus the median of all the
+        sectors.
+
+        :return: bias of each sector of azimuth_bins in metres, NaN for sectors without retrievals
+        """
+        combined = self.table[self.table['sector'] == ALL_SECTORS]
+        rows = self.table[self.table['sector'] != ALL_SECTORS]
+        # every bin with a sector row has an ALL_SECTORS row, and the table is sorted by time
+        difference = rows['median'] - combined['median'][np.searchsorted(combined['time'], rows['time'])]
+        return group_median(rows['sector'], difference, len(self.azimuth_bins))
+
+    def corrected(self):
+        """
+        Bias corrected height of each time bin: the mean of the sector medians minus their bias, weighted by the number
+        of retrievals kept in each sector.
+
+        :return: (start of the bins, corrected heights, retrievals kept in each bin)
+        """
+        rows = self.table[self.table['sector'] != ALL_SECTORS]
+        heights = rows['median'] - self.sector_bias()[rows['sector']]
+        times, index = np.unique(rows['time'], return_inverse=True)
+        index = index.ravel()
+        counts = np.bincount(index, rows['count'], minlength=times.size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            heights = np.bincount(index, rows['count'] * heights, minlength=times.size) / counts
+        return times, heights, counts.astype(int)
+
+    def columns(self, sector=None):
+        """
+        Aggregate columns for export, in time order.
+
+        :param sector: index of a sector of azimuth_bins or ALL_SECTORS to only export its rows, all the rows if None
+        :return: dict of column name -> array, see AGGREGATE_COLUMNS
+        """
+        table = self.table if sector is None else self.table[self.table['sector'] == sector]
+        ranges = np.array(self.azimuth_bins + [(0, 360)], dtype=float)[table['sector']]
+        corrected = table['median'] - np.append(self.sector_bias(), np.nan)[table['sector']]
+        times, heights, _ = self.corrected()
+        combined = table['sector'] == ALL_SECTORS
+        corrected[combined] = heights[np.searchsorted(times, table['time'][combined])]
+        columns = {name: table[name] for name in aggregate_dt.names}
+        columns.update(azimuth_min=ranges[:, 0], azimuth_max=ranges[:, 1], corrected=corrected)
+        return {name: columns[name] for name in AGGREGATE_COLUMNS}
+
+    def write_csv(self, path, sector=None):
+        """
+        Write the aggregates to a CSV file with a header line, bin start times as ISO 8601 wall clock times. The rows of
+        all the sectors together have sector -1 and azimuths 0 to 360.
+
+        :param path: file path
+        :param sector: see `columns`
+        :return: number of rows written
+        """
+        columns = self.columns(sector)
+        columns['time'] = np.datetime_as_string(columns['time'], unit='s')
+        with open(path, 'w', newline='') as fid:
+            writer = csv.writer(fid)
+            writer.writerow(AGGREGATE_COLUMNS)
+            writer.writerows(zip(*(values.tolist() for values in columns.values())))
+        return len(columns['time'])
+
+    def save(self, path):
+        """
+        Save the aggregates and settings to a .npz file, to be updated with the next days by a later run.
+
+        :param path: file path
+        :return: None
+        """
+        np.savez(path, table=self.table, width=self.width, azimuth_bins=np.array(self.azimuth_bins, dtype=float),
+                 threshold=self.threshold)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load aggregates saved by `save`.
+
+        :param path: file path
+        :return: Aggregator
+        """
+        with np.load(path) as saved:
+            aggregator = cls(saved['width'][()], [tuple(b) for b in saved['azimuth_bins'].tolist()],
+                             float(saved['threshold']))
+            aggregator.table = saved['table']
+        return aggregator
@@ -0,0 +1,104 @@
+"""
+Satellite arc segmentation.
+
+`readGNSS` returns every sample of a satellite in a log as one track, so in a log of several hours a track holds
+several passes over the station, rising and setting on different sides. Such a track spans far more azimuth than
+`max_az_diff` and gives no retrieval at all. `split_arcs` cuts the track of a satellite into arcs:
+
+    - at gaps of more than MAX_GAP seconds between samples,
+    - where the elevation stops rising and starts setting, or the other way around,
+    - by azimuth bin, each arc only holding the samples inside one of the azimuth bins.
+
+Every arc is then processed on its own by `process_gnss.process_track`.
+"""
+import numpy as np
+
+from utils import epoch_seconds
+
+# seconds without a sample after which a new arc starts
+MAX_GAP = 300
+
+
+def sample_seconds(group):
+    """
+    Time of each sample in seconds.
+
+    :param group: structured array of one satellite, as returned by `readGNSS`
+    :return: array of seconds, from the date and utc fields when the elevations were interpolated and from the block
+             counter (taken to be one second apart) otherwise
+    """
+    date = group['date']
+    if not np.any(date):
+        return group['count'].astype(float)
+    # samples before the first RMC sentence of a log have no date, they are taken to be on the first day
+    date = np.where(date > 0, date, date[date > 0].min())
+    return epoch_seconds(date, group['utc'])
+
+
+def elevation_turns(el):
+    """
+    Samples where the elevation changes direction.
+
+    :param el: elevation angles in time order
+    :return: indices of the first sample after each change from rising to setting or back
+    """
+    step = np.sign(np.diff(el))
+    moving = np.flatnonzero(step)
+    # a change of direction between two consecutive moves, the flat samples between them stay with the earlier arc
+    turns = moving[1:][step[moving[1:]] != step[moving[:-1]]]
+    return turns + 1
+
+
+def split_arcs(group, azimuth_bins, max_gap=MAX_GAP):
+    """
+    Split the samples of one satellite into rising and setting arcs in each azimuth bin.
+
+    :param group: structured array of one satellite, as returned by `readGNSS`
+    :param azimuth_bins: list of (min, max) azimuth bins in degrees
+    :param max_gap: seconds without a sample after which a new arc starts
+    :return: list of structured arrays, one per arc, in time order within each azimuth bin
+    """
+    if group.size == 0:
+        return []
+    valid = np.flatnonzero(~np.isnan(group['el']) & ~np.isnan(group['az']))
+    if valid.size == 0:
+        return []
+    group = group[valid]
+
+    gaps = np.flatnonzero(np.diff(sample_seconds(group)) > max_gap) + 1
+    cuts = np.union1d(gaps, elevation_turns(group['el']))
+    arc = np.zeros(group.size, dtype=int)
+    arc[cuts] = 1
+    arc = np.cumsum(arc)
+
+    arcs = []
+    azimuth = group['az']
+    for min_v, max_v in azimuth_bins:
+        in_bin = (azimuth > min_v) & (azimuth < max_v)
+        ids = arc[in_bin]
+        if ids.size == 0:
+            continue
+        samples = group[in_bin]
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(ids)) + 1, [ids.size]))
+        arcs += [samples[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+    return arcs
+
+
+def split_tracks(gnss_data, satellites, carrier, azimuth_bins, max_gap=MAX_GAP):
+    """
+    Split every track into arcs, see `split_arcs`.
+
+    :param gnss_data: tracks read by `readGPS` or `readGNSS`
+    :param satellites: satellite table of the tracks
+    :param carrier: carrier wavelength of each track
+    :param azimuth_bins: list of (min, max) azimuth bins in degrees
+    :param max_gap: seconds without a sample after which a new arc starts
+    :return: (arcs, satellite table of the arcs, carrier wavelength of the arcs)
+    """
+    arcs, owner = [], []
+    for n, group in enumerate(gnss_data):
+        group_arcs = split_arcs(group, azimuth_bins, max_gap)
+        arcs += group_arcs
+        owner += [n] * len(group_arcs)
+    owner = np.array(owner, dtype=int)
+    return arcs, satellites[owner], np.asarray(carrier)[owner]
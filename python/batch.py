@@ -0,0 +1,190 @@
+"""
+Batch processing of many log files in a pool of worker processes.
+
+Each worker parses and processes one file with its own GNSSProcessor and sends back only its results store, which is
+merged into a single processor in the order of the files. As each file is processed independently, the merged
+results are identical to processing the files one after the other in one processor.
+
+`render_figures` likewise draws the figures of each day in its own worker, saving them to files off screen.
+"""
+import copy
+import datetime
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+
+import numpy as np
+
+import instrument
+from cache import config_cache
+from process_gnss import GNSSProcessor
+from readGPS import readGNSS
+
+
+def process_file(file, azimuth_bins, min_el=6, max_el=30, cache=None, config_path=None):
+    """
+    Parse and process one log file.
+
+    :param file: path to the .LOG file
+    :param azimuth_bins: list of (min, max) azimuth ranges in degrees
+    :param min_el: minimum elevation angle in degrees
+    :param max_el: maximum elevation angle in degrees
+    :param cache: optional ObservationCache the parsed observations are read from and stored in
+    :param config_path: configuration file, see GNSSProcessor
+    :return: ResultsStore of the retrievals of the file
+    """
+    if cache is None:
+        gnss_data, satellites = readGNSS(file, True)
+    else:
+        gnss_data, satellites = cache.read(file, True)
+    processor = GNSSProcessor(azimuth_bins, min_el, max_el, config_path)
+    processor.process_gnss(gnss_data, satellites)
+    return processor.store
+
+
+def _process_file_profiled(*args):
+    """
+    `process_file` in a worker process with profiling enabled.
+    :return: (ResultsStore, instrument report of the file)
+    """
+    instrument.enable()
+    store = process_file(*args)
+    return store, instrument.report()
+
+
+def process_files(files, azimuth_bins, min_el=6, max_el=30, workers=0, config_path=None):
+    """
+    Parse and process log files, in parallel when more than one worker is used.
+
+    :param files: paths to the .LOG files, in chronological order
+    :param azimuth_bins: list of (min, max) azimuth ranges in degrees
+    :param min_el: minimum elevation angle in degrees
+    :param max_el: maximum elevation angle in degrees
+    :param workers: number of worker processes, 0 uses every core and 1 processes the files in this process
+    :param config_path: configuration file, see GNSSProcessor
+    :return: GNSSProcessor holding the retrievals of every file, in file order
+    """
+    files = list(files)
+    processor = GNSSProcessor(azimuth_bins, min_el, max_el, config_path)
+    cache = config_cache(processor.config)
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(files))
+
+    if workers <= 1:
+        for file in files:
+            print("Parsing file:", os.path.basename(file))
+            processor.add_results(process_file(file, azimuth_bins, min_el, max_el, cache, config_path))
+        return processor
+
+    # when profiling, the workers record their own instrument reports and send them back with their results
+    profiled = instrument.enabled()
+    worker = _process_file_profiled if profiled else process_file
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # map yields results in submission order, so the merge follows the file order
+        results = pool.map(worker, files, repeat(azimuth_bins), repeat(min_el), repeat(max_el), repeat(cache),
+                           repeat(config_path))
+        for file, result in zip(files, results):
+            print("Parsed file:", os.path.basename(file))
+            if profiled:
+                result, report = result
+                instrument.merge(report)
+            processor.add_results(result)
+    return processor
+
+
+# per day figures of render_figures: file name prefix and GNSSProcessor graph method
+DAY_FIGURES = (('azimuths', 'graph_azimuths'), ('metrics', 'graph_retrieval_metrics'), ('polar', 'graph_az_el_polar'))
+
+_render_processor = None  # processor of a render_figures worker without retrievals, sent once when the worker starts
+
+
+def _set_render_processor(processor):
+    global _render_processor
+    _render_processor = processor
+
+
+def _render_day_store(day, folder, store):
+    """
+    `render_day` in a worker process, with the retrievals of the day.
+
+    :param store: ResultsStore of the retrievals of the day
+    :return: list of the files written
+    """
+    _render_processor.store = store
+    return render_day(day, folder)
+
+
+def render_day(day, folder, processor=None):
+    """
+    Save the DAY_FIGURES of one day as PNG files named <prefix>_<YYYY-MM-DD>.png.
+
+    :param day: datetime.date
+    :param folder: output folder
+    :param processor: GNSSProcessor holding the retrievals, the one of the worker process if None
+    :return: list of the files written
+    """
+    processor = processor or _render_processor
+    date = datetime.datetime.combine(day, datetime.time())
+    written = []
+    for prefix, graph in DAY_FIGURES:
+        path = Path(folder) / "{}_{}.png".format(prefix, day.isoformat())
+        # a figure left from an earlier run is removed, so the file only exists if the graph was drawn now
+        path.unlink(missing_ok=True)
+        getattr(processor, graph)(date, path)
+        if path.exists():
+            written.append(path)
+    return written
+
+
+def render_figures(processor, folder, start=None, end=None, workers=0):
+    """
+    Save the figures of every day with retrievals between two dates, and the height over time figure of all the
+    retrievals, as PNG files.
+    The days are rendered in parallel when more than one worker is used.
+
+    :param processor: GNSSProcessor holding the retrievals
+    :param folder: output folder, created if needed
+    :param start: first day (datetime.date), the first day with retrievals if None
+    :param end: last day (datetime.date), the last day with retrievals if None
+    :param workers: number of worker processes, 0 uses every core and 1 renders the days in this process
+    :return: list of the files written
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    days = np.unique(processor.store['time'].astype('datetime64[D]'))
+    if start is not None:
+        days = days[days >= np.datetime64(start, 'D')]
+    if end is not None:
+        days = days[days <= np.datetime64(end, 'D')]
+    days = days.astype(datetime.date).tolist()
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(days))
+
+    written = []
+    if workers <= 1:
+        for day in days:
+            written += render_day(day, folder, processor)
+    else:
+        # the settings are sent to each worker once, then each day with only its own retrievals, a few days ahead of
+        # the workers so the copies of the retrievals held at a time stay bounded
+        renderer = copy.copy(processor)
+        renderer.store = processor.store.subset([])
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_set_render_processor,
+                                 initargs=(renderer,)) as pool:
+            for day in days:
+                store = processor.store.subset(processor.store.on_date(day))
+                pending.append(pool.submit(_render_day_store, day, folder, store))
+                if len(pending) >= 2 * workers:
+                    written += pending.popleft().result()
+            while pending:
+                written += pending.popleft().result()
+    if days:
+        path = folder / "height_time.png"
+        processor.graph_height_time(path)
+        written.append(path)
+    return written
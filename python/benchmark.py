@@ -0,0 +1,352 @@
+"""
+Benchmarks for the GNSS-IR processing code.
+
+The suite times each stage of the pipeline (parse, detrend, periodogram and an end to end run of one file) on the
+sample logs and on synthetic logs, reporting wall time, throughput and peak memory. Timings can be stored as a
+baseline and later runs are compared to it, listing the stages that got slower than the tolerance. Timings depend on
+the machine, so the comparison only fails the run with --check-baseline, against a baseline saved on the same machine.
+
+usage - from the python folder
+        python benchmark.py                            # sample logs and a 2 hour synthetic log
+        python benchmark.py ../data/*.LOG -r 5         # other logs, best of 5 runs
+        python benchmark.py --synthetic 1 --rate 5     # one day synthetic log sampled every 5 seconds
+        python benchmark.py --save-baseline            # store the timings as the baseline
+        python benchmark.py --check-baseline           # exit with status 1 if a stage is slower than the baseline
+        python benchmark.py --readers --lomb           # also compare the reader modes and Lomb-Scargle methods
+        python benchmark.py --imports                  # also check the import time of the processing modules
+"""
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+from batch import process_file
+from gnss_systems import wavelengths
+from lombscargle import lomb
+from process_gnss import GNSSProcessor, detrend_track, retrieve_height
+from readGPS import readGPS, readGNSS
+from synthetic import write_log, DEFAULT_SATELLITES
+from utils import get_ofac_hifac
+
+SAMPLE_LOG = Path(__file__).resolve().parent.parent / "sample_data" / "farm" / "25052202.LOG"
+SAMPLE_LOGS = sorted(SAMPLE_LOG.parent.glob("*.LOG"))
+BASELINE = Path(__file__).resolve().parent / "benchmark_baseline.json"
+STAGES = ('parse', 'detrend', 'periodogram', 'end_to_end')
+AZIMUTH_BINS = [(0, 90), (90, 180), (180, 270), (270, 360)]
+
+# tolerance of the fast Lomb-Scargle method: largest amplitude error relative to the peak amplitude of the direct method
+LOMB_FAST_RTOL = 1e-3
+# modules of the parse and retrieve path, the seconds a fresh interpreter may take to import each of them, and the
+# modules they must not import (plotting is only imported by the graphs)
+IMPORT_MODULES = ('readGPS', 'process_gnss', 'batch')
+IMPORT_BUDGET = 0.5
+HEAVY_MODULES = ('matplotlib', 'scipy')
+# block size large enough for the direct method to evaluate every frequency at once, as the original implementation did
+UNBOUNDED_BLOCK = 1 << 62
+
+
+def time_call(func, *args, repeat=3, **kwargs):
+    """
+    Time a function call, keeping the best of several runs.
+
+    :param func: function to time
+    :param repeat: number of runs
+    :return: (best wall time in seconds, result of the last call)
+    """
+    best = np.inf
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def peak_memory(func, *args, **kwargs):
+    """
+    Peak memory allocated by a function call, as traced by tracemalloc (NumPy buffers included).
+
+    :return: (peak in bytes, result of the call)
+    """
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak, result
+
+
+def same_gnss_data(a, b):
+    """
+    Check two `readGPS` outputs hold identical arrays (NaN compares equal).
+    """
+    if len(a) != len(b):
+        return False
+    for x, y in zip(a, b):
+        if x.dtype != y.dtype or x.shape != y.shape:
+            return False
+        for name in x.dtype.names:
+            if not np.array_equal(x[name], y[name], equal_nan=True):
+                return False
+    return True
+
+
+def bench_read(path, repeat=3, interp=True, modes=('legacy', 'buffered', 'mmap')):
+    """
+    Time each `readGPS` mode on one file, measure its peak memory and check all modes return the same data as
+    the first mode.
+
+    :param path: path to the .LOG file
+    :param repeat: number of runs per mode, the best is reported
+    :param interp: passed to `readGPS`
+    :param modes: reader modes to compare, the first is the reference for speedup and output
+    :return: dict of mode -> best wall time in seconds
+    """
+    path = Path(path)
+    size_mb = path.stat().st_size / 1e6
+    timings = {}
+    reference = None
+    print("{} ({:.1f} MB, interp={})".format(path.name, size_mb, interp))
+    for mode in modes:
+        # the legacy reader does not check the NMEA checksums, so none of the modes do here
+        seconds, gnss_data = time_call(readGPS, path, interp, mode=mode, validate=False, repeat=repeat)
+        peak, _ = peak_memory(readGPS, path, interp, mode=mode, validate=False)
+        timings[mode] = seconds
+        if reference is None:
+            reference = gnss_data
+            note = ""
+        else:
+            note = "matches {}".format(modes[0]) if same_gnss_data(reference, gnss_data) else "MISMATCH"
+        out_mb = sum(d.nbytes for d in gnss_data) / 1e6
+        print("  {:<10} {:8.3f} s  {:7.1f} MB/s  x{:<6.1f} peak {:7.1f} MB (output {:.1f} MB)  {}".format(
+            mode, seconds, size_mb / seconds, timings[modes[0]] / seconds, peak / 1e6, out_mb, note))
+    return timings
+
+
+def detrended_tracks(path):
+    """
+    Periodogram inputs of every track of a file that passes the detrending gates.
+
+    :param path: path to the .LOG file
+    :return: list of (t, h, ofac, hifac) arguments of `lomb`
+    """
+    gnss_data, satellites = readGNSS(path, True)
+    params = GNSSProcessor(AZIMUTH_BINS).track_params()
+    inputs = []
+    for group, cf in zip(gnss_data, wavelengths(satellites)):
+        track = detrend_track(group, params)
+        if track is None:
+            continue
+        ofac, hifac = get_ofac_hifac(track['elevation_angles'], cf / 2, params['max_height'],
+                                     params['desired_precision'])
+        inputs.append((track['x'] / (cf / 2), track['y'], ofac, hifac))
+    return inputs
+
+
+def bench_lomb(path, repeat=1):
+    """
+    Time the Lomb-Scargle methods on the tracks of one file and validate them against the unbounded direct method,
+    i.e. the original implementation: the bounded direct method must match it exactly and the fast method within
+    LOMB_FAST_RTOL of the peak amplitude, with its peak at the same frequency.
+
+    :param path: path to the .LOG file
+    :param repeat: number of runs per method, the best is reported
+    :return: True if every method is within its tolerance
+    """
+    path = Path(path)
+    inputs = detrended_tracks(path)
+    print("{} ({} tracks)".format(path.name, len(inputs)))
+    if not inputs:
+        return True
+
+    methods = (('unbounded', dict(block_size=UNBOUNDED_BLOCK)), ('direct', dict(method='direct')),
+               ('fast', dict(method='fast')))
+    reference = None
+    valid = True
+    for name, kwargs in methods:
+        def run():
+            return [lomb(*args, **kwargs) for args in inputs]
+        seconds, spectra = time_call(run, repeat=repeat)
+        peak = max(peak_memory(lomb, *args, **kwargs)[0] for args in inputs)
+        if reference is None:
+            reference = spectra
+            timings = seconds
+            note = "reference"
+        else:
+            error = max(np.max(np.abs(p[1] - r[1])) / np.max(r[1]) for p, r in zip(spectra, reference))
+            same_peak = all(np.argmax(p[1]) == np.argmax(r[1]) for p, r in zip(spectra, reference))
+            ok = same_peak and (error == 0 if name == 'direct' else error <= LOMB_FAST_RTOL)
+            valid &= ok
+            note = "max rel error {:.1e}, {}  {}".format(error, "same peaks" if same_peak else "PEAKS DIFFER",
+                                                         "ok" if ok else "OUT OF TOLERANCE")
+        print("  {:<10} {:8.3f} s  x{:<7.1f} peak {:7.1f} MB  {}".format(name, seconds, timings / seconds, peak / 1e6,
+                                                                        note))
+    return valid
+
+
+def synthetic_log(days, rate=1, satellites=None, seed=0):
+    """
+    Path of a synthetic log, written to the temporary folder unless a log with the same parameters is already there.
+
+    :param days: length of the log in days
+    :param rate: seconds between epochs
+    :param satellites: satellites per constellation, None for full constellations
+    :param seed: random seed
+    :return: Path of the log
+    """
+    folder = Path(tempfile.gettempdir()) / "gnss_benchmark"
+    folder.mkdir(exist_ok=True)
+    path = folder / "synthetic_{:g}h_{}s_{}sat_{}.LOG".format(round(days * 24, 3), rate, satellites or 'all', seed)
+    if not path.exists():
+        counts = None if satellites is None else {system: satellites for system in DEFAULT_SATELLITES}
+        write_log(path, days, counts, rate, seed=seed)
+    return path
+
+
+def bench_stages(path, stages=STAGES, repeat=3):
+    """
+    Time and measure the peak memory of each stage of the pipeline on one file. The stages are timed separately
+    from their memory measurement, as tracing allocations slows them down.
+
+    :param path: path to the .LOG file
+    :param stages: stages to run, some of STAGES
+    :param repeat: number of runs per stage, the best is reported
+    :return: dict of stage -> dict of 'seconds', 'peak_mb' and the stage throughputs
+    """
+    path = Path(path)
+    size_mb = path.stat().st_size / 1e6
+    processor = GNSSProcessor(AZIMUTH_BINS)
+    params = processor.track_params()
+    gnss_data, satellites = readGNSS(path, True)
+    carrier = wavelengths(satellites)
+    epochs = max((int(track['count'][-1]) + 1 for track in gnss_data if track.size), default=0)
+
+    def detrend():
+        return [detrend_track(group, params) for group in gnss_data]
+    detrended = [(group, track, cf) for group, track, cf in zip(gnss_data, detrend(), carrier) if track is not None]
+
+    def periodogram():
+        return [retrieve_height(group, track, cf, params) for group, track, cf in detrended]
+
+    runs = {
+        'parse': (lambda: readGNSS(path, True), lambda seconds: {'MB/s': size_mb / seconds,
+                                                                 'epochs/s': epochs / seconds}),
+        'detrend': (detrend, lambda seconds: {'tracks/s': len(gnss_data) / seconds}),
+        'periodogram': (periodogram, lambda seconds: {'tracks/s': len(detrended) / seconds}),
+        'end_to_end': (lambda: process_file(path, AZIMUTH_BINS), lambda seconds: {'epochs/s': epochs / seconds}),
+    }
+    print("{} ({:.1f} MB, {} epochs, {} tracks, {} detrended)".format(path.name, size_mb, epochs, len(gnss_data),
+                                                                      len(detrended)))
+    report = {}
+    for stage in stages:
+        func, throughput = runs[stage]
+        seconds, _ = time_call(func, repeat=repeat)
+        peak, _ = peak_memory(func)
+        report[stage] = dict(seconds=seconds, peak_mb=peak / 1e6, **throughput(seconds))
+        rates = "  ".join("{:9.1f} {}".format(value, unit) for unit, value in throughput(seconds).items())
+        print("  {:<12} {:8.3f} s  peak {:7.1f} MB  {}".format(stage, seconds, peak / 1e6, rates))
+    return report
+
+
+def bench_imports(modules=IMPORT_MODULES, budget=IMPORT_BUDGET, repeat=3):
+    """
+    Time importing each module in a fresh interpreter, run from this folder, and check it stays within the budget
+    without importing any of HEAVY_MODULES.
+
+    :param modules: module names
+    :param budget: allowed import time in seconds
+    :param repeat: number of runs per module, the best is reported
+    :return: True if every module is within the budget
+    """
+    code = ("import sys, time\n"
+            "start = time.perf_counter()\n"
+            "import {}\n"
+            "print(time.perf_counter() - start, *[name for name in {!r} if name in sys.modules])")
+    folder = Path(__file__).resolve().parent
+    valid = True
+    print("imports (budget {:.2f} s)".format(budget))
+    for module in modules:
+        runs = [subprocess.run([sys.executable, '-c', code.format(module, HEAVY_MODULES)], cwd=folder,
+                               capture_output=True, text=True, check=True).stdout.split() for _ in range(repeat)]
+        seconds = min(float(run[0]) for run in runs)
+        heavy = sorted(set(name for run in runs for name in run[1:]))
+        ok = seconds <= budget and not heavy
+        valid &= ok
+        note = "imports {}".format(", ".join(heavy)) if heavy else ""
+        print("  {:<12} {:8.3f} s  {}  {}".format(module, seconds, "ok" if ok else "OVER BUDGET", note).rstrip())
+    return valid
+
+
+def compare_baseline(reports, baseline, tolerance=0.2):
+    """
+    Stages slower than their baseline by more than the tolerance.
+
+    :param reports: dict of file name -> stage reports of `bench_stages`
+    :param baseline: reports stored by an earlier run
+    :param tolerance: allowed relative slow down
+    :return: list of (file name, stage, seconds, baseline seconds)
+    """
+    regressions = []
+    for name, report in reports.items():
+        for stage, result in report.items():
+            reference = baseline.get(name, {}).get(stage)
+            if reference and result['seconds'] > reference['seconds'] * (1 + tolerance):
+                regressions.append((name, stage, result['seconds'], reference['seconds']))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the GNSS-IR processing stages.")
+    parser.add_argument("files", nargs="*", default=SAMPLE_LOGS, help="LOG files to benchmark")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="runs per measurement, best is kept")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES), help="stages to benchmark")
+    parser.add_argument("--synthetic", type=float, default=1 / 12,
+                        help="days of synthetic log to add to the files, 0 for none")
+    parser.add_argument("--rate", type=int, default=1, help="seconds between epochs of the synthetic log")
+    parser.add_argument("--satellites", type=int, default=None,
+                        help="satellites per constellation of the synthetic log, full constellations by default")
+    parser.add_argument("--baseline", type=Path, default=BASELINE, help="baseline JSON file")
+    parser.add_argument("--save-baseline", action="store_true", help="store the timings as the baseline")
+    parser.add_argument("--check-baseline", action="store_true",
+                        help="exit with status 1 when a stage is slower than the baseline, which must have been saved "
+                             "on this machine")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slow down reported as a regression")
+    parser.add_argument("--readers", action="store_true", help="also compare the readGPS modes")
+    parser.add_argument("--lomb", action="store_true", help="also benchmark and validate the Lomb-Scargle methods")
+    parser.add_argument("--imports", action="store_true",
+                        help="also check the import time of the processing modules against IMPORT_BUDGET")
+    args = parser.parse_args()
+
+    files = [Path(file) for file in args.files]
+    if args.synthetic > 0:
+        files.append(synthetic_log(args.synthetic, args.rate, args.satellites))
+
+    reports = {file.name: bench_stages(file, args.stages, args.repeat) for file in files}
+    if args.readers:
+        for file in files:
+            bench_read(file, repeat=args.repeat)
+    valid = not args.lomb or all([bench_lomb(file) for file in files])
+    if args.imports:
+        valid &= bench_imports(repeat=args.repeat)
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(reports, indent=2))
+        print("Baseline saved to", args.baseline)
+    elif args.baseline.exists():
+        regressions = compare_baseline(reports, json.loads(args.baseline.read_text()), args.tolerance)
+        # the baseline timings come from whichever machine saved them, so being slower only fails when asked for
+        label = "REGRESSION" if args.check_baseline else "slower than baseline"
+        for name, stage, seconds, reference in regressions:
+            print("{} {} {}: {:.3f} s, baseline {:.3f} s".format(label, name, stage, seconds, reference))
+        if args.check_baseline:
+            valid &= not regressions
+
+    if not valid:
+        raise SystemExit(1)
@@ -0,0 +1,182 @@
+"""
+On-disk cache of parsed GNSS observations.
+
+Parsing the raw NMEA text is the slowest step left when re-processing the same logs with different settings in
+config.ini, yet its output only depends on the log and the reader options. `ObservationCache.read` returns what
+`readGNSS` would, from a cache entry when there is one for the file's path, size and modification time and the same
+options, and parses the file and stores the result otherwise.
+
+Each entry is an uncompressed .npz file holding the observation table of every satellite end to end, the bounds of
+each satellite's rows and the satellite table. When the entries exceed the size limit, the least recently used ones
+are removed.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from gnss_systems import ALL_SYSTEMS, satellite_dt
+from readGPS import readGNSS, dt
+
+# bump when the entries or the reader output change, so older entries are not used
+CACHE_VERSION = 3
+DEFAULT_DIRECTORY = Path(__file__).resolve().parent / ".gnss_cache"
+DEFAULT_MAX_BYTES = 500 * 10**6
+
+
+def cache_key(Filename, **options):
+    """
+    Key of a log file's cache entry.
+
+    :param Filename: path to the .LOG file
+    :param options: reader options the parsed output depends on
+    :return: hex digest of the absolute path, size, modification time and options
+    """
+    stat = os.stat(Filename)
+    identity = [CACHE_VERSION, os.path.abspath(Filename), stat.st_size, stat.st_mtime_ns, sorted(options.items())]
+    return hashlib.sha1(json.dumps(identity).encode()).hexdigest()
+
+
+def config_cache(config):
+    """
+    Cache set up by the [cache] section of config.ini.
+
+    :param config: ConfigParser of config.ini
+    :return: ObservationCache, or None if the cache is disabled (no section or an empty directory)
+    """
+    if not config.has_section('cache') or not config['cache'].get('directory'):
+        return None
+    directory = Path(__file__).resolve().parent / config['cache']['directory']
+    max_bytes = config['cache'].getfloat('max_size_mb', fallback=DEFAULT_MAX_BYTES / 10**6) * 10**6
+    return ObservationCache(directory, max_bytes)
+
+
+class ObservationCache:
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param directory: folder of the cache entries, created when needed
+        :param max_bytes: total size of the entries, the least recently used entries are removed beyond it
+        """
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, Filename, interp=False, mode='buffered', systems=ALL_SYSTEMS, validate=True):
+        """
+        `readGNSS` through the cache. The reader mode does not change the parsed output, so it is not part of the key.
+
+        :return: (tracks, satellites) as returned by `readGNSS`
+        """
+        systems = tuple(systems)
+        key = cache_key(Filename, interp=interp, systems=systems, validate=validate)
+        entry = self.load(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        tracks, satellites = readGNSS(Filename, interp, mode, systems, validate)
+        self.store(key, tracks, satellites)
+        return tracks, satellites
+
+    def path(self, key):
+        return self.directory / (key + ".npz")
+
+    def load(self, key):
+        """
+        Load a cache entry and mark it as recently used.
+
+        :param key: key returned by `cache_key`
+        :return: (tracks, satellites), or None if there is no such entry
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                table = entry['table']
+                bounds = entry['bounds']
+                satellites = entry['satellites']
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            # missing, evicted by another process, or a partly written entry
+            return None
+        tracks = [table[bounds[k]:bounds[k + 1]] for k in range(len(satellites))]
+        return tracks, satellites
+
+    def store(self, key, tracks, satellites):
+        """
+        Write a cache entry, then evict entries beyond the size limit. The entry is written to a temporary file and
+        renamed so other processes never read a partial entry. Logs too large for the cache on their own are not
+        stored.
+
+        :param key: key returned by `cache_key`
+        :param tracks: list of structured arrays of dtype readGPS.dt
+        :param satellites: satellite table of the tracks
+        :return: None
+        """
+        table = np.concatenate(tracks) if tracks else np.zeros(0, dtype=dt)
+        if table.nbytes > self.max_bytes:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        bounds = np.concatenate(([0], np.cumsum([len(track) for track in tracks], dtype=int)))
+        fd, temp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as fid:
+                np.savez(fid, table=table, bounds=bounds, satellites=np.asarray(satellites, dtype=satellite_dt))
+            os.replace(temp, self.path(key))
+        except BaseException:
+            os.unlink(temp)
+            raise
+        self.evict()
+
+    def entries(self):
+        """
+        :return: list of (last use time, size in bytes, path) of every entry
+        """
+        entries = []
+        for path in self.directory.glob("*.npz"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self):
+        """
+        :return: total size of the entries in bytes
+        """
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes.
+        :return: number of entries removed
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry[0])
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        """
+        Remove every entry.
+        :return: None
+        """
+        for _, _, path in self.entries():
+            try:
+                path.unlink()
+            except OSError:
+                pass
@@ -0,0 +1,226 @@
+"""
+Command line batch processing, without any prompts.
+
+usage
+    python cli.py "../sample_data/**/2505*.LOG" --azimuth 90 270 --output heights.csv --figures figures
+
+Every option of the interactive matlab_translate.py is a command line argument, so runs can be scripted and scheduled.
+The exit status tells how the run went, see the EXIT_* constants.
+"""
+import argparse
+import datetime
+import glob
+import sys
+from pathlib import Path
+
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_USAGE = 2  # also used by argparse for invalid arguments
+EXIT_NO_FILES = 3
+EXIT_NO_RETRIEVALS = 4
+
+DEFAULT_AZIMUTH_BINS = [(0, 90), (90, 180), (180, 270), (270, 360)]
+OUTPUT_FORMATS = ('csv', 'parquet')
+
+
+def find_files(patterns, data_dir=None):
+    """
+    LOG files matching glob patterns.
+
+    :param patterns: glob patterns, '**' matches any number of folders
+    :param data_dir: folder searched recursively for the patterns, as matlab_translate does, None to match the patterns
+                     as paths
+    :return: sorted list of Path, by file name
+    """
+    files = set()
+    for pattern in patterns:
+        if data_dir is None:
+            files.update(Path(file) for file in glob.glob(pattern, recursive=True))
+        else:
+            files.update(Path(data_dir).rglob(pattern))
+    return sorted((file for file in files if file.is_file()), key=lambda x: x.name)
+
+
+def azimuth_bins(ranges):
+    """
+    Check the --azimuth ranges.
+
+    :param ranges: list of [min, max] in degrees, None for the default bins
+    :return: list of (min, max)
+    """
+    if not ranges:
+        return DEFAULT_AZIMUTH_BINS
+    for az_min, az_max in ranges:
+        if not 0 <= az_min < az_max <= 360:
+            raise ValueError("Invalid azimuth range {} {}, ensure 0 <= min < max <= 360.".format(az_min, az_max))
+    return [tuple(r) for r in ranges]
+
+
+def output_format(path, fmt=None):
+    """
+    :param path: output file path
+    :param fmt: format given on the command line, None to take it from the file suffix
+    :return: 'csv' or 'parquet'
+    """
+    fmt = fmt or Path(path).suffix.lstrip('.').lower()
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format '{}', use one of {} or pass --format.".format(fmt, OUTPUT_FORMATS))
+    return fmt
+
+
+def profile_path(path):
+    """
+    Check the profile report can be written, creating its folder, so a bad path fails before the run rather than after.
+
+    :param path: report file path, None for no report
+    :return: path
+    """
+    if path is None:
+        return None
+    path = Path(path)
+    if path.is_dir():
+        raise ValueError("Invalid profile report {}, it is a folder.".format(path))
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        raise ValueError("Invalid profile report {}: {}".format(path, e)) from None
+    return path
+
+
+def parse_day(text):
+    """
+    :param text: date in YYYY-MM-DD format
+    :return: datetime.date
+    """
+    try:
+        return datetime.datetime.strptime(text, "%Y-%m-%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date '{}', use YYYY-MM-DD".format(text)) from None
+
+
+def write_outputs(args, files, bins, fmt, workers):
+    """
+    Process the files and write the retrievals, aggregates, stacked heights and figures asked for.
+
+    :param args: parsed command line arguments
+    :param files: LOG files
+    :param bins: azimuth bins
+    :param fmt: format of args.output, None for no output file
+    :param workers: number of worker processes
+    :return: exit status
+    """
+    from aggregate import Aggregator
+    from batch import process_files, render_figures
+    from stack import stack_heights, write_csv as write_stack
+
+    processor = process_files(files, bins, args.min_el, args.max_el, workers, args.config)
+    print("{} reflector heights from {} files".format(len(processor.store), len(files)))
+    if len(processor.store) == 0:
+        return EXIT_NO_RETRIEVALS
+
+    if fmt is not None:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+    if fmt == 'csv':
+        processor.store.write_csv(args.output)
+    elif fmt == 'parquet':
+        processor.store.write_parquet(args.output)
+    if fmt is not None:
+        print("Reflector heights written to", args.output)
+    if args.aggregate is not None:
+        width, path = args.aggregate
+        aggregator = Aggregator(width, bins)
+        aggregator.update(processor.store)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        print("{} aggregates written to {}".format(aggregator.write_csv(path), path))
+    if args.stack is not None:
+        width, path = args.stack
+        rows, _, _ = stack_heights(processor, width)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        print("{} stacked heights written to {}".format(write_stack(rows, path, bins), path))
+    if args.figures is not None:
+        written = render_figures(processor, args.figures, *args.days, workers)
+        print("{} figures written to {}".format(len(written), args.figures))
+    return EXIT_OK
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process GNSS logs into reflector heights without any prompts.")
+    parser.add_argument("patterns", nargs="+", help="LOG files or glob patterns, e.g. '../sample_data/**/2505*.LOG'")
+    parser.add_argument("--data-dir", type=Path, default=None,
+                        help="folder searched recursively for the patterns, e.g. ../sample_data")
+    parser.add_argument("--azimuth", nargs=2, type=float, action="append", metavar=("MIN", "MAX"),
+                        help="azimuth range in degrees, repeat for several ranges (default 4 bins of 90 degrees)")
+    parser.add_argument("--min-el", type=float, default=6, help="minimum elevation angle in degrees")
+    parser.add_argument("--max-el", type=float, default=30, help="maximum elevation angle in degrees")
+    parser.add_argument("--config", type=Path, default=None, help="configuration file (default config.ini)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes, 0 uses every core (default from the configuration)")
+    parser.add_argument("-o", "--output", type=Path, default=None, help="file the retrievals are written to")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default=None,
+                        help="format of --output (default from its suffix), parquet needs pyarrow")
+    parser.add_argument("--aggregate", nargs=2, default=None, metavar=("WIDTH", "FILE"),
+                        help="write the median heights of each time bin (e.g. 1h, 6h, 1d) and azimuth range, after "
+                             "outlier rejection, to a CSV file")
+    parser.add_argument("--stack", nargs=2, default=None, metavar=("WIDTH", "FILE"),
+                        help="write the reflector height of the stacked spectra of each time window (e.g. 6h, 1d) and "
+                             "azimuth range to a CSV file")
+    parser.add_argument("--figures", type=Path, default=None, help="folder the plots are saved to as PNG files")
+    parser.add_argument("--days", nargs=2, type=parse_day, default=(None, None), metavar=("FIRST", "LAST"),
+                        help="only save the plots of the days from FIRST to LAST (YYYY-MM-DD)")
+    parser.add_argument("--profile", type=Path, default=None,
+                        help="JSON file the profile report is written to (default profile_report of the configuration)")
+    args = parser.parse_args(argv)
+
+    try:
+        bins = azimuth_bins(args.azimuth)
+        if not 0 <= args.min_el < args.max_el <= 90:
+            raise ValueError("Invalid elevation range {} {}, ensure 0 <= min < max <= 90.".format(args.min_el,
+                                                                                                 args.max_el))
+        fmt = output_format(args.output, args.format) if args.output is not None else None
+        for option in (args.aggregate, args.stack):
+            if option is not None:
+                from aggregate import bin_width
+                bin_width(option[0])
+    except ValueError as e:
+        parser.print_usage(sys.stderr)
+        print("error:", e, file=sys.stderr)
+        return EXIT_USAGE
+
+    import instrument
+    from process_gnss import CONFIG_PATH, read_config
+
+    try:
+        config = read_config(args.config or CONFIG_PATH)
+        workers = args.workers
+        if workers is None:
+            workers = config['processing'].getint('workers', fallback=0)
+        profile = args.profile or config['processing'].get('profile_report', fallback='') or None
+        try:
+            profile = profile_path(profile)
+        except ValueError as e:
+            parser.print_usage(sys.stderr)
+            print("error:", e, file=sys.stderr)
+            return EXIT_USAGE
+        files = find_files(args.patterns, args.data_dir)
+        if not files:
+            print("No files match", " ".join(args.patterns), file=sys.stderr)
+            return EXIT_NO_FILES
+
+        if profile is not None:
+            instrument.enable()
+        try:
+            return write_outputs(args, files, bins, fmt, workers)
+        finally:
+            # written last, so the plotting is in the report and a failure writing it loses none of the outputs
+            if profile is not None:
+                instrument.write_report(profile)
+                print(instrument.summary())
+                print("Profile report written to", profile)
+    except (OSError, ValueError, ImportError) as e:
+        print("error:", e, file=sys.stderr)
+        return EXIT_ERROR
+
+
+if __name__ == "__main__":
+    sys.exit(main())
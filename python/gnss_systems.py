@@ -0,0 +1,62 @@
+"""
+GNSS constellations reported in the receiver's GSV sentences.
+
+Satellites are identified by the NMEA talker id of their system and their PRN, and packed into a single integer
+key `system index * KEY_STRIDE + PRN` so tracks of every constellation can be indexed densely.
+"""
+import numpy as np
+
+# talker id: (system name, NMEA signal id of the tracked signal, carrier wavelength in meters, lowest PRN,
+# highest PRN). Only the tracked signal is kept when a sentence carries a signal id (NMEA 4.10 and later).
+SYSTEMS = {
+    'GP': ('GPS', 1, 0.1902936, 1, 32),  # L1 C/A 1575.42 MHz, PRN 33-64 are SBAS and skipped
+    'GL': ('GLONASS', 1, 0.1871364, 65, 96),  # L1 OF 1602 MHz, the nominal channel 0 frequency
+    'GA': ('Galileo', 7, 0.1902936, 1, 36),  # E1 1575.42 MHz
+    'GB': ('BeiDou', 1, 0.1920395, 1, 63),  # B1I 1561.098 MHz
+}
+
+ALL_SYSTEMS = tuple(SYSTEMS)
+KEY_STRIDE = 256
+
+# dense satellite index, one row per track returned by readGNSS
+satellite_dt = np.dtype([('system', 'U2'), ('prn', int)])
+
+
+def satellite_table(keys, systems):
+    """
+    Satellite table for an array of packed keys.
+
+    :param keys: integer keys, system index (position in `systems`) * KEY_STRIDE + PRN
+    :param systems: talker ids the keys were packed with
+    :return: structured array of (system, prn)
+    """
+    keys = np.asarray(keys, dtype=int)
+    satellites = np.zeros(keys.size, dtype=satellite_dt)
+    satellites['system'] = np.asarray(systems, dtype='U2')[keys // KEY_STRIDE] if keys.size else []
+    satellites['prn'] = keys % KEY_STRIDE
+    return satellites
+
+
+def gsv_heads(systems):
+    """
+    GSV sentence heads of the given constellations.
+
+    :param systems: talker ids, the position of each one is its system index
+    :return: dict of sentence head (e.g. '$GPGSV') -> (system index, tracked signal id, lowest PRN, highest PRN)
+    """
+    heads = {}
+    for index, system in enumerate(systems):
+        _, signal, _, prn_min, prn_max = SYSTEMS[system]
+        heads["$" + system + "GSV"] = (index, signal, prn_min, prn_max)
+    return heads
+
+
+def wavelengths(satellites):
+    """
+    Carrier wavelength in meters of each satellite.
+
+    :param satellites: structured array of (system, prn) as returned by readGNSS
+    :return: float array
+    """
+    lookup = {system: info[2] for system, info in SYSTEMS.items()}
+    return np.array([lookup[system] for system in satellites['system']], dtype=float)
@@ -0,0 +1,180 @@
+"""
+Profiling hooks for the processing pipeline.
+
+The readers and GNSSProcessor time their stages with `stage` or `timed` and count what they do with `count` (lines
+parsed, tracks considered, tracks rejected by each quality gate, ...). Nothing is recorded until `enable` is called:
+`stage` then returns a shared no-op context manager and `count` returns straight away, so the hooks cost next to
+nothing in normal runs.
+
+usage
+    >>> import instrument
+    >>> instrument.enable()
+    >>> processor.process_gnss(*readGNSS("25052202.LOG", True))
+    >>> instrument.write_report("profile.json")
+"""
+import functools
+import json
+import time
+from contextlib import nullcontext
+
+_NULL = nullcontext()
+_profile = None
+
+
+class Profile:
+    def __init__(self):
+        self.timers = {}  # stage -> [seconds, calls]
+        self.counters = {}  # name -> count
+        self.started = time.perf_counter()
+
+    def add_time(self, name, seconds, calls=1):
+        timer = self.timers.setdefault(name, [0.0, 0])
+        timer[0] += seconds
+        timer[1] += calls
+
+    def add_count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+
+class _Timer:
+    __slots__ = ('profile', 'name', 'start')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def enable():
+    """
+    Start recording, discarding anything recorded before.
+    :return: None
+    """
+    global _profile
+    _profile = Profile()
+
+
+def disable():
+    """
+    Stop recording.
+    :return: None
+    """
+    global _profile
+    _profile = None
+
+
+def enabled():
+    """
+    :return: True while recording
+    """
+    return _profile is not None
+
+
+def stage(name):
+    """
+    Context manager timing a stage, e.g. `with instrument.stage('lomb'): ...`. Nested stages are timed separately,
+    each including the time of the stages inside it.
+
+    :param name: stage name
+    :return: context manager
+    """
+    if _profile is None:
+        return _NULL
+    return _Timer(_profile, name)
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function as a stage.
+
+    :param name: stage name
+    :return: decorator
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profile is None:
+                return func(*args, **kwargs)
+            with _Timer(_profile, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    """
+    Add to a counter.
+
+    :param name: counter name, e.g. 'rejected.min_points'
+    :param n: amount to add
+    :return: None
+    """
+    if _profile is not None:
+        _profile.add_count(name, n)
+
+
+def report():
+    """
+    Everything recorded so far.
+
+    :return: dict with 'wall_seconds', 'timers' (stage -> seconds and calls) and 'counters', or None when disabled
+    """
+    if _profile is None:
+        return None
+    return {
+        'wall_seconds': time.perf_counter() - _profile.started,
+        'timers': {name: {'seconds': seconds, 'calls': calls} for name, (seconds, calls) in _profile.timers.items()},
+        'counters': dict(_profile.counters),
+    }
+
+
+def merge(other):
+    """
+    Add a report of another process, e.g. a worker of batch.process_files, to the current recording.
+
+    :param other: dict returned by `report`
+    :return: None
+    """
+    if _profile is None or other is None:
+        return
+    for name, timer in other['timers'].items():
+        _profile.add_time(name, timer['seconds'], timer['calls'])
+    for name, n in other['counters'].items():
+        _profile.add_count(name, n)
+
+
+def write_report(path):
+    """
+    Write the recording as a JSON run report.
+
+    :param path: file path
+    :return: the report written
+    """
+    run = report()
+    with open(path, 'w') as fid:
+        json.dump(run, fid, indent=2)
+    return run
+
+
+def summary():
+    """
+    Readable summary of the recording, stages by decreasing time then the counters.
+
+    :return: str
+    """
+    run = report()
+    if run is None:
+        return "Profiling is disabled."
+    lines = ["Run time {:.3f} s".format(run['wall_seconds'])]
+    for name, timer in sorted(run['timers'].items(), key=lambda item: -item[1]['seconds']):
+        lines.append("  {:<14} {:10.3f} s  {:8d} calls".format(name, timer['seconds'], timer['calls']))
+    for name, n in sorted(run['counters'].items()):
+        lines.append("  {:<28} {:10d}".format(name, n))
+    return "\n".join(lines)
@@ -1,6 +1,16 @@
 import numpy as np
 
-def lomb(t, h, ofac, hifac):
+# largest len(f) x len(t) block evaluated at once by the direct method, in elements (8 MB per float64 matrix)
+BLOCK_SIZE = 1 << 20
+# number of grid points each sample is spread over by the fast method (Press & Rybicki's MACC)
+MACC = 4
+LOMB_METHODS = ('direct', 'fast')
+# frequencies of the full grid per frequency of the coarse spectrum of `lomb_peaks`, and number of its peaks refined
+COARSE_STEP = 4
+N_PEAKS = 3
+
+
+def lomb(t, h, ofac, hifac, method='direct', block_size=BLOCK_SIZE):
     """
     Computes the Lomb normalized periodogram of unevenly sampled data.
     Translated from Dmitry Savransky's original implementation in Matlab.
@@ -9,6 +19,9 @@ def lomb(t, h, ofac, hifac):
     :param h: 1D array of data values (same length as t)
     :param ofac: oversampling factor (typically >= 4)
     :param hifac: high-frequency factor (multiple of average Nyquist frequency)
+    :param method: 'direct' evaluates the periodogram exactly, a block of frequencies at a time. 'fast' uses the
+                   Press & Rybicki extirpolation and FFT approximation, in O(N log N) time and O(N) memory.
+    :param block_size: largest number of frequency x sample terms held in memory at once by the direct method
     :return: (f, P, prob, conf95)
              f: array of frequencies considered
              P: spectral amplitude at each frequency
@@ -18,6 +31,8 @@ def lomb(t, h, ofac, hifac):
 
     if t.shape != h.shape:
         raise ValueError("t and h must have the same shape")
+    if method not in LOMB_METHODS:
+        raise ValueError("Unknown Lomb-Scargle method {!r}, expected one of {}".format(method, LOMB_METHODS))
 
     # Sample length and time span
     N = len(h)
@@ -30,29 +45,14 @@ def lomb(t, h, ofac, hifac):
     # Calculate sampling frequencies
     f_step = 1 / (T * ofac)
     f_max = hifac * N / (2 * T)
-    f = np.arange(f_step, f_max + f_step, f_step)
-
-    # Angular frequencies
-    w = 2 * np.pi * f
-
-    # Constant offsets (tau)
-    sin_term = np.sum(np.sin(2 * w[:, np.newaxis] * t), axis=1)
-    cos_term = np.sum(np.cos(2 * w[:, np.newaxis] * t), axis=1)
-    tau = np.arctan2(sin_term, cos_term) / (2 * w)
-
-    # Spectral power terms
-    phase_shift = w[:, np.newaxis] * t - (w * tau)[:, np.newaxis]
-    cterm = np.cos(phase_shift)
-    sterm = np.sin(phase_shift)
+    f = frequency_grid(f_step, f_max)
 
     # Compute power
     h_centered = h - mu
-    c_weighted = np.sum(cterm * h_centered, axis=1)
-    s_weighted = np.sum(sterm * h_centered, axis=1)
-    c_sum_sq = np.sum(cterm**2, axis=1)
-    s_sum_sq = np.sum(sterm**2, axis=1)
-
-    P = (c_weighted**2 / c_sum_sq + s_weighted**2 / s_sum_sq) / (2 * s2)
+    if method == 'fast':
+        P = fast_power(t, h_centered, len(f), T * ofac) / (2 * s2)
+    else:
+        P = direct_power(t, h_centered, f, block_size) / (2 * s2)
 
     # Estimate number of independent frequencies
     M = 2 * len(f) / ofac
@@ -70,4 +70,285 @@ def lomb(t, h, ofac, hifac):
     conf95_power = -np.log(1 - (1 - (1 - cf))**(1 / M))
     conf95 = 2 * np.sqrt(s2 * conf95_power / N)
 
-    return f, P, prob, conf95
\ No newline at end of file
+    return f, P, prob, conf95
+
+
+def lomb_peaks(t, h, ofac, hifac, method='direct', step=COARSE_STEP, n_peaks=N_PEAKS, block_size=BLOCK_SIZE):
+    """
+    Coarse to fine search of the periodogram peaks of `lomb`. The periodogram is evaluated on every `step`-th
+    frequency of the grid of `lomb` and at both ends of it, then on every frequency around the `n_peaks` highest local
+    maxima of that coarse spectrum, computed exactly. The highest peak is the one `lomb` finds as long as its lobe is
+    wider than `step` frequencies, which the oversampling of GNSS-IR tracks ensures by a wide margin.
+
+    :param t: 1D array of sample times (not necessarily evenly spaced)
+    :param h: 1D array of data values (same length as t)
+    :param ofac: oversampling factor
+    :param hifac: high-frequency factor
+    :param method: 'direct' or 'fast', method of the coarse spectrum, as for `lomb`
+    :param step: frequencies of the full grid per coarse frequency
+    :param n_peaks: number of coarse peaks refined
+    :param block_size: largest number of frequency x sample terms held in memory at once by the direct method
+    :return: (f, P, index)
+             f: full frequency grid of `lomb`
+             P: spectral amplitude at the frequencies evaluated, as P of `lomb`
+             index: increasing positions in f of the frequencies evaluated
+    """
+    if t.shape != h.shape:
+        raise ValueError("t and h must have the same shape")
+    if method not in LOMB_METHODS:
+        raise ValueError("Unknown Lomb-Scargle method {!r}, expected one of {}".format(method, LOMB_METHODS))
+
+    N = len(h)
+    T = np.max(t) - np.min(t)
+    mu = np.mean(h)
+    s2 = np.var(h, ddof=0)
+    f = frequency_grid(1 / (T * ofac), hifac * N / (2 * T))
+    h_centered = h - mu
+
+    coarse_index = np.arange(step - 1, len(f), step)
+    if method == 'fast':
+        coarse_power = fast_power(t, h_centered, len(coarse_index), T * ofac / step)
+    else:
+        coarse_power = direct_power(t, h_centered, f[coarse_index], block_size)
+
+    # highest local maxima of the coarse spectrum, the ends of the grid included
+    padded = np.concatenate(([-np.inf], coarse_power, [-np.inf]))
+    maxima = np.flatnonzero((padded[1:-1] >= padded[:-2]) & (padded[1:-1] > padded[2:]))
+    peaks = coarse_index[maxima[np.argsort(coarse_power[maxima])[::-1][:n_peaks]]]
+
+    # every frequency strictly between the coarse neighbours of each peak, and the ends of the grid
+    window = np.arange(1 - step, step)
+    fine_index = np.clip(peaks[:, np.newaxis] + window, 0, len(f) - 1).ravel()
+    fine_index = np.setdiff1d(np.concatenate((fine_index, [0, len(f) - 1])), coarse_index)
+    fine_power = direct_power(t, h_centered, f[fine_index], block_size)
+
+    index = np.concatenate((coarse_index, fine_index))
+    power = np.concatenate((coarse_power, fine_power))
+    order = np.argsort(index)
+    P = power[order] / (2 * s2)
+    return f, 2 * np.sqrt(s2 * P / N), index[order]
+
+
+def frequency_grid(f_step, f_max):
+    """
+    Regular frequency grid f_step, 2 f_step, ... up to f_max, as used by `lomb`. For GNSS-IR, with the sine of the
+    elevation angles divided by half the carrier wavelength as sample times, the frequencies are reflector heights in
+    meters and the grid of a processor is `frequency_grid(desired_precision, max_height)`.
+
+    :param f_step: frequency step, also the first frequency
+    :param f_max: highest frequency
+    :return: array of frequencies
+    """
+    return np.arange(f_step, f_max + f_step, f_step)
+
+
+def lomb_batch(ts, hs, f, method='direct', block_size=BLOCK_SIZE):
+    """
+    Lomb normalized periodogram of many series on one frequency grid, in a single vectorized evaluation. The series
+    can have different lengths (ragged): the direct method keeps them end to end and the fast method spreads each one
+    on its own row of a common FFT grid.
+
+    :param ts: sequence of 1D arrays of sample times, one per series
+    :param hs: sequence of 1D arrays of data values, same lengths as `ts`
+    :param f: frequency grid returned by `frequency_grid`, common to every series
+    :param method: 'direct' or 'fast', as for `lomb`
+    :param block_size: largest number of frequency x sample terms held in memory at once by the direct method
+    :return: 2D array of spectral amplitudes, one row per series and one column per frequency, as P of `lomb`
+    """
+    if method not in LOMB_METHODS:
+        raise ValueError("Unknown Lomb-Scargle method {!r}, expected one of {}".format(method, LOMB_METHODS))
+    if len(ts) != len(hs):
+        raise ValueError("ts and hs must have the same number of series")
+    if len(ts) == 0:
+        return np.empty((0, len(f)))
+
+    if any(np.shape(t) != np.shape(h) or len(t) == 0 for t, h in zip(ts, hs)):
+        raise ValueError("each series of ts and hs must have the same, non zero, length")
+
+    # series end to end, with the index of the series of each sample
+    lengths = np.array([len(t) for t in ts])
+    series = np.repeat(np.arange(len(lengths)), lengths)
+    t = np.concatenate(ts).astype(float)
+    h = np.concatenate(hs).astype(float)
+
+    # Mean and variance of each series
+    N = lengths[:, np.newaxis]
+    mu = np.bincount(series, h) / lengths
+    h_centered = h - mu[series]
+    s2 = (np.bincount(series, h_centered**2) / lengths)[:, np.newaxis]
+
+    if method == 'fast':
+        P = batch_fast_power(t, h_centered, series, len(f), 1 / f[0])
+    else:
+        P = batch_direct_power(t, h_centered, lengths, f, block_size)
+    P = P / (2 * s2)
+
+    # Convert power to amplitude
+    return 2 * np.sqrt(s2 * P / N)
+
+
+def batch_direct_power(t, h_centered, lengths, f, block_size=BLOCK_SIZE):
+    """
+    Unnormalized Lomb periodogram of concatenated series, evaluated exactly a block of frequencies at a time. The
+    series are kept end to end rather than padded, and the sums of each series are taken with `np.add.reduceat`.
+
+    :param t: 1D array of sample times of every series, one after the other
+    :param h_centered: 1D array of data values with the mean of their series removed
+    :param lengths: number of samples of each series, all above zero
+    :param f: array of frequencies
+    :param block_size: largest number of frequency x sample terms in one block
+    :return: 2D array of powers, one row per series
+    """
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    power = np.empty((len(lengths), len(f)))
+    rows = max(1, block_size // max(len(t), 1))
+    for start in range(0, len(f), rows):
+        w = 2 * np.pi * f[start:start + rows]
+
+        # Constant offsets (tau), per frequency and series
+        sin_term = np.add.reduceat(np.sin(2 * w[:, np.newaxis] * t), starts, axis=1)
+        cos_term = np.add.reduceat(np.cos(2 * w[:, np.newaxis] * t), starts, axis=1)
+        tau = np.arctan2(sin_term, cos_term) / (2 * w[:, np.newaxis])
+
+        phase_shift = w[:, np.newaxis] * t - np.repeat(w[:, np.newaxis] * tau, lengths, axis=1)
+        cterm = np.cos(phase_shift)
+        sterm = np.sin(phase_shift)
+
+        c_weighted = np.add.reduceat(cterm * h_centered, starts, axis=1)
+        s_weighted = np.add.reduceat(sterm * h_centered, starts, axis=1)
+        c_sum_sq = np.add.reduceat(cterm**2, starts, axis=1)
+        s_sum_sq = np.add.reduceat(sterm**2, starts, axis=1)
+
+        power[:, start:start + rows] = (c_weighted**2 / c_sum_sq + s_weighted**2 / s_sum_sq).T
+    return power
+
+
+def batch_fast_power(t, h_centered, series, n_freq, span):
+    """
+    Unnormalized Lomb periodogram of concatenated series with the fast method of `fast_power`, every series
+    extirpolated onto its own row of one grid and transformed in one FFT call.
+
+    :param t: 1D array of sample times of every series, one after the other
+    :param h_centered: 1D array of data values with the mean of their series removed
+    :param series: index of the series of each sample
+    :param n_freq: number of frequencies
+    :param span: inverse of the frequency step
+    :return: 2D array of powers, one row per series
+    """
+    lengths = np.bincount(series)
+    n_series = len(lengths)
+    ndim = 1 << int(np.ceil(np.log2(4 * n_freq * MACC)))
+    t_min = np.full(n_series, np.inf)
+    np.minimum.at(t_min, series, t)
+    x = (t - t_min[series]) * (ndim / span)
+
+    wk1 = np.conj(np.fft.rfft(extirpolate(x, h_centered, ndim, series, n_series), axis=1))[:, 1:n_freq + 1]
+    wk2 = np.conj(np.fft.rfft(extirpolate(2 * x, np.ones(t.size), ndim, series, n_series), axis=1))[:, 1:n_freq + 1]
+
+    n = lengths[:, np.newaxis]
+    hypo = np.abs(wk2)
+    hc2wt = 0.5 * wk2.real / hypo
+    hs2wt = 0.5 * wk2.imag / hypo
+    cwt = np.sqrt(0.5 + hc2wt)
+    swt = np.copysign(np.sqrt(0.5 - hc2wt), hs2wt)
+
+    den = 0.5 * n + hc2wt * wk2.real + hs2wt * wk2.imag
+    cterm = (cwt * wk1.real + swt * wk1.imag)**2 / den
+    sterm = (cwt * wk1.imag - swt * wk1.real)**2 / (n - den)
+    return cterm + sterm
+
+
+def direct_power(t, h_centered, f, block_size=BLOCK_SIZE):
+    """
+    Unnormalized Lomb periodogram, evaluated exactly with the terms of a block of frequencies at a time so the
+    working set stays below `block_size` elements per matrix whatever the number of frequencies.
+
+    :param t: 1D array of sample times
+    :param h_centered: 1D array of data values with their mean removed
+    :param f: array of frequencies
+    :param block_size: largest number of frequency x sample terms in one block
+    :return: array of sum(h cos)^2 / sum(cos^2) + sum(h sin)^2 / sum(sin^2) at each frequency
+    """
+    power = np.empty(len(f))
+    rows = max(1, block_size // max(len(t), 1))
+    for start in range(0, len(f), rows):
+        # Angular frequencies
+        w = 2 * np.pi * f[start:start + rows]
+
+        # Constant offsets (tau)
+        sin_term = np.sum(np.sin(2 * w[:, np.newaxis] * t), axis=1)
+        cos_term = np.sum(np.cos(2 * w[:, np.newaxis] * t), axis=1)
+        tau = np.arctan2(sin_term, cos_term) / (2 * w)
+
+        # Spectral power terms
+        phase_shift = w[:, np.newaxis] * t - (w * tau)[:, np.newaxis]
+        cterm = np.cos(phase_shift)
+        sterm = np.sin(phase_shift)
+
+        c_weighted = np.sum(cterm * h_centered, axis=1)
+        s_weighted = np.sum(sterm * h_centered, axis=1)
+        c_sum_sq = np.sum(cterm**2, axis=1)
+        s_sum_sq = np.sum(sterm**2, axis=1)
+
+        power[start:start + rows] = c_weighted**2 / c_sum_sq + s_weighted**2 / s_sum_sq
+    return power
+
+
+def fast_power(t, h_centered, n_freq, span):
+    """
+    Unnormalized Lomb periodogram at the frequencies k / span, k = 1..n_freq, approximated as in Press & Rybicki
+    (1989): the data are extirpolated onto a regular grid and the trigonometric sums are read from two FFTs.
+
+    :param t: 1D array of sample times
+    :param h_centered: 1D array of data values with their mean removed
+    :param n_freq: number of frequencies
+    :param span: inverse of the frequency step, i.e. time span * oversampling factor
+    :return: array of sum(h cos)^2 / sum(cos^2) + sum(h sin)^2 / sum(sin^2) at each frequency
+    """
+    n = len(t)
+    # grid large enough that the doubled frequencies of the tau sums are sampled MACC times per quarter cycle
+    ndim = 1 << int(np.ceil(np.log2(4 * n_freq * MACC)))
+    x = (t - np.min(t)) * (ndim / span)
+
+    # numpy's FFT uses exp(-i...), conjugate to get sum(h cos(wt)) + i sum(h sin(wt))
+    wk1 = np.conj(np.fft.rfft(extirpolate(x, h_centered, ndim)))[1:n_freq + 1]
+    wk2 = np.conj(np.fft.rfft(extirpolate(2 * x, np.ones(n), ndim)))[1:n_freq + 1]
+
+    # cos(w tau) and sin(w tau) from the half angle of 2 w tau = atan2(sum sin(2wt), sum cos(2wt))
+    hypo = np.abs(wk2)
+    hc2wt = 0.5 * wk2.real / hypo
+    hs2wt = 0.5 * wk2.imag / hypo
+    cwt = np.sqrt(0.5 + hc2wt)
+    swt = np.copysign(np.sqrt(0.5 - hc2wt), hs2wt)
+
+    # sum(cos^2(w(t - tau))), the sum of the squared sines is n minus it
+    den = 0.5 * n + hc2wt * wk2.real + hs2wt * wk2.imag
+    cterm = (cwt * wk1.real + swt * wk1.imag)**2 / den
+    sterm = (cwt * wk1.imag - swt * wk1.real)**2 / (n - den)
+    return cterm + sterm
+
+
+def extirpolate(x, y, ndim, row=None, n_rows=1):
+    """
+    Spread values at fractional positions onto a periodic grid of `ndim` points, with the Lagrange interpolation
+    weights of the MACC nearest grid points, so sums of smooth functions over the samples can be taken on the grid.
+
+    :param x: positions in grid units
+    :param y: values at each position
+    :param ndim: number of grid points
+    :param row: optional row of each value, to spread several series at once onto a (n_rows, ndim) grid
+    :param n_rows: number of rows when `row` is given
+    :return: array of `ndim` grid values, or 2D array of (n_rows, ndim) grid values when `row` is given
+    """
+    nodes = np.floor(x).astype(int)[:, np.newaxis] + np.arange(1 - MACC // 2, 1 + MACC - MACC // 2)
+    d = x[:, np.newaxis] - nodes
+    weights = np.empty_like(d)
+    for k in range(MACC):
+        others = [m for m in range(MACC) if m != k]
+        weights[:, k] = np.prod(d[:, others], axis=1) / np.prod([k - m for m in others])
+    index = nodes % ndim
+    if row is None:
+        return np.bincount(index.ravel(), (weights * y[:, np.newaxis]).ravel(), minlength=ndim)
+    index += (row * ndim)[:, np.newaxis]
+    grid = np.bincount(index.ravel(), (weights * y[:, np.newaxis]).ravel(), minlength=n_rows * ndim)
+    return grid.reshape(n_rows, ndim)
@@ -1,8 +1,9 @@
 from pathlib import Path
 from datetime import datetime
 
-from python.process_gnss import GNSSProcessor
-from readGPS import readGPS
+import instrument
+from process_gnss import read_config
+from batch import process_files
 
 
 if __name__ == "__main__":
@@ -40,12 +41,14 @@ if __name__ == "__main__":
 
     min_el = input("What should the minimum elevation angle be for processing? (default is 6 degrees): ")
     max_el = input("What should the maximum elevation angle be for processing? (default is 30 degrees): ")
-    gnss_processor = GNSSProcessor(az_range_in)
-
-    for file in files_path:
-        print("Parsing file:", file.name)
-        gnss_data = readGPS(file, True)
-        gnss_processor.process_gnss(gnss_data)
+    min_el = float(min_el) if min_el.strip() else 6
+    max_el = float(max_el) if max_el.strip() else 30
+    config = read_config()
+    workers = config['processing'].getint('workers', fallback=0)
+    profile_report = config['processing'].get('profile_report', fallback='')
+    if profile_report:
+        instrument.enable()
+    gnss_processor = process_files(files_path, az_range_in, min_el, max_el, workers=workers)
 
     choice = ""
     while choice != "3":
@@ -73,6 +76,12 @@ if __name__ == "__main__":
         elif choice == "3":
             gnss_processor.graph_height_time()
         elif choice == "4":
-            exit(0)
+            break
         else:
-            print("Invalid input")
\ No newline at end of file
+            print("Invalid input")
+
+    # written once the menu is left, so the time spent plotting is in the report
+    if profile_report:
+        instrument.write_report(profile_report)
+        print(instrument.summary())
+        print("Profile report written to", profile_report)
\ No newline at end of file
@@ -0,0 +1,380 @@
+"""
+Bytes level NMEA tokenizer for `readGNSS(..., mode='mmap')`.
+
+The log is memory mapped and scanned in chunks that each start on an RMC sentence, the first sentence of a
+block, so a chunk never splits a block and only the block counter and the pending GGA time carry over from one
+chunk to the next. Sentence boundaries, sentence types and fields are found from the positions of newline,
+comma and checksum bytes, and the numbers are decoded with NumPy, so no per line strings are built and the
+working memory is a few times the chunk size rather than a few times the file size.
+"""
+import mmap
+
+import numpy as np
+
+import instrument
+from gnss_systems import SYSTEMS, KEY_STRIDE
+
+CHUNK_SIZE = 1 << 18  # bytes per scanned chunk, grown if a chunk holds no RMC sentence
+SLOTS = 4  # satellites per GSV sentence
+
+
+def _head_code(head):
+    # 6 byte sentence head packed into an integer, e.g. b'$GPGSV'
+    return int.from_bytes(head, 'little')
+
+
+GGA = (_head_code(b'$GNGGA'), _head_code(b'$GPGGA'))
+RMC = (_head_code(b'$GNRMC'), _head_code(b'$GPRMC'))
+RMC_STARTS = (b'\n$GNRMC', b'\n$GPRMC')
+
+
+def line_bounds(buf):
+    """
+    Find the lines of a byte buffer.
+
+    :param buf: 1D uint8 array
+    :return: (starts, ends) index arrays, ends exclusive and excluding any carriage return
+    """
+    newlines = np.flatnonzero(buf == 10)
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.concatenate((newlines, [buf.size]))
+    if starts[-1] == buf.size:  # buffer ends with a newline
+        starts, ends = starts[:-1], ends[:-1]
+    cr = (ends > starts) & (buf[np.maximum(ends - 1, 0)] == 13)
+    ends = ends - cr
+    return starts, ends
+
+
+def head_codes(buf, starts, ends):
+    """
+    Pack the first 6 bytes of every line into an integer, 0 for lines shorter than 6 bytes.
+    """
+    codes = np.zeros(starts.size, dtype=np.uint64)
+    long_enough = (ends - starts) >= 6
+    heads = buf[starts[long_enough, np.newaxis] + np.arange(6)].astype(np.uint64)
+    codes[long_enough] = (heads << (np.arange(6, dtype=np.uint64) * np.uint64(8))).sum(axis=1)
+    return codes
+
+
+def _gather(buf, starts, ends):
+    # (n_fields, width) character codes, with a mask of the positions inside each field
+    width = int((ends - starts).max(initial=0))
+    pos = np.arange(width)
+    inside = pos < (ends - starts)[:, np.newaxis]
+    chars = buf[np.minimum(starts[:, np.newaxis] + pos, buf.size - 1)].astype(np.int64)
+    return chars, inside, pos
+
+
+def is_digits(buf, starts, ends):
+    """
+    True for fields made only of ASCII digits, as `str.isdigit` on the field text.
+    """
+    chars, inside, _ = _gather(buf, starts, ends)
+    digit = (chars >= 48) & (chars <= 57)
+    return (ends > starts) & (digit | ~inside).all(axis=1)
+
+
+def parse_decimal(buf, starts, ends):
+    """
+    Decode ASCII decimal fields such as '07', '-3' or '020930.00'.
+
+    :param buf: 1D uint8 array
+    :param starts: field start indices
+    :param ends: field end indices (exclusive)
+    :return: float array, NaN for empty or malformed fields
+    """
+    values = np.full(starts.size, np.nan)
+    lengths = ends - starts
+    if lengths.max(initial=0) <= 0:
+        return values
+
+    chars, inside, pos = _gather(buf, starts, ends)
+    digit = inside & (chars >= 48) & (chars <= 57)
+    dot = inside & (chars == 46)
+    minus = inside & (chars == 45) & (pos == 0)
+    ok = ((digit | dot | minus) == inside).all(axis=1) & (dot.sum(axis=1) <= 1) & digit.any(axis=1)
+
+    # integer mantissa then one exact division, which rounds the same way as float()
+    right = np.cumsum(digit[:, ::-1], axis=1)[:, ::-1] - digit  # digits to the right of each position
+    mantissa = np.where(digit, (chars - 48) * 10 ** np.minimum(right, 18), 0).sum(axis=1)
+    dot_pos = np.where(dot.any(axis=1), dot.argmax(axis=1), lengths)
+    n_frac = np.maximum(lengths - dot_pos - 1, 0)
+    result = mantissa / 10.0 ** n_frac
+    if minus.size:
+        result[minus[:, 0]] *= -1
+    values[ok] = result[ok]
+    return values
+
+
+def parse_hex(buf, starts, ends):
+    """
+    Decode ASCII hexadecimal fields such as '1' or '7A', as int(field, 16).
+
+    :param buf: 1D uint8 array
+    :param starts: field start indices
+    :param ends: field end indices (exclusive)
+    :return: int array, -1 for empty or malformed fields
+    """
+    values = np.full(starts.size, -1)
+    if ends.size == 0 or (ends - starts).max() <= 0:
+        return values
+    chars, inside, _ = _gather(buf, starts, ends)
+    upper = chars & ~32  # 'a'-'f' to 'A'-'F'
+    digit = np.where((chars >= 48) & (chars <= 57), chars - 48, np.where((upper >= 65) & (upper <= 70), upper - 55, -1))
+    ok = (ends > starts) & ((digit >= 0) | ~inside).all(axis=1)
+    result = np.where(inside, digit, 0)
+    for k in range(1, result.shape[1]):
+        result[:, k] += result[:, k - 1] * np.where(inside[:, k], 16, 1)
+    values[ok] = result[ok, -1]
+    return values
+
+
+class Fields:
+    """
+    Comma separated fields of the lines of a byte buffer, located from the comma and checksum byte positions.
+    """
+
+    def __init__(self, buf, starts, ends):
+        self.ends = ends
+        self.commas = np.append(np.flatnonzero(buf == 44), buf.size)
+        self.first_comma = np.searchsorted(self.commas, starts)
+        self.n_commas = np.searchsorted(self.commas, ends) - self.first_comma
+        stars = np.append(np.flatnonzero(buf == 42), buf.size)
+        self.stars = np.minimum(stars[np.searchsorted(stars, starts)], ends)  # checksum start, or line end
+
+    def __call__(self, lines, j):
+        """
+        :return: start and end of field j (0 is the sentence head) of the given lines, checksum excluded
+        """
+        commas, first_comma, n_commas = self.commas, self.first_comma, self.n_commas
+        last = commas.size - 1
+        field_starts = commas[np.minimum(first_comma[lines] + j - 1, last)] + 1
+        field_ends = np.where(j < n_commas[lines], commas[np.minimum(first_comma[lines] + j, last)], self.ends[lines])
+        field_ends = np.minimum(field_ends, self.stars[lines])
+        return field_starts, np.maximum(field_ends, field_starts)
+
+
+def checksums_ok(buf, starts, ends, stars):
+    """
+    Validate the NMEA checksums of lines: the two hexadecimal digits after '*' must be the XOR of every byte between
+    the leading '$' and the '*'.
+
+    :param buf: 1D uint8 array
+    :param starts: line start indices
+    :param ends: line end indices (exclusive)
+    :param stars: index of the '*' of each line, or its end when there is none
+    :return: bool array, False for lines without a checksum
+    """
+    prefix = np.concatenate(([0], np.bitwise_xor.accumulate(buf)))  # xor of bytes [a, b) is prefix[a] ^ prefix[b]
+    body_start = np.minimum(starts + (buf[np.minimum(starts, buf.size - 1)] == 36), stars)  # skip the '$'
+    computed = prefix[body_start] ^ prefix[stars]
+    given = parse_hex(buf, np.minimum(stars + 1, ends), np.minimum(stars + 3, ends))
+    return (stars < ends) & (ends - stars == 3) & (given == computed)
+
+
+def _scan_chunk(buf, state, systems, decode=True, validate=True):
+    """
+    Tokenize one chunk starting on a block boundary.
+
+    :param buf: 1D uint8 view of the chunk
+    :param state: dict with 'block_count' and 'pending' (hour, minute, second of a GGA not yet closed by an
+                  RMC), updated for the next chunk
+    :param systems: talker ids of the GSV sentences to read
+    :param decode: if False only the satellite key column is decoded, and the checksum errors are not counted
+    :param validate: if True, the observations of GSV sentences with a missing or wrong checksum are skipped
+    :return: (observation columns in file order, block rows of hour, minute, second, date)
+    """
+    starts, ends = line_bounds(buf)
+    codes = head_codes(buf, starts, ends)
+    n_lines = starts.size
+    line_no = np.arange(n_lines)
+
+    is_gga = np.isin(codes, GGA)
+    is_rmc = np.isin(codes, RMC)
+
+    field = Fields(buf, starts, ends)
+    n_commas = field.n_commas
+    line_stars = field.stars
+
+    # --- GGA time, the time of the block being filled --- #
+    gga_lines = np.flatnonzero(is_gga & (n_commas >= 1))
+    gga_time = parse_decimal(buf, *field(gga_lines, 1))
+    hour = np.floor(gga_time / 10000)
+    minute = np.floor((gga_time - hour * 10000) / 100)
+    second = np.round(gga_time - np.floor(gga_time / 100) * 100)
+
+    last_gga = np.full(n_lines, -1)
+    last_gga[gga_lines] = np.arange(gga_lines.size)
+    last_gga = np.maximum.accumulate(last_gga)  # latest GGA at or before each line, as an index into gga_lines
+    last_gga_line = np.where(last_gga >= 0, np.append(gga_lines, -1)[last_gga], -1)
+    last_rmc_line = np.maximum.accumulate(np.where(is_rmc, line_no, -1))
+    prev_rmc_line = np.concatenate(([-1], last_rmc_line[:-1]))
+
+    # --- RMC date, closing a block --- #
+    rmc_lines = np.flatnonzero(is_rmc)
+    stamp = np.nan_to_num(parse_decimal(buf, *field(rmc_lines, 9))).astype(int)
+    date = (2000 + stamp % 100) * 10000 + (stamp // 100 % 100) * 100 + stamp // 10000
+    block_hms = np.zeros((rmc_lines.size, 3), dtype=int)
+    own_gga = last_gga_line[rmc_lines] > prev_rmc_line[rmc_lines]
+    k = last_gga[rmc_lines][own_gga]
+    block_hms[own_gga] = np.column_stack((hour[k], minute[k], second[k]))
+    block_hms[~own_gga & (prev_rmc_line[rmc_lines] < 0)] = state['pending']
+    blocks = np.column_stack((block_hms, date))
+
+    block_index = state['block_count'] + np.cumsum(is_rmc) - is_rmc  # RMC sentences before each line
+    if n_lines and last_gga_line[-1] > last_rmc_line[-1]:
+        k = last_gga[-1]
+        state['pending'] = (int(hour[k]), int(minute[k]), int(second[k]))
+    elif rmc_lines.size:
+        state['pending'] = (0, 0, 0)
+    state['block_count'] += rmc_lines.size
+
+    # --- GSV groups --- #
+    system = np.full(n_lines, -1)
+    for index, talker in enumerate(systems):
+        system[codes == _head_code(('$' + talker + 'GSV').encode())] = index
+    gsv = np.flatnonzero((system >= 0) & (n_commas >= 3))
+    system = system[gsv]
+    signal, prn_min, prn_max = (np.array([SYSTEMS[talker][i] for talker in systems])[system] for i in (1, 3, 4))
+    total = parse_decimal(buf, *field(gsv, 1))
+    number = parse_decimal(buf, *field(gsv, 2))
+    new_block = last_gga_line[gsv] > last_rmc_line[gsv]
+
+    # a sentence continues the sequence of the line right before it while that one is of the same system and
+    # expects more messages, and is read if the sequence has had a first message so far
+    follows = np.zeros(gsv.size, dtype=bool)
+    follows[1:] = (gsv[1:] == gsv[:-1] + 1) & (system[1:] == system[:-1]) & (number[:-1] < total[:-1])
+    chain_start = np.maximum.accumulate(np.where(follows, 0, np.arange(gsv.size)))
+    firsts = np.cumsum(number == 1)
+    before_chain = np.where(chain_start > 0, firsts[chain_start - 1], 0)
+    accepted = new_block & (firsts - before_chain > 0)
+
+    # only the tracked signal is read when the sentence ends with a signal id
+    with_signal = (n_commas[gsv] - 3) % SLOTS == 1
+    signal_starts, signal_ends = field(gsv, n_commas[gsv])
+    tracked = ~with_signal | (signal_ends == signal_starts) | \
+        (parse_decimal(buf, signal_starts, signal_ends) == signal)
+
+    # a short sentence (checksum in a PRN field) ends its group, later messages of the group are ignored
+    continued = np.zeros(gsv.size, dtype=bool)
+    continued[1:] = follows[1:] & accepted[:-1]
+    group = np.cumsum(accepted & ~continued)
+    short = (n_commas[gsv] % SLOTS == 0) & (n_commas[gsv] <= 4 * SLOTS) & (line_stars[gsv] < ends[gsv]) & tracked
+    shorts_before = np.cumsum(short) - short
+    group_first = np.searchsorted(group, group)
+    read = accepted & tracked & (shorts_before == shorts_before[group_first])
+    gsv, system, prn_min, prn_max = gsv[read], system[read], prn_min[read], prn_max[read]
+
+    # a sentence failing its checksum keeps its place in its group, only its observations are dropped
+    checksum_ok = checksums_ok(buf, starts[gsv], ends[gsv], line_stars[gsv])
+    if decode:
+        instrument.count('checksum_errors', int(np.count_nonzero(~checksum_ok)))
+    if validate:
+        gsv, system, prn_min, prn_max = (values[checksum_ok] for values in (gsv, system, prn_min, prn_max))
+
+    # --- satellite quadruples --- #
+    names = ('order', 'key', 'count', 'el', 'az', 'snr', 'utc') if decode else ('order', 'key')
+    parts = {name: [] for name in names}
+    for slot in range(SLOTS):
+        j = 4 + 4 * slot
+        present = n_commas[gsv] >= j + 3
+        lines = gsv[present]
+        prn_starts, prn_ends = field(lines, j)
+        prn = parse_decimal(buf, prn_starts, prn_ends)
+        keep = is_digits(buf, prn_starts, prn_ends) & (prn >= prn_min[present]) & (prn <= prn_max[present])
+        lines = lines[keep]
+        parts['order'].append(lines * SLOTS + slot)
+        parts['key'].append(system[present][keep] * KEY_STRIDE + prn[keep].astype(int))
+        if not decode:
+            continue
+        parts['count'].append(block_index[lines])
+        parts['el'].append(parse_decimal(buf, *field(lines, j + 1)))
+        parts['az'].append(parse_decimal(buf, *field(lines, j + 2)))
+        parts['snr'].append(parse_decimal(buf, *field(lines, j + 3)))
+        parts['utc'].append(gga_time[last_gga[lines]])
+
+    # slots were decoded one at a time, put them back in file order
+    order = np.argsort(np.concatenate(parts.pop('order')), kind='stable')
+    columns = {name: np.concatenate(values)[order] for name, values in parts.items()}
+    return columns, blocks
+
+
+def _chunks(mm, size, chunk_size):
+    # (start, end) of successive chunks, each cut just before the last RMC sentence of its window
+    lo = 0
+    while lo < size:
+        hi = lo + chunk_size
+        cut = size
+        while hi < size:
+            cut = max(mm.rfind(head, lo, hi) for head in RMC_STARTS) + 1
+            if cut > lo:
+                break
+            hi = lo + 2 * (hi - lo)
+            cut = size
+        yield lo, cut
+        lo = cut
+
+
+def read_observations(Filename, dtype, systems, chunk_size=CHUNK_SIZE, validate=True):
+    """
+    Memory map a log and tokenize its GSV observations straight into per satellite arrays.
+
+    The file is scanned twice: the first pass only counts the observations of each satellite, so the output
+    table can be allocated once and every chunk of the second pass written into its final rows. Peak memory is
+    the output plus the working set of one chunk.
+
+    :param Filename: path to the .LOG file
+    :param dtype: structured dtype of the output with 'count', 'el', 'az', 'snr' and 'utc' fields
+    :param systems: talker ids of the constellations to read
+    :param chunk_size: bytes scanned at a time
+    :param validate: if True, the observations of GSV sentences with a missing or wrong checksum are skipped
+    :return: (tracks, keys, blocks) where tracks is a list of structured arrays in file order, one per observed
+             satellite, keys the sorted satellite keys (see gnss_systems) and blocks an (n_blocks + 1, 4) array
+             of hour, minute, second, date
+    """
+    n_keys = len(systems) * KEY_STRIDE
+    counts = np.zeros(n_keys, dtype=int)
+    block_parts = []
+    table = np.zeros(0, dtype=dtype)
+
+    with open(Filename, 'rb') as fid:
+        size = fid.seek(0, 2)
+        if size:
+            with mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if instrument.enabled():
+                    lines = sum(mm[lo:lo + chunk_size].count(b'\n') for lo in range(0, size, chunk_size))
+                    instrument.count('lines', int(lines) + (mm[size - 1:size] != b'\n'))
+
+                # each chunk is copied out of the map rather than viewed, so no array keeps the map open if a scan
+                # fails and it is always closed, and the log file unlocked, on leaving this block
+                state = {'block_count': 0, 'pending': (0, 0, 0)}
+                for lo, hi in _chunks(mm, size, chunk_size):
+                    columns, blocks = _scan_chunk(np.frombuffer(mm[lo:hi], dtype=np.uint8), state, systems,
+                                                  decode=False, validate=validate)
+                    counts += np.bincount(columns['key'], minlength=n_keys)
+                    block_parts.append(blocks)
+                block_parts.append(np.array([state['pending'] + (0,)], dtype=int))
+
+                bounds = np.concatenate(([0], np.cumsum(counts)))
+                table = np.zeros(bounds[-1], dtype=dtype)
+                cursor = bounds[:-1].copy()  # next free row of each satellite
+
+                state = {'block_count': 0, 'pending': (0, 0, 0)}
+                for lo, hi in _chunks(mm, size, chunk_size):
+                    columns, _ = _scan_chunk(np.frombuffer(mm[lo:hi], dtype=np.uint8), state, systems,
+                                             validate=validate)
+                    key = columns.pop('key')
+                    order = np.argsort(key, kind='stable')
+                    chunk_counts = np.bincount(key, minlength=n_keys)
+                    rank = np.empty(key.size, dtype=int)
+                    rank[order] = np.arange(key.size) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+                    rows = cursor[key] + rank
+                    for name, values in columns.items():
+                        table[name][rows] = values
+                    cursor += chunk_counts
+
+    keys = np.flatnonzero(counts)
+    starts = np.concatenate(([0], np.cumsum(counts)))[keys]
+    tracks = [table[start:start + counts[key]] for start, key in zip(starts, keys)]
+    blocks = np.concatenate(block_parts) if block_parts else np.zeros((1, 4), dtype=int)
+    return tracks, keys, blocks
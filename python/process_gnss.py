@@ -1,203 +1,652 @@
 import configparser
 import datetime
-from collections import defaultdict
+from itertools import repeat
+from pathlib import Path
 
 import numpy as np
-from scipy.signal import lfilter
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 
-from utils import smooth, get_ofac_hifac, peak2noise, gps_to_nz
-from lombscargle import lomb
-config = configparser.ConfigParser()
-config.read('config.ini')
+import instrument
+from utils import smooth, get_ofac_hifac, peak2noise, noise_level, gps_to_datetime64, epoch_seconds
+from lombscargle import lomb, lomb_peaks, lomb_batch, frequency_grid
+from gnss_systems import wavelengths, satellite_dt
+from results import ResultsStore
+from arcs import split_tracks
+
+# matplotlib is imported by the graph methods, so that parsing and retrieving heights does not pay for its import
+
+# configuration used when GNSSProcessor is not given one, next to this file whatever the working directory
+CONFIG_PATH = Path(__file__).resolve().parent / 'config.ini'
+
+
+def read_config(path=CONFIG_PATH):
+    """
+    Read a configuration file laid out as config.ini.
+
+    :param path: file path, config.ini of the python folder by default
+    :return: ConfigParser
+    """
+    parser = configparser.ConfigParser()
+    if not parser.read(path):
+        raise ValueError("Cannot read the config file {}".format(path))
+    return parser
+
+
+# per retrieval lists of GNSSProcessor, kept for compatibility with the results store
+RESULT_FIELDS = ('reflector_heights', 'peak_amplitudes', 'azimuths', 'datetime_list', 'freq_list', 'power_list',
+                 'peak_noise', 'elevations', 'tracks', 'satellites')
+
+# GNSSProcessor attributes used to process a single track
+TRACK_PARAMS = ('pvf', 'min_rh', 'min_points', 'max_az_diff', 'max_height', 'desired_precision', 'pcrit', 'emin',
+                'emax', 'ediff', 'snr_thresh', 'av_time', 'azimuth_bins', 'lomb_method', 'prefilter',
+                'peak_search')
+
+# smallest peak amplitude of a retrieval, and the reflector heights outside of which the noise level is taken
+MIN_AMP = 18
+NOISE_RANGE = (6, 2)
+# prefilter modes: 'off', 'on' skips the periodogram of tracks `prefilter` rejects, 'verify' computes it anyway and
+# reports any retrieval the prefilter would have lost
+PREFILTER_MODES = ('off', 'on', 'verify')
+# relative headroom of the prefilter thresholds, well above the error of the fast periodogram
+PREFILTER_MARGIN = 1e-2
+# peak search of the periodogram: 'full' evaluates the whole reflector height grid, 'coarse' a coarse grid refined
+# around its highest peaks (see lombscargle.lomb_peaks)
+PEAK_SEARCHES = ('full', 'coarse')
+
+
+def sampling_interval(group):
+    """
+    Median positive difference between consecutive sample times, in seconds.
+
+    Samples with a date (readers run with interp=True) are timed from their date and utc (seconds of day) as epoch
+    seconds. Otherwise each value in `group['utc']` is treated as an HHMMSS float (e.g. 123519.0) and converted to
+    seconds since midnight. Returns None if an interval cannot be computed.
+    """
+    try:
+        utc = np.asarray(group['utc'], dtype=float)
+    except Exception:
+        return None
+
+    dated = group['date'] > 0 if 'date' in group.dtype.names else np.zeros(utc.shape, dtype=bool)
+    if dated.any():
+        secs = epoch_seconds(group['date'][dated], utc[dated])
+        secs = secs[~np.isnan(secs)]
+    else:
+        utc = utc[~np.isnan(utc)]
+        ints = utc.astype(int)
+        secs = (ints // 10000) * 3600 + ((ints % 10000) // 100) * 60 + (ints % 100)
+    if secs.size < 2:
+        return None
+
+    diffs = np.diff(secs)
+    diffs = diffs[diffs > 0]
+    if diffs.size == 0:
+        return None
+
+    return float(np.median(diffs))
+
+
+def window_samples(group, params):
+    """
+    Samples of a satellite track inside the elevation window and one of the azimuth bins.
+
+    :param group: structured array of one satellite, as returned by `readGPS` / `readGNSS`
+    :param params: processing parameters, only emin, emax and azimuth_bins are used
+    :return: indices of the samples in `group`
+    """
+    elevation = group['el']
+    azimuth = group['az']
+    snr = group['snr']
+
+    i = np.where(
+        (elevation > params['emin']) & (elevation < params['emax']) & (~np.isnan(snr)) & (~np.isnan(elevation)) & (
+            ~np.isnan(azimuth)))[0]
+
+    # create azimuth mask
+    mask = np.zeros(i.shape, dtype=bool)
+    for min_v, max_v in params['azimuth_bins']:
+        current_range_mask = (azimuth[i] > min_v) & (azimuth[i] < max_v)
+        mask = np.logical_or(mask, current_range_mask)
+    return i[mask]
+
+
+def window_gate(group, i, params):
+    """
+    Quality gates on the samples of `window_samples`, checked before detrending.
+
+    :return: name of the first gate failed, or None
+    """
+    if len(i) <= params['min_points']:
+        return 'min_points'
+    if not np.max(group['el'][i]) - np.min(group['el'][i]) > params['ediff']:
+        return 'ediff'
+    if not np.max(group['az'][i]) - np.min(group['az'][i]) < params['max_az_diff']:
+        return 'max_az_diff'
+    return None
+
+
+def detrend_samples(group, i, params, snr_linear=None):
+    """
+    Smooth the SNR of the samples of `window_samples` and remove the direct signal.
+
+    :param group: structured array of one satellite
+    :param i: indices of the samples, as returned by `window_samples`
+    :param params: processing parameters, only av_time, snr_thresh and pvf are used
+    :param snr_linear: optional linear SNR of every sample of `group`, 10**(snr/20), to share it between calls
+    :return: detrended track, see `detrend_track`, or None if the track is rejected
+    """
+    elevation = group['el']
+    azimuth = group['az']
+    snr = group['snr']
+
+    # moving average over av_time, at the sampling interval of this track
+    interval = sampling_interval(group)
+    if interval is None:
+        instrument.count('rejected.sampling_interval')
+        return None
+    coeff_ma = np.ones((1, int(params['av_time'] / interval))) * interval / params['av_time']
+
+    snr_subset = snr[i]
+    # causal moving average, the first output samples averaging fewer samples, as scipy.signal.lfilter(b, 1, x)
+    snr_filter = np.convolve(snr_subset, coeff_ma[0])[:snr_subset.size]
+    snr_index = np.where(snr_filter > params['snr_thresh'])[0]
+    if snr_index.size == 0:
+        instrument.count('rejected.snr_thresh')
+        return None
+    elevation_angles = elevation[i][snr_index]
+    track_indices = i[snr_index]
+
+    # convert from dB to linear
+    if snr_linear is None:
+        snr_db = 10**(snr_subset[snr_index] / 20)
+    else:
+        snr_db = snr_linear[track_indices]
+
+    # Detrend the data
+    p = np.polyfit(elevation_angles, snr_db, params['pvf'])
+    pv = np.polyval(p, elevation_angles)
+
+    smooth_data = smooth(snr_db-pv).conj().T
+
+    save_snr_idx = round(len(coeff_ma)/2)
+    if len(smooth_data) <= save_snr_idx:
+        return None
+    save_snr = smooth_data[save_snr_idx:]
+    # fft is done on the sine of the elevation angles
+    aligned_elev = elevation_angles[save_snr_idx:]
+    trim_len = min(len(save_snr), len(aligned_elev))
+    if trim_len == 0:
+        return None
+    save_snr = save_snr[:trim_len]
+    aligned_elev = aligned_elev[:trim_len]
+    elev_angels = np.radians(aligned_elev) # convert to radians as np does not have sind function
+    sine_e = np.sin(elev_angels)
+
+    # sort the data so all tracks are rising
+    sorted_x, j = np.unique(sine_e.conj().T, return_index=True)
+
+    sorted_y = save_snr[j]
+    sorted_x = sorted_x[1:-1]
+    sorted_y = sorted_y[1:-1]
+
+    return {
+        'x': sorted_x,
+        'y': sorted_y,
+        'elevation_angles': elevation_angles,
+        # the sample reported for a retrieval is picked by the index of the spectrum peak in this order
+        'order': track_indices[j],
+        'track': {'az': np.array(azimuth[track_indices], copy=True),
+                  'el': np.array(elevation[track_indices], copy=True)},
+    }
+
+
+def detrend_track(group, params):
+    """
+    Select the samples of one satellite track inside the elevation and azimuth windows, smooth the SNR and remove the
+    direct signal.
+
+    :param group: structured array of one satellite, as returned by `readGPS` / `readGNSS`
+    :param params: processing parameters, see GNSSProcessor.track_params
+    :return: dict with the detrended SNR `y` against the sorted sine of the elevation `x`, or None if the track is
+             rejected
+    """
+    if group.size == 0:
+        return None
+    i = window_samples(group, params)
+    gate = window_gate(group, i, params)
+    if gate is not None:
+        instrument.count('rejected.' + gate)
+        return None
+    return detrend_samples(group, i, params)
+
+
+def track_spectrum(track, cf, params):
+    """
+    Lomb-Scargle periodogram of a detrended track and its peak.
+
+    :param track: detrended track returned by `detrend_track`
+    :param cf: carrier wavelength of the satellite in meters
+    :param params: processing parameters, only max_height, desired_precision, lomb_method and peak_search are used
+    :return: dict of the 'freq' and 'power' of the spectrum, the 'reflector_height', 'peak_amplitude' and
+             'peak_noise' of its peak and the 'peak_index' of the peak in the full reflector height grid
+    """
+    ofac, hifac = get_ofac_hifac(track['elevation_angles'], cf/2, params['max_height'], params['desired_precision'])
+    if params['peak_search'] == 'coarse':
+        with instrument.stage('lomb'):
+            grid, power, grid_index = lomb_peaks(track['x'] / (cf/2), track['y'], ofac, hifac,
+                                                 method=params['lomb_method'])
+        freq = grid[grid_index]
+        with instrument.stage('peak2noise'):
+            peak = int(np.argmax(power))
+            maxRh, maxAmp = float(freq[peak]), float(power[peak])
+            # noise level of the spectrum interpolated back onto the full grid
+            pknoise = maxAmp / noise_level(grid, np.interp(np.arange(len(grid)), grid_index, power), NOISE_RANGE)
+    elif params['peak_search'] == 'full':
+        with instrument.stage('lomb'):
+            freq, power, prob, conf95 = lomb(track['x'] / (cf/2), track['y'], ofac, hifac,
+                                             method=params['lomb_method'])
+        grid_index = np.arange(len(freq))
+        with instrument.stage('peak2noise'):
+            maxRh, maxAmp, pknoise = peak2noise(freq, power, NOISE_RANGE)
+    else:
+        raise ValueError("Unknown peak search {!r}, expected one of {}".format(params['peak_search'], PEAK_SEARCHES))
+    return {
+        'freq': freq,
+        'power': power,
+        'reflector_height': maxRh,
+        'peak_amplitude': maxAmp,
+        'peak_noise': pknoise,
+        'peak_index': grid_index[np.argmax(power)],
+    }
+
+
+def height_gate(track, spectrum, params):
+    """
+    Quality gates of a retrieval, checked on the peak of its spectrum.
+
+    :param track: detrended track returned by `detrend_track`
+    :param spectrum: spectrum of the track returned by `track_spectrum`
+    :param params: processing parameters, only min_rh, pcrit and ediff are used
+    :return: name of the first gate failed, or None
+    """
+    elevation_angles = track['elevation_angles']
+    if not spectrum['peak_amplitude'] > MIN_AMP:
+        return 'min_amp'
+    if not spectrum['reflector_height'] > params['min_rh']:
+        return 'min_rh'
+    if not spectrum['peak_noise'] > params['pcrit']:
+        return 'pcrit'
+    if not (np.max(elevation_angles) - np.min(elevation_angles)) > params['ediff']:
+        return 'ediff'
+    return None
+
+
+def retrieval(group, track, spectrum):
+    """
+    Retrieval of a track passing `height_gate`, reported at the sample of the spectrum peak.
+
+    :return: dict of the retrieval
+    """
+    idx = track['order'][spectrum['peak_index']]
+    return {
+        'reflector_height': spectrum['reflector_height'],
+        'peak_amplitude': spectrum['peak_amplitude'],
+        'azimuth': group['az'][idx],
+        'elevation': group['el'][idx],
+        'time': gps_to_datetime64(group['date'][idx], group['utc'][idx])[()],  # wall clock datetime64, no time zone
+        'peak_noise': spectrum['peak_noise'],
+        'freq': spectrum['freq'],
+        'power': spectrum['power'],
+        'track': track['track'],
+    }
+
+
+def retrieve_height(group, track, cf, params):
+    """
+    Compute the Lomb-Scargle periodogram of a detrended track and keep its peak as a reflector height retrieval if it
+    passes the quality gates.
+
+    :param group: structured array of the satellite, as passed to `detrend_track`
+    :param track: detrended track returned by `detrend_track`
+    :param cf: carrier wavelength of the satellite in meters
+    :param params: processing parameters, see GNSSProcessor.track_params
+    :return: dict of the retrieval, or None if it is rejected
+    """
+    spectrum = track_spectrum(track, cf, params)
+    # quality gates, a rejection is counted against the first gate failed
+    gate = height_gate(track, spectrum, params)
+    if gate is not None:
+        instrument.count('rejected.' + gate)
+        return None
+    instrument.count('retrievals')
+    return retrieval(group, track, spectrum)
+
+
+def screen_peak(track, cf, params):
+    """
+    Peak of the fast periodogram of a detrended track, which `prefilter` screens the tracks with.
+
+    :return: (peak amplitude, peak to noise ratio)
+    """
+    with instrument.stage('prefilter'):
+        ofac, hifac = get_ofac_hifac(track['elevation_angles'], cf/2, params['max_height'],
+                                     params['desired_precision'])
+        freq, power, prob, conf95 = lomb(track['x'] / (cf/2), track['y'], ofac, hifac, method='fast')
+        maxRh, maxAmp, pknoise = peak2noise(freq, power, NOISE_RANGE)
+    return maxAmp, pknoise
+
+
+def prefilter(track, cf, params, screen=None):
+    """
+    Screen a detrended track before its periodogram, returning the quality gate of `retrieve_height` it is predicted
+    to fail. The first two gates are exact:
+
+        - the elevation span of the track must exceed ediff,
+        - the Lomb amplitude is at most sqrt(2) times the standard deviation of the detrended SNR at every frequency
+          (the cosine and sine terms are projections on orthogonal directions, so their squares sum to at most the
+          variance times the number of samples), so tracks below MIN_AMP / sqrt(2) can not pass the amplitude gate.
+
+    With the direct periodogram, the track is then screened with the fast one on the same grid, which is a few hundred
+    times cheaper, and rejected if its peak amplitude or peak to noise ratio falls short of the gates by more than
+    PREFILTER_MARGIN.
+
+    :param track: detrended track returned by `detrend_track`
+    :param cf: carrier wavelength of the satellite in meters
+    :param params: processing parameters, see GNSSProcessor.track_params
+    :param screen: function of (track, cf, params) returning the peak of the fast periodogram, `screen_peak` if None
+    :return: name of the gate the track is predicted to fail, or None if it needs the full periodogram
+    """
+    elevation_angles = track['elevation_angles']
+    if not np.max(elevation_angles) - np.min(elevation_angles) > params['ediff']:
+        return 'ediff'
+    if track['y'].size == 0:
+        return None
+    if not np.sqrt(2 * np.var(track['y'])) * (1 + PREFILTER_MARGIN) > MIN_AMP:
+        return 'min_amp'
+    if params['lomb_method'] != 'direct':
+        return None
+
+    maxAmp, pknoise = (screen or screen_peak)(track, cf, params)
+    if not maxAmp * (1 + PREFILTER_MARGIN) > MIN_AMP:
+        return 'screen.min_amp'
+    if not pknoise * (1 + PREFILTER_MARGIN) > params['pcrit']:
+        return 'screen.pcrit'
+    return None
+
+
+def process_track(group, cf, params):
+    """
+    Process one satellite track into a reflector height retrieval. Only depends on its arguments, so tracks can be
+    processed in any order, in a thread or in a process pool.
+
+    :param group: structured array of one satellite, as returned by `readGPS` / `readGNSS`
+    :param cf: carrier wavelength of the satellite in meters
+    :param params: processing parameters, see GNSSProcessor.track_params
+    :return: dict of the retrieval, or None if the track gives no retrieval
+    """
+    instrument.count('tracks')
+    with instrument.stage('detrend'):
+        track = detrend_track(group, params)
+    if track is None:
+        return None
+
+    mode = params['prefilter']
+    if mode not in PREFILTER_MODES:
+        raise ValueError("Unknown prefilter mode {!r}, expected one of {}".format(mode, PREFILTER_MODES))
+    gate = prefilter(track, cf, params) if mode != 'off' else None
+    if gate is None:
+        return retrieve_height(group, track, cf, params)
+    instrument.count('pruned.' + gate)
+    if mode == 'on':
+        return None
+
+    # verify: the periodogram is computed anyway, a retrieval here is one the prefilter would have lost
+    result = retrieve_height(group, track, cf, params)
+    if result is not None:
+        instrument.count('pruned.missed')
+        print("Warning: the {} prefilter rejected a track giving a reflector height of {:.3f} m".format(
+            gate, result['reflector_height']))
+    return result
+
 
 class GNSSProcessor:
-    def __init__(self, azimuth_bins, min_el=6, max_el=30):
-        self.reflector_heights = []
-        self.peak_amplitudes = []
-        self.azimuths = []
-        self.datetime_list = []
-        self.freq_list = []
-        self.power_list = []
-        self.peak_noise = []
-        self.elevations = []  # store elevation at detection
-        self.tracks = []  # cache az/el samples for each valid retrieval
-
-        self.pvf = config['gnssr_parameters'].getint('pvf') # polynomial order used to remove the direct signal.`
-        self.min_rh = config['gnssr_parameters'].getfloat('min_rh') # meters
-        self.min_points = config['gnssr_parameters'].getint('min_points')
-        self.max_az_diff = config['gnssr_parameters'].getint('max_az_diff')
-        self.max_height = config['gnssr_parameters'].getint('max_height')
+    def __init__(self, azimuth_bins, min_el=6, max_el=30, config_path=None):
+        """
+        :param azimuth_bins: list of (min, max) azimuth ranges in degrees
+        :param min_el: minimum elevation angle in degrees
+        :param max_el: maximum elevation angle in degrees
+        :param config_path: configuration file laid out as config.ini, CONFIG_PATH if None
+        """
+        self.config = read_config(CONFIG_PATH if config_path is None else config_path)
+        self.config_path = config_path
+        # retrievals, with what the retention policy keeps of their spectra and az/el tracks
+        spill_directory = self.config.get('processing', 'spill_directory', fallback='')
+        self.store = ResultsStore(self.config.get('processing', 'retention', fallback='full'),
+                                  self.config.getint('processing', 'retained_points', fallback=64),
+                                  self.config.getfloat('processing', 'recent_days', fallback=0),
+                                  Path(__file__).resolve().parent / spill_directory if spill_directory else None)
+
+        self.pvf = self.config['gnssr_parameters'].getint('pvf') # polynomial order used to remove the direct signal.`
+        self.min_rh = self.config['gnssr_parameters'].getfloat('min_rh') # meters
+        self.min_points = self.config['gnssr_parameters'].getint('min_points')
+        self.max_az_diff = self.config['gnssr_parameters'].getint('max_az_diff')
+        self.max_height = self.config['gnssr_parameters'].getint('max_height')
         self.desired_precision = 0.005
-        self.pcrit = config['gnssr_parameters'].getfloat('pcrit')
+        self.pcrit = self.config['gnssr_parameters'].getfloat('pcrit')
         self.emin = min_el
         self.emax = max_el
-        self.ediff = config['gnssr_parameters'].getint('ediff')
-        self.cf = 0.1902936 # only supporting L1 for now
-        self.snr_thresh = config['gnssr_parameters'].getint('snr_thresh')
+        self.ediff = self.config['gnssr_parameters'].getint('ediff')
+        self.cf = 0.1902936 # GPS L1 wavelength, used when no satellite table is given to process_gnss
+        self.snr_thresh = self.config['gnssr_parameters'].getint('snr_thresh')
         self.sampling_interval = 5
-        self.av_time = config['gnssr_parameters'].getint('av_time')
+        self.av_time = self.config['gnssr_parameters'].getint('av_time')
         self.coeff_ma = np.ones((1, int(self.av_time/self.sampling_interval))) * self.sampling_interval/self.av_time
+        self.lomb_method = self.config.get('processing', 'lomb_method', fallback='direct') # see lombscargle.lomb
+        self.segment_arcs = self.config.getboolean('processing', 'segment_arcs', fallback=False) # see arcs.split_arcs
+        self.prefilter = self.config.get('processing', 'prefilter', fallback='on') # see PREFILTER_MODES
+        self.peak_search = self.config.get('processing', 'peak_search', fallback='full') # see PEAK_SEARCHES
 
         self.azimuth_bins = azimuth_bins
 
-    def get_sampling_interval_from_group(self, group):
+    # per retrieval lists, built from the results store
+    reflector_heights = property(lambda self: self.store['reflector_height'].tolist())
+    peak_amplitudes = property(lambda self: self.store['peak_amplitude'].tolist())
+    azimuths = property(lambda self: self.store['azimuth'].tolist())
+    elevations = property(lambda self: self.store['elevation'].tolist())  # elevation at detection
+    peak_noise = property(lambda self: self.store['peak_noise'].tolist())
+    datetime_list = property(lambda self: self.store.datetimes())
+    freq_list = property(lambda self: [self.store.spectrum(i)[0] for i in range(len(self.store))])
+    power_list = property(lambda self: [self.store.spectrum(i)[1] for i in range(len(self.store))])
+    tracks = property(lambda self: [self.store.track(i) for i in range(len(self.store))])  # az/el samples
+    satellites = property(lambda self: list(zip(self.store['system'].tolist(), self.store['prn'].tolist())))
+
+    def results(self):
         """
-        Simple HHMMSS-only estimator.
-
-        Treats each value in `group['utc']` as an HHMMSS float (e.g. 123519.0), converts to
-        seconds since midnight, and returns the median positive difference between consecutive samples.
-        Returns None if an interval cannot be computed.
+        The retrievals found so far, as a dict of the per retrieval lists (see RESULT_FIELDS).
+        :return: dict of field name -> list
         """
-        try:
-            utc = np.asarray(group['utc'], dtype=float)
-        except Exception:
-            return None
+        return {field: getattr(self, field) for field in RESULT_FIELDS}
 
-        utc = utc[~np.isnan(utc)]
-        if utc.size < 2:
-            return None
+    def add_results(self, results):
+        """
+        Append retrievals produced by another processor, e.g. one run in a worker process.
+        :param results: the ResultsStore of the other processor, or a dict as returned by `results`
+        :return: None
+        """
+        if isinstance(results, ResultsStore):
+            self.store.extend(results)
+            return
+        for values in zip(*(results[field] for field in RESULT_FIELDS)):
+            row = dict(zip(RESULT_FIELDS, values))
+            system, prn = row['satellites']
+            self.store.append({'reflector_height': row['reflector_heights'], 'peak_amplitude': row['peak_amplitudes'],
+                               'azimuth': row['azimuths'], 'elevation': row['elevations'],
+                               'time': row['datetime_list'], 'peak_noise': row['peak_noise'],
+                               'freq': row['freq_list'], 'power': row['power_list'], 'track': row['tracks']},
+                              system, prn)
 
-        ints = utc.astype(int)
-        secs = (ints // 10000) * 3600 + ((ints % 10000) // 100) * 60 + (ints % 100)
-        diffs = np.diff(secs)
-        diffs = diffs[diffs > 0]
-        if diffs.size == 0:
-            return None
+    def get_sampling_interval_from_group(self, group):
+        """
+        Sampling interval of a track in seconds, see `sampling_interval`.
+        """
+        return sampling_interval(group)
 
-        return float(np.median(diffs))
+    def track_params(self):
+        """
+        The processing parameters used by `process_track`, as a plain dict so it can be sent to worker processes.
+        :return: dict of parameter name -> value
+        """
+        return {name: getattr(self, name) for name in TRACK_PARAMS}
 
-    def process_gnss(self, gnss_data):
+    def satellite_carriers(self, gnss_data, satellites=None):
         """
-        Process GNSS data to extract reflector heights and related information. Frequency and power spectra are computed
-        using Lomb-Scargle periodogram. The results are stored in the class attributes.
+        Satellite table and carrier wavelength of each track.
+        :param gnss_data: tracks read by `readGPS` or `readGNSS`
+        :param satellites: satellite table returned by `readGNSS`, if None every track is taken to be GPS L1
+        :return: (satellite table, array of carrier wavelengths in meters)
+        """
+        if satellites is None:
+            satellites = np.zeros(len(gnss_data), dtype=satellite_dt)
+            satellites['system'] = 'GP'
+            satellites['prn'] = np.arange(1, len(gnss_data) + 1)
+            return satellites, np.full(len(gnss_data), self.cf)
+        return satellites, wavelengths(satellites)
+
+    def candidate_tracks(self, gnss_data, satellites=None):
+        """
+        Tracks to process, with their satellite table and carrier wavelengths. With segment_arcs set, each track is
+        split into its rising and setting arcs in each azimuth bin, see `arcs.split_arcs`.
+        :param gnss_data: tracks read by `readGPS` or `readGNSS`
+        :param satellites: satellite table returned by `readGNSS`, if None every track is taken to be GPS L1
+        :return: (tracks, satellite table, array of carrier wavelengths in meters)
+        """
+        satellites, carrier = self.satellite_carriers(gnss_data, satellites)
+        if not self.segment_arcs:
+            return gnss_data, satellites, carrier
+        with instrument.stage('segment'):
+            tracks, satellites, carrier = split_tracks(gnss_data, satellites, carrier, self.azimuth_bins)
+        instrument.count('arcs', len(tracks))
+        return tracks, satellites, carrier
+
+    def height_grid(self):
+        """
+        Reflector heights the spectra of `spectra` are evaluated at.
+        :return: array of heights in meters
+        """
+        return frequency_grid(self.desired_precision, self.max_height)
 
-        :param gnss_data: The data read from `readGPS` function, structured as a list of numpy arrays for each PRN.
-        :return: None
+    def spectra(self, gnss_data, satellites=None):
         """
-        for prn, group in enumerate(gnss_data, start=1):
-            if group.size == 0:
+        Periodograms of every track passing the detrending gates, on the common reflector height grid of
+        `height_grid` and computed in one batch. The retrieval gates are not applied, so the spectra can be stacked
+        or compared as they are.
+
+        :param gnss_data: tracks read by `readGPS` or `readGNSS`
+        :param satellites: satellite table returned by `readGNSS`, if None every track is taken to be GPS L1
+        :return: (heights, 2D array of spectral amplitudes with one row per kept track or arc, satellite table of the
+                 rows)
+        """
+        gnss_data, satellites, carrier = self.candidate_tracks(gnss_data, satellites)
+        params = self.track_params()
+        heights = self.height_grid()
+        keep, xs, ys = [], [], []
+        for n, (group, cf) in enumerate(zip(gnss_data, carrier)):
+            track = detrend_track(group, params)
+            if track is None:
                 continue
+            keep.append(n)
+            xs.append(track['x'] / (cf/2))
+            ys.append(track['y'])
+        power = lomb_batch(xs, ys, heights, method=self.lomb_method)
+        return heights, power, satellites[np.array(keep, dtype=int)]
 
-            elevation = group['el']
-            azimuth = group['az']
-            snr = group['snr']
-
-            i = np.where(
-                (elevation > self.emin) & (elevation < self.emax) & (~np.isnan(snr)) & (~np.isnan(elevation)) & (
-                    ~np.isnan(azimuth)))[0]
-
-            # create azimuth mask
-            mask = np.zeros(i.shape, dtype=bool)
-            for min_v, max_v in self.azimuth_bins:
-                current_range_mask = (azimuth[i] > min_v) & (azimuth[i] < max_v)
-                mask = np.logical_or(mask, current_range_mask)
-            i = i[mask]
-
-            # calculate interval
-            sampling_interval = self.get_sampling_interval_from_group(group)
-            if sampling_interval != self.sampling_interval:
-                self.sampling_interval = sampling_interval
-                self.coeff_ma = np.ones(
-                    (1, int(self.av_time / self.sampling_interval))) * self.sampling_interval / self.av_time
-
-            if len(i) > self.min_points:
-                if (np.max(elevation[i]) - np.min(elevation[i]) > self.ediff
-                    and np.max(azimuth[i]) - np.min(azimuth[i]) < self.max_az_diff):
-                    minAmp, frange = 18, (6,2)
-                    snr_subset = snr[i]
-                    snr_filter = lfilter(self.coeff_ma[0], 1, snr_subset)
-                    snr_index = np.where(snr_filter > self.snr_thresh)[0]
-                    if snr_index.size == 0:
-                        continue
-                    snr_data = snr_subset[snr_index]
-                    elevation_angles = elevation[i][snr_index]
-                    azm = np.mean(azimuth[i])
-                    track_indices = i[snr_index]
-                    track_az = np.array(azimuth[track_indices], copy=True)
-                    track_el = np.array(elevation[track_indices], copy=True)
-
-                    # convert from dB to linear
-                    snr_db = 10**(snr_data / 20)
-
-                    # Detrend the data
-                    p = np.polyfit(elevation_angles, snr_db, self.pvf)
-                    pv = np.polyval(p, elevation_angles)
-
-                    smooth_data = smooth(snr_db-pv).conj().T
-
-                    save_snr_idx = round(len(self.coeff_ma)/2)
-                    if len(smooth_data) <= save_snr_idx:
-                        continue
-                    save_snr = smooth_data[save_snr_idx:]
-                    # fft is done on the sine of the elevation angles
-                    aligned_elev = elevation_angles[save_snr_idx:]
-                    trim_len = min(len(save_snr), len(aligned_elev))
-                    if trim_len == 0:
-                        continue
-                    save_snr = save_snr[:trim_len]
-                    aligned_elev = aligned_elev[:trim_len]
-                    elev_angels = np.radians(aligned_elev) # convert to radians as np does not have sind function
-                    sine_e = np.sin(elev_angels)
-
-                    # sort the data so all tracks are rising
-                    sorted_x, j = np.unique(sine_e.conj().T, return_index=True)
-
-                    sorted_y = save_snr[j]
-                    sorted_x = sorted_x[1:-1]
-                    sorted_y = sorted_y[1:-1]
-
-                    ofac, hifac = get_ofac_hifac(elevation_angles, self.cf/2, self.max_height, self.desired_precision)
-                    freq, power, prob, conf95 = lomb(sorted_x / (self.cf/2), sorted_y, ofac, hifac)
-                    maxRh, maxAmp, pknoise = peak2noise(freq, power, frange)
-                    maxObsElev = np.max(elevation_angles)
-                    minObsElev = np.min(elevation_angles)
-
-                    if (maxAmp > minAmp
-                        and maxRh > self.min_rh
-                        and pknoise > self.pcrit
-                        and (maxObsElev - minObsElev) > self.ediff):
-
-                        power_max = np.argmax(power)
-                        idx = i[snr_index[j[power_max]]]
-                        utc = group['utc'][idx]
-                        date = group['date'][idx]
-
-                        self.reflector_heights.append(maxRh)
-                        self.peak_amplitudes.append(maxAmp)
-                        self.azimuths.append(group['az'][idx])
-                        self.elevations.append(group['el'][idx])  # record elevation at detection
-                        self.datetime_list.append(gps_to_nz(date, utc))
-                        self.peak_noise.append(pknoise)
-
-                        self.freq_list.append(freq)
-                        self.power_list.append(power)
-                        self.tracks.append({'az': track_az, 'el': track_el})
+    def process_gnss(self, gnss_data, satellites=None, executor=None):
+        """
+        Process GNSS data to extract reflector heights and related information. Frequency and power spectra are computed
+        using Lomb-Scargle periodogram. The results are stored in the class attributes. With segment_arcs set, every
+        rising or setting arc of a satellite in each azimuth bin gives its own retrieval.
+
+        :param gnss_data: The data read from `readGPS` (a list of numpy arrays for each GPS PRN) or the tracks read
+                          from `readGNSS`.
+        :param satellites: The satellite table returned by `readGNSS` alongside the tracks, giving the system and
+                           carrier wavelength of each track. If None, every track is taken to be GPS L1.
+        :param executor: Optional `concurrent.futures` executor the tracks are processed in, e.g. a ProcessPoolExecutor
+                         to use every core on a single large file. If None, the tracks are processed in this thread.
+                         Results are collected in track order either way. The instrument counters and timers of
+                         tracks processed in other processes are not collected.
+        :return: None
+        """
+        gnss_data, satellites, carrier = self.candidate_tracks(gnss_data, satellites)
+        params = self.track_params()
+        mapper = map if executor is None else executor.map
+        for result, satellite in zip(mapper(process_track, gnss_data, carrier, repeat(params)), satellites):
+            if result is not None:
+                self.add_retrieval(result, satellite['system'], satellite['prn'])
+
+    def add_retrieval(self, result, system, prn):
+        """
+        Store one retrieval.
+        :param result: dict returned by `process_track`
+        :param system: talker id of the satellite system
+        :param prn: PRN of the satellite
+        :return: None
+        """
+        self.store.append(result, str(system), int(prn))
 
     def guard_graphs(self):
         """
         Ensure that there is data to graph before attempting to do so.
         :return: True if there is data to graph, False otherwise.
         """
-        if len(self.reflector_heights) == 0:
+        if len(self.store) == 0:
             print("No reflector heights detected. Cannot generate graphs.")
             exit(1)
 
-    def graph_azimuths(self, date: datetime.datetime):
+    def new_figure(self, path=None, *args, figsize=None, **kwargs):
+        """
+        Figure and axes to draw a graph in, as plt.subplots. A figure saved to a file is created without pyplot, so it
+        is rendered off screen by Agg whatever the backend and needs no GUI.
+        :param path: file path the figure will be saved to, None to show it
+        :param figsize: figure size in inches
+        :return: (figure, axes)
+        """
+        if path is None:
+            import matplotlib.pyplot as plt
+            return plt.subplots(*args, figsize=figsize, **kwargs)
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=figsize)
+        return fig, fig.subplots(*args, **kwargs)
+
+    def finish_graph(self, fig, path=None):
+        """
+        Show a figure, or save it to a file.
+        :param fig: figure returned by `new_figure`
+        :param path: file path, None to show the figure
+        :return: None
+        """
+        if path is None:
+            fig.show()
+        else:
+            fig.savefig(path)
+
+    @instrument.timed('plot')
+    def graph_azimuths(self, date: datetime.datetime, path=None):
         """
         Graph the azimuths of detected reflector heights, for a particular day, in groups of 90 degrees.
         :param date: Date corresponding to the GNSS data to be displayed.
+        :param path: File the figure is saved to instead of being shown, if given.
         :return: None
         """
         self.guard_graphs()
         # check date is in date list
-        if all(dt.date() != date.date() for dt in self.datetime_list):
+        day = self.store.on_date(date)
+        if day.size == 0:
             print("No data for the specified date: {}. Cannot generate graph.".format(date.strftime('%Y-%m-%d')))
             return
         start_date = date.strftime('%d %b %Y %H:%m')
         end_date = date.replace(minute=59).strftime('%d %b %Y %H:%m')
-        fig, ax = plt.subplots(2, 2, figsize=(10,10))
+        from matplotlib import rcParams
+        from matplotlib.collections import LineCollection
+        fig, ax = self.new_figure(path, 2, 2, figsize=(10,10))
         fig.suptitle("Height Retrievals by Azimuth Sector for {}\nto\n{}".format(start_date, end_date))
         for i in range(len(self.azimuth_bins)):
             start, end = self.azimuth_bins[i]
@@ -206,29 +655,36 @@ class GNSSProcessor:
             ax_sector.set_xlabel("Reflector Height (m)")
             ax_sector.grid()
 
-        for freq, power, az, dt in zip(self.freq_list, self.power_list, self.azimuths, self.datetime_list):
-            if dt.date() == date.date():
-                for i in range(len(self.azimuth_bins)):
-                    start, end = self.azimuth_bins[i]
-                    if start < az < end:
-                        ax_sector = ax[i//2, i%2]
-                        ax_sector.plot(freq, power)
-        fig.show()
-
-    def graph_retrieval_metrics(self, date: datetime.datetime):
+        for i in range(len(self.azimuth_bins)):
+            start, end = self.azimuth_bins[i]
+            ax_sector = ax[i//2, i%2]
+            # every spectrum of the sector in one collection, coloured in turn by the colour cycle as separate plots were
+            freq, power, ends = self.store.spectra(self.store.in_sector(start, end, day))
+            if ends.size == 0:
+                continue
+            colors = rcParams['axes.prop_cycle'].by_key()['color']
+            lines = np.split(np.column_stack((freq, power)), ends[:-1])
+            ax_sector.add_collection(LineCollection(lines, colors=[colors[k % len(colors)] for k in range(len(lines))]))
+            ax_sector.autoscale_view()
+        self.finish_graph(fig, path)
+
+    @instrument.timed('plot')
+    def graph_retrieval_metrics(self, date: datetime.datetime, path=None):
         """
         Graph the retrieval metrics of detected reflector heights, for a particular day.
         :param date: Date corresponding to the GNSS data to be displayed.
+        :param path: File the figure is saved to instead of being shown, if given.
         :return: None
         """
         self.guard_graphs()
         # check date is in date list
-        if all(dt.date() != date.date() for dt in self.datetime_list):
+        day = self.store.on_date(date)
+        if day.size == 0:
             print("No data for the specified date: {}. Cannot generate graph.".format(date.strftime('%Y-%m-%d')))
             return
         start_date = date.strftime('%d %b %Y %H:%m')
         end_date = date.replace(minute=59).strftime('%d %b %Y %H:%m')
-        fig_retrieval, (ax_height, ax_peak, ax_noise) = plt.subplots(3, 1, figsize=(8, 10))
+        fig_retrieval, (ax_height, ax_peak, ax_noise) = self.new_figure(path, 3, 1, figsize=(8, 10))
 
         fig_retrieval.suptitle("Retrieval Metrics for {}\nto\n{}".format(start_date, end_date))
 
@@ -245,36 +701,40 @@ class GNSSProcessor:
         ax_noise.set_ylabel("Peak to Noise Ratio")
         ax_noise.grid()
 
-        for rh, pa, pk, az, dt in zip(self.reflector_heights, self.peak_amplitudes, self.peak_noise, self.azimuths, self.datetime_list):
-            if dt.date() == date.date():
-                ax_height.scatter(az, rh)
-                ax_peak.scatter(az, pa)
-                ax_noise.scatter(az, pk)
+        records = self.store.records[day]
+        # each retrieval coloured in turn by the colour cycle, as when every point was a scatter of its own
+        from matplotlib import rcParams
+        cycle = rcParams['axes.prop_cycle'].by_key()['color']
+        colors = [cycle[k % len(cycle)] for k in range(len(records))]
+        ax_height.scatter(records['azimuth'], records['reflector_height'], c=colors)
+        ax_peak.scatter(records['azimuth'], records['peak_amplitude'], c=colors)
+        ax_noise.scatter(records['azimuth'], records['peak_noise'], c=colors)
 
         ax_peak.plot()
-        fig_retrieval.show()
+        self.finish_graph(fig_retrieval, path)
 
-    def graph_height_time(self):
+    @instrument.timed('plot')
+    def graph_height_time(self, path=None):
         """
         Graph the reflector heights over time.
+        :param path: File the figure is saved to instead of being shown, if given.
         :return: None
         """
         self.guard_graphs()
-        start_date = self.datetime_list[0].strftime('%d %b %Y %H:%m')
-        end_date = self.datetime_list[-1].strftime('%d %b %Y %H:%m')
-        daily_heights= defaultdict(list)
-        for dt, height in zip(self.datetime_list, self.reflector_heights):
-            daily_heights[dt.date()].append(height)
-
-        daily_dates = []
-        daily_avg_heights = []
-        for day in sorted(daily_heights):
-            daily_dates.append(datetime.datetime.combine(day, datetime.datetime.min.time()))
-            daily_avg_heights.append(np.mean(daily_heights[day]))
-
-        fig_height_time, ax_height_time = plt.subplots(figsize=(8, 6))
-        ax_height_time.plot(self.datetime_list, self.reflector_heights, marker='s', mfc='white', mec='black', linestyle='None', label='Individual Retrievals')
-        ax_height_time.plot(daily_dates, daily_avg_heights, marker='s', mfc='blue', mec='black', linestyle='None', label='Average Daily Retrievals')
+        order = self.store.time_order()
+        times = self.store['time'][order]
+        first, last = self.store.datetimes(order[[0, -1]])
+        start_date = first.strftime('%d %b %Y %H:%m')
+        end_date = last.strftime('%d %b %Y %H:%m')
+        heights = self.store['reflector_height'][order]
+        days, day_index = np.unique(times.astype('datetime64[D]'), return_inverse=True)
+        daily_avg_heights = np.bincount(day_index, heights) / np.bincount(day_index)
+
+        # wall clock times are plotted as they are, the time zone only labels the axis
+        import matplotlib.dates as mdates
+        fig_height_time, ax_height_time = self.new_figure(path, figsize=(8, 6))
+        ax_height_time.plot(times, heights, marker='s', mfc='white', mec='black', linestyle='None', label='Individual Retrievals')
+        ax_height_time.plot(days, daily_avg_heights, marker='s', mfc='blue', mec='black', linestyle='None', label='Average Daily Retrievals')
         ax_height_time.legend()
         ax_height_time.grid()
         ax_height_time.set_xlabel("Time (NZ)")
@@ -284,37 +744,33 @@ class GNSSProcessor:
         ax_height_time.xaxis.set_major_formatter(mdates.DateFormatter('%d %b'))
         ax_height_time.xaxis.set_major_locator(mdates.DayLocator())
 
-        fig_height_time.show()
+        self.finish_graph(fig_height_time, path)
 
-    def graph_az_el_polar(self, date: datetime.datetime):
+    @instrument.timed('plot')
+    def graph_az_el_polar(self, date: datetime.datetime, path=None):
         """
         Polar line plot of azimuth (theta) vs elevation (radius) tracks for a given date.
-        Each line represents a valid satellite track.
+        Each line represents a valid satellite track. The figure is saved to `path` instead of being shown, if given.
         """
         self.guard_graphs()
-        if all(dt.date() != date.date() for dt in self.datetime_list):
+        day = self.store.on_date(date)
+        if day.size == 0:
             print("No data for the specified date: {}. Cannot generate graph.".format(date.strftime('%Y-%m-%d')))
             return
+        azimuths, elevations, ends = self.store.tracks(day)
+        if azimuths.size == 0:
+            print("No tracks to plot for the date:", date.strftime('%Y-%m-%d'))
+            return
 
         start_date = date.strftime('%d %b %Y %H:%M')
         end_date = date.replace(minute=59).strftime('%d %b %Y %H:%M')
-        fig, ax = plt.subplots(subplot_kw={'projection': 'polar'}, figsize=(8, 8))
+        fig, ax = self.new_figure(path, subplot_kw={'projection': 'polar'}, figsize=(8, 8))
         fig.suptitle("Azimuth vs Elevation (polar) for {}\nto\n{}".format(start_date, end_date))
 
-        plotted = False
-        for track, dt in zip(self.tracks, self.datetime_list):
-            if dt.date() == date.date():
-                thetas = np.deg2rad(track['az'])
-                radii = np.asarray(track['el'])
-                if radii.size == 0:
-                    continue
-                ax.plot(thetas, radii, linewidth=1.5, alpha=0.9, color='tab:blue')
-                plotted = True
-
-        if not plotted:
-            print("No tracks to plot for the date:", date.strftime('%Y-%m-%d'))
-            plt.close(fig)
-            return
+        # all the tracks in one line, a NaN between two tracks breaks it
+        thetas = np.insert(np.deg2rad(azimuths), ends[:-1], np.nan)
+        radii = np.insert(elevations, ends[:-1], np.nan)
+        ax.plot(thetas, radii, linewidth=1.5, alpha=0.9, color='tab:blue')
 
         ax.set_theta_zero_location('N')
         ax.set_theta_direction(-1)
@@ -322,4 +778,4 @@ class GNSSProcessor:
         ax.set_rlabel_position(135)
         ax.grid(True)
 
-        fig.show()
+        self.finish_graph(fig, path)
@@ -14,6 +14,10 @@ from numpy.lib import recfunctions as rfn
 #
 # date    - v1 release 2024.04.11
 #         - v2 release 2024.06.10 - added line 144 that checks for existence of 'prn' in case of a G*RMC with no GPGSV
+#         - v3 release 2026.10.18 - single pass reader filling columnar buffers, the original row by row reader is
+#                                   kept as mode='legacy'
+#                                 - readGNSS for the GLGSV, GAGSV and GBGSV sentences alongside GPGSV
+#                                 - elevations interpolated pass by pass, on one table for all the satellites
 #
 # usage   - within a python interpretor you can obtain an output structure as
 #         >>> gps_data = readGPS("./FILENAME.LOG")
@@ -30,7 +34,12 @@ from numpy.lib import recfunctions as rfn
 import numpy as np
 import os
 
+import instrument
+
+from arcs import MAX_GAP, sample_seconds
 from read_gpgsv import *
+from nmea_bytes import read_observations
+from gnss_systems import SYSTEMS, ALL_SYSTEMS, KEY_STRIDE, satellite_table, gsv_heads
 
 #===========#
 # constants #
@@ -39,16 +48,239 @@ from read_gpgsv import *
 # TRUE  = 1
 # FALSE = 0
 N_PRN = 32
+GSV_BATCH = 1 << 16  # GSV sentences decoded at once by the buffered reader
+MIN_CHANGES = 10  # elevation changes a pass needs for its elevations to be interpolated
 
 #=========#
 # readGPS #
 #=========#
 
-def readGPS(Filename, interp=False):
-    # -----------#
-    # open file #
-    # -----------#
+# per satellite observation record and per block (epoch) record
+dt = np.dtype(
+    [('count', int), ('el', float), ('az', float), ('snr', float), ('utc', float), ('date', int)])
+gps_dt = np.dtype(
+    [('hour', int), ('minute', int), ('second', int), ('date', int), ('timestamp', int)]
+)
+
+READ_MODES = ('buffered', 'mmap', 'legacy')
+
+
+def readGPS(Filename, interp=False, mode='buffered', validate=True):
+    """
+    Read a GNSS logger file and return the GPGSV observations of every GPS PRN.
+
+    :param Filename: path to the .LOG file
+    :param interp: if True, join utc (seconds of day) and date onto each observation and interpolate the
+                   integer elevation angles
+    :param mode: parsing engine, 'buffered' (single pass into columnar buffers), 'mmap' (memory mapped, bytes
+                 level tokenizer with the lowest peak memory) or 'legacy' (the original row by row reader, kept
+                 for benchmarking)
+    :param validate: if True, the GPGSV sentences with a missing or wrong checksum are skipped, see `readGNSS`. The
+                     legacy reader never checks them, so compare it with validate=False
+    :return: list of length N_PRN of structured arrays, entry k holding PRN k+1
+    """
+    if mode == 'legacy':
+        with instrument.stage('parse'):
+            gnss_data, gps_data = _read_legacy(Filename)
+        if interp:
+            with instrument.stage('interp'):
+                _interp_elevation(gnss_data, gps_data)
+        return gnss_data
+
+    tracks, satellites = readGNSS(Filename, interp, mode, systems=('GP',), validate=validate)
+    gnss_data = [np.zeros(0, dtype=dt) for _ in range(N_PRN)]
+    for track, prn in zip(tracks, satellites['prn']):
+        gnss_data[prn - 1] = track
+    return gnss_data
+
+
+def readGNSS(Filename, interp=False, mode='buffered', systems=ALL_SYSTEMS, validate=True):
+    """
+    Read a GNSS logger file and return the GSV observations of every satellite of the given constellations.
+
+    :param Filename: path to the .LOG file
+    :param interp: if True, join utc (seconds of day) and date onto each observation and interpolate the
+                   integer elevation angles
+    :param mode: parsing engine, 'buffered' or 'mmap' (see `readGPS`)
+    :param systems: NMEA talker ids of the constellations to read, keys of gnss_systems.SYSTEMS
+    :param validate: if True, the observations of GSV sentences with a missing or wrong checksum are skipped. They
+                     still take their place in their GSV group, and are counted as 'checksum_errors' by instrument
+    :return: (tracks, satellites) where tracks is a list of structured arrays, one per observed satellite, and
+             satellites the matching structured array of (system, prn), ordered by system then PRN
+    """
+    systems = tuple(systems)
+    unknown = set(systems) - set(SYSTEMS)
+    if unknown:
+        raise ValueError("unknown systems {}, expected some of {}".format(sorted(unknown), ALL_SYSTEMS))
+
+    if mode not in ('buffered', 'mmap'):
+        raise ValueError("mode must be 'buffered' or 'mmap', got {!r}".format(mode))
+    with instrument.stage('parse'):
+        if mode == 'buffered':
+            tracks, keys, gps_data = _read_buffered(Filename, systems, validate)
+        else:
+            tracks, keys, gps_data = _read_mmap(Filename, systems, validate)
+    instrument.count('epochs', len(gps_data) - 1)
+    instrument.count('observations', sum(track.size for track in tracks))
+
+    if interp:
+        with instrument.stage('interp'):
+            _interp_elevation(tracks, gps_data)
+
+    return tracks, satellite_table(keys, systems)
+
+
+def _to_float(field):
+    # empty NMEA fields are missing values
+    return float(field) if field else np.nan
 
+
+def _read_buffered(Filename, systems, validate=True):
+    """
+    Single pass reader. Every satellite observation is appended to flat column lists shared by all satellites
+    and the per satellite arrays are cut out of one table at the end, so the cost is linear in the file length.
+    """
+    # GSV sentence head -> (system index, tracked signal id, lowest PRN, highest PRN)
+    heads = gsv_heads(systems)
+
+    # sentences of the accepted GSV messages, decoded GSV_BATCH at a time, and their system index, block count and time
+    gsv_lines = []
+    gsv_meta = []
+    columns = {name: [] for name in ('key', 'count', 'el', 'az', 'snr', 'utc')}
+
+    blocks = []  # (hour, minute, second, date) for each completed block
+    hms = (0, 0, 0)
+    block_count = 0
+    time_float = 0.0
+    new_block = False
+    gsv_open = None  # head of the multi message GSV group being read
+    gsv_done = False  # a short sentence (checksum before the 4th satellite) ended the group
+
+    n_lines = 0
+    with open(Filename, 'r') as fid:
+        for n_lines, line in enumerate(fid, 1):
+            line = line.rstrip()
+            head = line[:6]
+
+            system = heads.get(head)
+            if system is not None:
+                if not new_block:
+                    continue
+                data = line.split(',')
+                num_messages = int(data[1])
+                message_number = int(data[2])
+                if gsv_open != head:
+                    if message_number != 1:
+                        gsv_open = None
+                        continue
+                    gsv_done = False
+                gsv_open = head if message_number < num_messages else None
+                if gsv_done:
+                    continue
+
+                index, signal, prn_min, prn_max = system
+                if (len(data) - 4) % 4 == 1:  # trailing signal id
+                    signal_id = data[-1].split('*')[0]
+                    if signal_id and int(signal_id, 16) != signal:
+                        continue
+
+                gsv_lines.append(line)
+                gsv_meta.append((index, prn_min, prn_max, block_count, time_float))
+                if len(gsv_lines) == GSV_BATCH:
+                    _decode_gsv_lines(gsv_lines, gsv_meta, columns, validate)
+                # the checksum in a PRN field (4, 8, 12 or 16) ends the group
+                gsv_done = len(data) % 4 == 1 and len(data) <= 17 and "*" in data[-1]
+                continue
+
+            gsv_open = None
+            if head == "$GNGGA" or head == "$GPGGA":
+                new_block = True
+                time_float = float(line.split(',')[1])
+                hour = math.floor(time_float/10000)
+                minute = math.floor((time_float - hour * 10000)/100)
+                second = round(time_float - math.floor(time_float/100)*100)
+                hms = (hour, minute, second)
+
+            elif head == "$GNRMC" or head == "$GPRMC":
+                stamp = line.split(',')[9]
+                date = (2000 + int(stamp[4:6])) * 10000 + int(stamp[2:4]) * 100 + int(stamp[:2])
+                blocks.append(hms + (date,))
+                hms = (0, 0, 0)
+                block_count += 1
+                new_block = False
+
+    _decode_gsv_lines(gsv_lines, gsv_meta, columns, validate)
+    blocks.append(hms + (0,))  # block still open at the end of the file
+    instrument.count('lines', n_lines)
+    tracks, keys = _split_by_key({name: np.concatenate(parts) for name, parts in columns.items()})
+    return tracks, keys, _block_table(blocks)
+
+
+def _decode_gsv_lines(gsv_lines, gsv_meta, columns, validate):
+    """
+    Decode a batch of GSV sentences with `decode_gsv` and append their observations to the columns of
+    `_read_buffered`. Both lists are emptied.
+    """
+    index, prn_min, prn_max, count, utc = (np.array(meta) for meta in zip(*gsv_meta)) if gsv_meta else \
+        (np.zeros(0, dtype=int),) * 5
+    decoded = decode_gsv(gsv_lines, prn_min, prn_max, validate=validate)
+    instrument.count('checksum_errors', int(np.count_nonzero(~decoded['checksum_ok'])))
+    sentence = decoded['sentence']
+    columns['key'].append(index[sentence] * KEY_STRIDE + decoded['prn'])
+    columns['count'].append(count[sentence])
+    columns['el'].append(decoded['el'])
+    columns['az'].append(decoded['az'])
+    columns['snr'].append(decoded['snr'])
+    columns['utc'].append(utc[sentence].astype(float))
+    gsv_lines.clear()
+    gsv_meta.clear()
+
+
+def _read_mmap(Filename, systems, validate=True):
+    """
+    Memory mapped reader, tokenizing the raw bytes with NumPy (see nmea_bytes.py).
+    """
+    tracks, keys, blocks = read_observations(Filename, dt, systems, validate=validate)
+    return tracks, keys, _block_table(blocks)
+
+
+def _block_table(blocks):
+    """
+    Block table from (hour, minute, second, date) rows, one per block.
+    """
+    block_cols = np.array(blocks, dtype=int).reshape(-1, 4)
+    gps_data = np.zeros(len(block_cols), dtype=gps_dt)
+    gps_data['hour'] = block_cols[:, 0]
+    gps_data['minute'] = block_cols[:, 1]
+    gps_data['second'] = block_cols[:, 2]
+    gps_data['date'] = block_cols[:, 3]
+    return gps_data
+
+
+def _split_by_key(columns):
+    """
+    Build the per satellite structured arrays from file ordered observation columns.
+
+    :param columns: dict mapping 'key', 'count', 'el', 'az', 'snr', 'utc' to sequences with one entry per
+                    observation, emptied as the table is filled
+    :return: (tracks, keys), a list of structured arrays (views into one table) and the sorted satellite keys
+    """
+    # stable sort keeps each satellite's observations in file order
+    key = np.asarray(columns.pop('key'), dtype=int)
+    order = np.argsort(key, kind='stable')
+    table = np.zeros(key.size, dtype=dt)
+    for name in ('count', 'el', 'az', 'snr', 'utc'):
+        table[name] = np.asarray(columns.pop(name))[order]  # release each column once copied
+    key = key[order]
+    keys = np.unique(key)
+    bounds = np.searchsorted(key, np.append(keys, np.iinfo(int).max))
+    return [table[bounds[k]:bounds[k + 1]] for k in range(keys.size)], keys
+
+
+def _read_legacy(Filename):
+    """
+    Original reader, appending one row at a time with np.concatenate. Kept as a reference for benchmarks.
+    """
     # ----------------#
     # initialisation #
     # ----------------#
@@ -57,16 +289,6 @@ def readGPS(Filename, interp=False):
     # new_block = False
     block_count = 0
 
-    # -------------------------------------------------------#
-    # create a structure template and array of length N_PRN #
-    # -------------------------------------------------------#
-
-    dt = np.dtype(
-        [('count', int), ('el', float), ('az', float), ('snr', float), ('utc', float), ('date', int)])
-    gps_dt = np.dtype(
-        [('hour', int), ('minute', int), ('second', int), ('date', int), ('timestamp', int)]
-    )
-
     gnss_data = [np.array([], dtype=dt) for _ in range(N_PRN)]  # creates a list of null vectors of length N_PRN
     # gps_data = []
     data_to_append = np.zeros(1, dtype=dt)  # structure we will use to append to gps_data
@@ -140,36 +362,96 @@ def readGPS(Filename, interp=False):
                 block_count += 1
                 new_block = False
 
+    return gnss_data, gps_data
 
-    if interp:
-        for prn, data in enumerate(gnss_data, start=1):
-            if data.size == 0:
-                continue
 
-            # first join in utc and date
-            idx = data['count'].astype(int) # get indices to gps_data
-            utc_vals = (
-                gps_data['hour'][idx] * 3600
-                + gps_data['minute'][idx] * 60
-                + gps_data['second'][idx]
-            )
-            # set utc time and date
-            data['utc'] = utc_vals
-            data['date'] = gps_data['date'][idx]
+def _interp_elevation(gnss_data, gps_data):
+    """
+    Join utc (seconds of day) and date from the block records onto each satellite and interpolate the integer
+    elevation angles in place, for all the satellites at once on flat columns.
+    """
+    sizes = np.array([data.size for data in gnss_data], dtype=int)
+    if sizes.sum() == 0:
+        return
+    bounds = np.cumsum(sizes)[:-1]
+    idx = np.concatenate([data['count'] for data in gnss_data]).astype(int) # get indices to gps_data
 
+    # first join in utc and date, timing each block once
+    block_utc = gps_data['hour'] * 3600 + gps_data['minute'] * 60 + gps_data['second']
+    block_seconds = sample_seconds(np.rec.fromarrays((gps_data['date'], block_utc, np.arange(len(gps_data))),
+                                                     names=('date', 'utc', 'count')))
+    el = interpolated_elevations(np.concatenate([data['el'] for data in gnss_data]), block_seconds[idx],
+                                 (np.cumsum(sizes) - sizes)[sizes > 0])
 
-            el = data['el']
-            utc = data['utc']
+    for data, rows, elevations in zip(gnss_data, np.split(idx, bounds), np.split(el, bounds)):
+        data['utc'] = block_utc[rows]
+        data['date'] = gps_data['date'][rows]
+        data['el'] = elevations
 
-            # find indices where elevation changes sharply
-            ind = np.where(np.abs(np.diff(el)) > 0.1)[0]
 
-            if len(ind) > 10:
-                timeshort = utc[ind]
-                elv = np.interp(utc, timeshort, el[ind])
-                data['el'] = elv  # directly update elevation values
+def interpolated_elevations(el, seconds, starts=(0,)):
+    """
+    Elevation angles interpolated over time, pass by pass.
 
-    return gnss_data
+    The logger reports whole degrees, so within a pass the samples just before each change of the elevation are
+    taken as exact and the others interpolated between them, as np.interp does. A pass ends with its satellite or
+    after arcs.MAX_GAP seconds without a sample, so the interpolation never bridges the time a satellite spends below
+    the horizon. Passes with at most MIN_CHANGES changes keep their whole degrees.
+
+    :param el: elevation angles of the observations of every satellite, each satellite's together and in time order
+    :param seconds: time of each observation in seconds
+    :param starts: index of the first observation of each satellite
+    :return: array of the elevation angles
+    """
+    out = np.array(el, dtype=float)
+    if out.size == 0:
+        return out
+    step = np.diff(seconds)
+    new_pass = np.empty(out.size, dtype=bool)
+    new_pass[1:] = (step > MAX_GAP) | (step < 0)
+    new_pass[np.asarray(starts, dtype=int)] = True
+    passes = np.cumsum(new_pass) - 1
+
+    # samples just before each change of the elevation, within a pass
+    anchor = np.zeros(out.size, dtype=bool)
+    anchor[:-1] = (np.abs(np.diff(out)) > 0.1) & ~new_pass[1:]
+    n_anchors = np.bincount(passes[anchor], minlength=passes[-1] + 1)
+    n_anchors[n_anchors <= MIN_CHANGES] = 0
+    interpolated = n_anchors[passes] > 0
+    anchor &= interpolated
+    rows = np.flatnonzero(interpolated)
+    if rows.size == 0:
+        return out
+
+    # a single np.interp for every pass, on a time axis where each pass starts `span` seconds after the previous one.
+    # Each pass gets two more anchors at the ends of its span, holding its first and last elevations, so that the
+    # samples before its first anchor or after its last one keep their value as with one np.interp per pass.
+    seconds = seconds - seconds.min()
+    span = seconds.max() + 1
+    key = passes * span + seconds
+    anchors = np.flatnonzero(anchor)
+    counts = n_anchors[n_anchors > 0]
+    ends = np.cumsum(counts)
+    firsts = ends - counts
+    start = np.flatnonzero(n_anchors) * span
+    # the end of a pass is inserted before the start of the next one, both going at the same position
+    at = np.concatenate((ends, firsts))
+    xp = np.insert(key[anchors], at, np.concatenate((start + span - 1, start)))
+    fp = np.insert(out[anchors], at, np.concatenate((out[anchors[ends - 1]], out[anchors[firsts]])))
+    if rows.size == out.size:
+        return np.interp(key, xp, fp)
+    out[rows] = np.interp(key[rows], xp, fp)
+    return out
+
+
+def interp_elevation(data):
+    """
+    Interpolate the integer elevation angles of one satellite over time, in place, see `interpolated_elevations`.
+
+    :param data: structured array of one satellite with utc and date set
+    :return: None
+    """
+    data['el'] = interpolated_elevations(data['el'], sample_seconds(data))
 
 # readGPS('../data/240531.LOG', True)
 
@@ -180,7 +462,7 @@ def readGPS(Filename, interp=False):
 # you can find lists of what is in each of the fields here in the case that you want more information.
 #
 # GPGGA: https://docs.novatel.com/OEM7/Content/Logs/GPGGA.htm
-# GPGSV: https://docs.novatel.com/OEM7/Content/Logs/GPGSV.htm
+# GPGSV: https://docs.novatel.com/OEM7/Content/Logs/GPGSV.htm (GLGSV, GAGSV, GBGSV share the layout)
 # GPRMC: https://docs.novatel.com/OEM7/Content/Logs/GPRMC.htm
 #
 ##=================##
@@ -204,3 +486,10 @@ def readGPS(Filename, interp=False):
 # >>> plt.xlabel("elevation")
 # >>> plt.ylabel("snr [dB]")
 # >>> plt.show()
+#
+## readGNSS reads every constellation (GPS, GLONASS, Galileo and BeiDou) and returns only the satellites seen,
+## together with a table of (system, prn) giving the dense index of each track
+#
+# >>> tracks, satellites = readGNSS("190110.LOG", True)
+# >>> for track, sat in zip(tracks, satellites):
+# ...     print(sat['system'], sat['prn'], len(track))
@@ -2,6 +2,8 @@
 
 import numpy as np
 
+from nmea_bytes import SLOTS, Fields, checksums_ok, line_bounds, is_digits, parse_decimal, parse_hex
+
 #============#
 # read_gpgsv #
 #============#
@@ -24,6 +26,65 @@ import numpy as np
 # read_gpgsv #
 #============#
 
+def decode_gsv(sentences, prn_min=1, prn_max=32, signal=None, validate=True):
+    """
+    Decode a batch of GSV sentences at once, e.g. every GSV sentence of a block or of a file.
+
+    Sentences may hold 1 to 4 satellites, empty elevation, azimuth or SNR fields (decoded as NaN), a trailing signal
+    id and a checksum. Satellite slots whose PRN field is empty, not a number or outside prn_min..prn_max are skipped.
+
+    :param sentences: list of sentences, str or bytes, with or without their line endings
+    :param prn_min: lowest PRN read, a number or an array with one entry per sentence
+    :param prn_max: highest PRN read, a number or an array with one entry per sentence
+    :param signal: signal id of the signal read, sentences ending with another signal id are skipped. None reads all
+    :param validate: if True, the observations of sentences with a missing or wrong checksum are skipped
+    :return: dict of arrays, one entry per observation for 'sentence' (index of its sentence), 'prn', 'el', 'az' and
+             'snr', in sentence then slot order, and one entry per sentence for 'checksum_ok', 'signal' (-1 without a
+             signal id) and 'short' (True when the checksum follows a PRN field, i.e. the sentence ends its group)
+    """
+    lines = [sentence.encode() if isinstance(sentence, str) else sentence for sentence in sentences]
+    buf = np.frombuffer(b'\n'.join(line.rstrip() for line in lines) + b'\n', dtype=np.uint8)
+    starts, ends = line_bounds(buf)
+    starts, ends = starts[:len(lines)], ends[:len(lines)]
+    field = Fields(buf, starts, ends)
+    n_commas = field.n_commas
+    index = np.arange(len(lines))
+    prn_min = np.broadcast_to(prn_min, index.shape)
+    prn_max = np.broadcast_to(prn_max, index.shape)
+
+    checksum_ok = checksums_ok(buf, starts, ends, field.stars)
+    with_signal = (n_commas - 3) % SLOTS == 1
+    signal_id = np.where(with_signal, parse_hex(buf, *field(index, n_commas)), -1)
+    short = (n_commas % SLOTS == 0) & (n_commas <= SLOTS * SLOTS) & (field.stars < ends)
+
+    read = n_commas >= 3
+    if signal is not None:
+        read &= (signal_id < 0) | (signal_id == signal)
+    if validate:
+        read &= checksum_ok
+
+    parts = {name: [] for name in ('order', 'sentence', 'prn', 'el', 'az', 'snr')}
+    for slot in range(SLOTS):
+        j = 4 + 4 * slot
+        present = index[read & (n_commas >= j + 3)]
+        prn_starts, prn_ends = field(present, j)
+        prn = parse_decimal(buf, prn_starts, prn_ends)
+        keep = is_digits(buf, prn_starts, prn_ends) & (prn >= prn_min[present]) & (prn <= prn_max[present])
+        present = present[keep]
+        parts['order'].append(present * SLOTS + slot)
+        parts['sentence'].append(present)
+        parts['prn'].append(prn[keep].astype(int))
+        parts['el'].append(parse_decimal(buf, *field(present, j + 1)))
+        parts['az'].append(parse_decimal(buf, *field(present, j + 2)))
+        parts['snr'].append(parse_decimal(buf, *field(present, j + 3)))
+
+    # slots were decoded one at a time, put them back in sentence order
+    order = np.argsort(np.concatenate(parts.pop('order')), kind='stable')
+    observations = {name: np.concatenate(values)[order] for name, values in parts.items()}
+    observations.update(checksum_ok=checksum_ok, signal=signal_id, short=short)
+    return observations
+
+
 def read_gpgsv(gsv_data):
     prn = []
     elev = []
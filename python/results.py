@@ -0,0 +1,566 @@
+"""
+Array backed store of reflector height retrievals.
+
+Every retrieval is one record of `record_dt`. The spectra (frequency and power) and the az/el track samples of all
+retrievals are kept end to end in contiguous arrays, each record holding the start and size of its own slice. A
+sorted time index and a sorted azimuth index answer date, time range and azimuth sector queries with binary searches
+instead of scanning every retrieval.
+
+Retrievals are appended to small pending lists and merged into the arrays before the next query, or every MERGE_EVERY
+retrievals, so appending one retrieval at a time stays cheap.
+
+For long deployments the retention policy bounds what is kept besides the heights (see RETENTIONS): the whole spectrum
+and track, `points` heights of the spectrum around its peak and `points` evenly spaced track samples, or nothing. The
+retrievals of the last `recent_days` days keep everything, so the plots of recent days still work. The spectra and
+tracks can also be spilled to memory-mapped files in a folder instead of being held in memory.
+"""
+import csv
+import datetime
+import shutil
+import tempfile
+import weakref
+from pathlib import Path
+
+import numpy as np
+
+# retrieval times are the wall clock times of utils.gps_to_datetime64, TIMEZONE is only attached for display
+from utils import TIMEZONE
+
+record_dt = np.dtype([
+    ('time', 'datetime64[us]'), ('reflector_height', float), ('peak_amplitude', float), ('azimuth', float),
+    ('elevation', float), ('peak_noise', float), ('system', 'U2'), ('prn', int),
+    ('spectrum_start', int), ('spectrum_size', int), ('track_start', int), ('track_size', int),
+])
+
+# what is kept of the spectrum and track of each retrieval: everything, the part around the spectrum peak, or nothing
+RETENTIONS = ('full', 'peak', 'heights')
+MERGE_EVERY = 1024  # pending retrievals merged into the arrays at a time
+BLOCKS = ('freq', 'power', 'track_az', 'track_el')  # arrays the spectra and tracks are kept end to end in
+
+# columns of the CSV and Parquet exports
+EXPORT_COLUMNS = ('time', 'system', 'prn', 'reflector_height', 'peak_amplitude', 'peak_noise', 'azimuth', 'elevation')
+
+
+def to_datetime64(value):
+    """
+    Wall clock time of a datetime (naive or aware, its time zone is dropped), date or datetime64.
+
+    :return: numpy.datetime64 in microseconds
+    """
+    if isinstance(value, datetime.datetime):
+        value = value.replace(tzinfo=None)
+    elif isinstance(value, datetime.date):
+        value = datetime.datetime.combine(value, datetime.time())
+    return np.datetime64(value, 'us')
+
+
+def slice_positions(starts, sizes):
+    """
+    Positions of the elements of several slices of an array, slice after slice.
+
+    :param starts: start of each slice
+    :param sizes: size of each slice
+    :return: (positions, end of each slice in them)
+    """
+    starts, sizes = np.asarray(starts, dtype=int), np.asarray(sizes, dtype=int)
+    ends = np.cumsum(sizes)
+    return np.arange(ends[-1] if ends.size else 0) + np.repeat(starts - (ends - sizes), sizes), ends
+
+
+def retained_spectra(power, starts, sizes, retention, points):
+    """
+    Part of each spectrum a retention policy keeps.
+
+    :param power: power of the spectra, laid end to end
+    :param starts: start of each spectrum in power
+    :param sizes: size of each spectrum
+    :param retention: one of RETENTIONS
+    :param points: number of heights kept around the peak by the 'peak' retention
+    :return: (starts, sizes) of the parts kept
+    """
+    starts, sizes = np.asarray(starts, dtype=int), np.asarray(sizes, dtype=int)
+    if retention == 'full':
+        return starts, sizes
+    if retention == 'heights':
+        return starts, np.zeros_like(sizes)
+    positions, ends = slice_positions(starts, sizes)
+    filled = sizes > 0
+    # within each spectrum, the highest power first and the first of equal ones as np.argmax
+    order = np.lexsort((-power[positions], np.repeat(np.arange(len(sizes)), sizes)))
+    peak = np.zeros_like(sizes)
+    peak[filled] = positions[order[(ends - sizes)[filled]]] - starts[filled]
+    kept = np.minimum(sizes, points)
+    return starts + np.clip(peak - points // 2, 0, sizes - kept), kept
+
+
+def retained_size(sizes, retention, points):
+    """
+    :return: number of heights of each spectrum or samples of each track a retention policy keeps
+    """
+    sizes = np.asarray(sizes, dtype=int)
+    if retention == 'full':
+        return sizes
+    return np.zeros_like(sizes) if retention == 'heights' else np.minimum(sizes, points)
+
+
+def track_samples(starts, sizes, kept):
+    """
+    Positions of evenly spaced samples of several tracks, the first and last samples included.
+
+    :param starts: start of each track
+    :param sizes: size of each track
+    :param kept: number of samples kept of each track, at most its size
+    :return: positions of the samples, track after track
+    """
+    starts, sizes, kept = (np.asarray(values, dtype=int) for values in (starts, sizes, kept))
+    steps = slice_positions(np.zeros_like(kept), kept)[0]
+    # sample k of the n kept is sample k * (size - 1) // (n - 1), every sample when n is the size
+    return np.repeat(starts, kept) + steps * np.repeat(sizes - 1, kept) // np.repeat(np.maximum(kept - 1, 1), kept)
+
+
+def gather(array, starts, sizes, kept, chunk=MERGE_EVERY):
+    """
+    Evenly spaced samples of several slices of an array, `chunk` slices at a time, so no index spans the whole array.
+
+    :param array: array the slices are laid end to end in, e.g. a memory-mapped block
+    :param starts: start of each slice
+    :param sizes: size of each slice
+    :param kept: number of samples kept of each slice, see `track_samples`, its size to keep it whole
+    :param chunk: number of slices copied at a time
+    :return: generator of the samples, one array per chunk of slices
+    """
+    for first in range(0, len(starts), chunk):
+        part = slice(first, first + chunk)
+        yield array[track_samples(starts[part], sizes[part], kept[part])]
+
+
+def map_file(path):
+    """
+    :return: read only memory map of a file of float64 values, an empty array for an empty file
+    """
+    size = Path(path).stat().st_size // np.dtype(float).itemsize
+    return np.memmap(path, dtype=float, mode='r', shape=(size,)) if size else np.zeros(0)
+
+
+class ResultsStore:
+    def __init__(self, retention='full', points=64, recent_days=0, spill_directory=None):
+        """
+        :param retention: what is kept of the spectrum and track of each retrieval, one of RETENTIONS
+        :param points: number of spectrum heights and track samples the 'peak' retention keeps
+        :param recent_days: the retrievals of the last recent_days days before the latest retrieval keep their whole
+                            spectrum and track whatever the retention
+        :param spill_directory: folder the spectra and tracks are kept in as memory-mapped files, in memory if None
+        """
+        if retention not in RETENTIONS:
+            raise ValueError("Unknown retention {!r}, expected one of {}".format(retention, RETENTIONS))
+        if points < 1:
+            raise ValueError("Invalid number of retained points {}, it must be at least 1.".format(points))
+        self.retention = retention
+        self.points = points
+        self.recent = np.timedelta64(int(recent_days * 86400 * 10**6), 'us')
+        self.spill_directory = spill_directory
+
+        self.records = np.zeros(0, dtype=record_dt)
+        self.freq = np.zeros(0)
+        self.power = np.zeros(0)
+        self.track_az = np.zeros(0)
+        self.track_el = np.zeros(0)
+
+        self._pending = []  # (record, freq, power, track az, track el) not merged into the arrays yet
+        self._time_order = None  # (record indices sorted by time, sorted times), built on the first query
+        self._azimuth_order = None  # same for the azimuths
+        self._spill = None  # folder of the memory-mapped files, created on the first merge
+        self._finalizer = None  # removes that folder once the store is gone
+
+    def __getstate__(self):
+        """
+        The arrays are sent to other processes in full, the memory-mapped files stay with this store.
+        """
+        state = self.__dict__.copy()
+        state.update((name, np.array(getattr(self, name))) for name in BLOCKS)
+        state['_spill'] = state['_finalizer'] = None
+        return state
+
+    def __len__(self):
+        return len(self.records) + len(self._pending)
+
+    def __getitem__(self, field):
+        """
+        Column of the records, e.g. store['reflector_height'].
+        """
+        self._merge()
+        return self.records[field]
+
+    def append(self, result, system, prn):
+        """
+        Add one retrieval.
+
+        :param result: dict returned by `process_gnss.process_track`
+        :param system: talker id of the satellite system
+        :param prn: PRN of the satellite
+        :return: None
+        """
+        record = (to_datetime64(result['time']), result['reflector_height'], result['peak_amplitude'],
+                  result['azimuth'], result['elevation'], result['peak_noise'], system, prn, 0, 0, 0, 0)
+        freq, power = np.asarray(result['freq'], dtype=float), np.asarray(result['power'], dtype=float)
+        track_az, track_el = np.asarray(result['track']['az'], dtype=float), np.asarray(result['track']['el'], dtype=float)
+        if not self.recent:
+            # nothing is kept in full, so only what the retention keeps is held until the merge
+            (start,), (size,) = retained_spectra(power, [0], [len(power)], self.retention, self.points)
+            freq, power = freq[start:start + size].copy(), power[start:start + size].copy()
+            kept = track_samples([0], [len(track_az)], retained_size([len(track_az)], self.retention, self.points))
+            track_az, track_el = track_az[kept], track_el[kept]
+        self._pending.append((record, freq, power, track_az, track_el))
+        if len(self._pending) >= MERGE_EVERY:
+            self._merge()
+
+    def extend(self, other):
+        """
+        Add every retrieval of another store, e.g. one filled in a worker process, after the retrievals of this one.
+
+        :param other: ResultsStore
+        :return: None
+        """
+        self._merge()
+        other._merge()
+        records = other.records.copy()
+        records['spectrum_start'] += len(self.freq)
+        records['track_start'] += len(self.track_az)
+        self.records = np.concatenate((self.records, records))
+        self._write_blocks([(getattr(other, name),) for name in BLOCKS], append=True)
+        self._time_order = self._azimuth_order = None
+        self._retain()
+
+    def _merge(self):
+        """
+        Move the pending retrievals into the arrays.
+        """
+        if not self._pending:
+            return
+        records, freq, power, track_az, track_el = zip(*self._pending)
+        self._pending = []
+
+        records = np.array(list(records), dtype=record_dt)
+        records['spectrum_size'] = [len(f) for f in freq]
+        records['spectrum_start'] = len(self.freq) + np.cumsum(records['spectrum_size']) - records['spectrum_size']
+        records['track_size'] = [len(az) for az in track_az]
+        records['track_start'] = len(self.track_az) + np.cumsum(records['track_size']) - records['track_size']
+
+        self.records = np.concatenate((self.records, records))
+        self._write_blocks((freq, power, track_az, track_el), append=True)
+        self._time_order = self._azimuth_order = None
+        self._retain()
+
+    def _write_blocks(self, blocks, append):
+        """
+        Append arrays to the spectra and track arrays, or replace them, in memory or in their memory-mapped files.
+
+        :param blocks: one sequence of arrays per name of BLOCKS, laid end to end
+        :param append: append to the current arrays if True, replace them otherwise
+        """
+        if self.spill_directory is None:
+            for name, arrays in zip(BLOCKS, blocks):
+                setattr(self, name, np.concatenate(((getattr(self, name),) if append else ()) + tuple(arrays)))
+            return
+        if self._spill is None:
+            Path(self.spill_directory).mkdir(parents=True, exist_ok=True)
+            self._spill = Path(tempfile.mkdtemp(prefix='results_', dir=self.spill_directory))
+            self._finalizer = weakref.finalize(self, shutil.rmtree, str(self._spill), True)
+            if append:
+                # the arrays held so far, e.g. after unpickling, go to the files
+                blocks = [(getattr(self, name),) + tuple(arrays) for name, arrays in zip(BLOCKS, blocks)]
+                append = False
+        for name, arrays in zip(BLOCKS, blocks):
+            path = self._spill / (name + '.f8')
+            # replaced files are written aside, so the current maps stay valid until they are swapped
+            target = path if append else path.with_suffix('.new')
+            with open(target, 'ab' if append else 'wb') as fid:
+                for array in arrays:
+                    fid.write(np.ascontiguousarray(array, dtype=float).tobytes())
+            if not append:
+                target.replace(path)
+            setattr(self, name, map_file(path))
+
+    def _retain(self):
+        """
+        Apply the retention policy to the retrievals older than the last `recent` days that hold more than it keeps.
+        What is kept of them is appended to the spectra and track arrays and only their records are updated, the
+        arrays are compacted once most of them is no longer referenced.
+        """
+        if self.retention == 'full' or len(self.records) == 0:
+            return
+        records = self.records
+        limit = self.points if self.retention == 'peak' else 0
+        changed = (records['spectrum_size'] > limit) | (records['track_size'] > limit)
+        if self.recent:
+            changed &= records['time'] < records['time'].max() - self.recent
+        changed = np.flatnonzero(changed)
+        if changed.size == 0:
+            return
+
+        aged = records[changed]
+        spectrum_start, spectrum_size = retained_spectra(self.power, aged['spectrum_start'], aged['spectrum_size'],
+                                                         self.retention, self.points)
+        track_size = retained_size(aged['track_size'], self.retention, self.points)
+        spectrum_end, track_end = len(self.freq) + np.cumsum(spectrum_size), len(self.track_az) + np.cumsum(track_size)
+        self._write_blocks((gather(self.freq, spectrum_start, spectrum_size, spectrum_size),
+                            gather(self.power, spectrum_start, spectrum_size, spectrum_size),
+                            gather(self.track_az, aged['track_start'], aged['track_size'], track_size),
+                            gather(self.track_el, aged['track_start'], aged['track_size'], track_size)), append=True)
+        records['spectrum_start'][changed] = spectrum_end - spectrum_size
+        records['spectrum_size'][changed] = spectrum_size
+        records['track_start'][changed] = track_end - track_size
+        records['track_size'][changed] = track_size
+
+        if len(self.freq) > 2 * records['spectrum_size'].sum() or len(self.track_az) > 2 * records['track_size'].sum():
+            self._compact()
+
+    def _compact(self):
+        """
+        Copy the spectra and tracks of the records end to end into new arrays, dropping what no record refers to.
+        """
+        records = self.records
+        spectrum_size, track_size = records['spectrum_size'], records['track_size']
+        self._write_blocks((gather(self.freq, records['spectrum_start'], spectrum_size, spectrum_size),
+                            gather(self.power, records['spectrum_start'], spectrum_size, spectrum_size),
+                            gather(self.track_az, records['track_start'], track_size, track_size),
+                            gather(self.track_el, records['track_start'], track_size, track_size)), append=False)
+        records['spectrum_start'] = np.cumsum(spectrum_size) - spectrum_size
+        records['track_start'] = np.cumsum(track_size) - track_size
+
+    def whole(self, indices=None):
+        """
+        Retrievals holding their whole spectrum and track: all of them with the 'full' retention, those of the last
+        `recent` days otherwise.
+
+        :param indices: optional record indices, all retrievals by default
+        :return: boolean mask of the retrievals
+        """
+        self._merge()
+        times = self.records['time'] if indices is None else self.records['time'][np.asarray(indices, dtype=int)]
+        if self.retention == 'full':
+            return np.ones(len(times), dtype=bool)
+        if not self.recent or len(times) == 0:
+            return np.zeros(len(times), dtype=bool)
+        return times >= self.records['time'].max() - self.recent
+
+    def time_order(self):
+        """
+        :return: record indices sorted by time, retrievals at the same time keep their insertion order
+        """
+        return self._time_index()[0]
+
+    def azimuth_order(self):
+        """
+        :return: record indices sorted by azimuth
+        """
+        return self._azimuth_index()[0]
+
+    def _time_index(self):
+        self._merge()
+        if self._time_order is None:
+            order = np.argsort(self.records['time'], kind='stable')
+            self._time_order = order, self.records['time'][order]
+        return self._time_order
+
+    def _azimuth_index(self):
+        self._merge()
+        if self._azimuth_order is None:
+            order = np.argsort(self.records['azimuth'], kind='stable')
+            self._azimuth_order = order, self.records['azimuth'][order]
+        return self._azimuth_order
+
+    def between(self, start=None, end=None):
+        """
+        Retrievals with start <= time < end.
+
+        :param start: datetime, date or datetime64, None for no lower limit
+        :param end: datetime, date or datetime64, None for no upper limit
+        :return: record indices in time order
+        """
+        order, times = self._time_index()
+        first = 0 if start is None else np.searchsorted(times, to_datetime64(start), side='left')
+        last = len(order) if end is None else np.searchsorted(times, to_datetime64(end), side='left')
+        return order[first:last]
+
+    def on_date(self, date):
+        """
+        Retrievals of one day.
+
+        :param date: datetime or date of the day
+        :return: record indices in time order
+        """
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+        return self.between(date, date + datetime.timedelta(days=1))
+
+    def in_sector(self, min_az, max_az, indices=None):
+        """
+        Retrievals with min_az < azimuth < max_az.
+
+        :param min_az: lower azimuth in degrees
+        :param max_az: upper azimuth in degrees
+        :param indices: optional record indices to select from, e.g. from `on_date`, kept in their order
+        :return: record indices, in azimuth order unless `indices` is given
+        """
+        if indices is not None:
+            indices = np.asarray(indices, dtype=int)
+            azimuth = self['azimuth'][indices]
+            return indices[(azimuth > min_az) & (azimuth < max_az)]
+        order, azimuths = self._azimuth_index()
+        first = np.searchsorted(azimuths, min_az, side='right')
+        last = np.searchsorted(azimuths, max_az, side='left')
+        return order[first:last]
+
+    def spectrum(self, index):
+        """
+        :return: (freq, power) of a retrieval, views into the spectra block
+        """
+        self._merge()
+        start, size = self.records['spectrum_start'][index], self.records['spectrum_size'][index]
+        return self.freq[start:start + size], self.power[start:start + size]
+
+    def track(self, index):
+        """
+        :return: dict of the 'az' and 'el' samples of a retrieval's track, views into the track block
+        """
+        self._merge()
+        start, size = self.records['track_start'][index], self.records['track_size'][index]
+        return {'az': self.track_az[start:start + size], 'el': self.track_el[start:start + size]}
+
+    def _positions(self, indices, start_field, size_field):
+        """
+        Positions of the samples of several records in the spectra or track block, record after record.
+
+        :return: (positions, end of the samples of each record in them)
+        """
+        self._merge()
+        records = self.records[np.asarray(indices, dtype=int)]
+        return slice_positions(records[start_field], records[size_field])
+
+    def spectra(self, indices):
+        """
+        Spectra of several retrievals, end to end, e.g. to draw them with a single call.
+
+        :param indices: record indices
+        :return: (freq, power, end of each retrieval's spectrum in them)
+        """
+        positions, ends = self._positions(indices, 'spectrum_start', 'spectrum_size')
+        return self.freq[positions], self.power[positions], ends
+
+    def tracks(self, indices):
+        """
+        Az/el track samples of several retrievals, end to end.
+
+        :param indices: record indices
+        :return: (az, el, end of each retrieval's track in them)
+        """
+        positions, ends = self._positions(indices, 'track_start', 'track_size')
+        return self.track_az[positions], self.track_el[positions], ends
+
+    def subset(self, indices):
+        """
+        Copy of some retrievals with their spectra and tracks, in memory, e.g. to send only them to a worker process.
+
+        :param indices: record indices
+        :return: ResultsStore with the same retention settings, without a spill folder
+        """
+        indices = np.asarray(indices, dtype=int)
+        store = ResultsStore(self.retention, self.points, self.recent / np.timedelta64(1, 'D'))
+        store.freq, store.power, spectrum_ends = self.spectra(indices)
+        store.track_az, store.track_el, track_ends = self.tracks(indices)
+        records = self.records[indices]
+        records['spectrum_start'] = spectrum_ends - records['spectrum_size']
+        records['track_start'] = track_ends - records['track_size']
+        store.records = records
+        return store
+
+    def datetimes(self, indices=None):
+        """
+        Retrieval times for display, as datetimes in TIMEZONE as returned by gps_to_nz. Queries and grouping work on
+        the datetime64 'time' column instead.
+
+        :param indices: optional record indices, all retrievals by default
+        :return: list of datetime
+        """
+        times = self['time'] if indices is None else self['time'][indices]
+        return [time.replace(tzinfo=TIMEZONE) for time in times.astype(datetime.datetime)]
+
+    def columns(self, indices=None):
+        """
+        Retrieval columns for export, in time order.
+
+        :param indices: optional record indices, all retrievals by default
+        :return: dict of column name -> array, see EXPORT_COLUMNS
+        """
+        indices = self.time_order() if indices is None else np.asarray(indices, dtype=int)
+        self._merge()
+        records = self.records[indices]
+        return {name: records[name] for name in EXPORT_COLUMNS}
+
+    def write_csv(self, path, indices=None):
+        """
+        Write the retrievals to a CSV file with a header line, times as ISO 8601 wall clock times.
+
+        :param path: file path
+        :param indices: optional record indices, all retrievals by default
+        :return: number of retrievals written
+        """
+        columns = self.columns(indices)
+        columns['time'] = np.datetime_as_string(columns['time'], unit='s')
+        with open(path, 'w', newline='') as fid:
+            writer = csv.writer(fid)
+            writer.writerow(EXPORT_COLUMNS)
+            writer.writerows(zip(*(values.tolist() for values in columns.values())))
+        return len(columns['time'])
+
+    def write_parquet(self, path, indices=None):
+        """
+        Write the retrievals to a Parquet file, which needs pyarrow.
+
+        :param path: file path
+        :param indices: optional record indices, all retrievals by default
+        :return: number of retrievals written
+        """
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Writing Parquet files needs pyarrow, install it with 'pip install pyarrow'") from None
+        columns = self.columns(indices)
+        pyarrow.parquet.write_table(pyarrow.table(columns), path)
+        return len(columns['time'])
+
+    def save(self, path):
+        """
+        Save the retrievals and the retention settings to a .npz file.
+
+        :param path: file path
+        :return: None
+        """
+        self._merge()
+        np.savez(path, records=self.records, freq=self.freq, power=self.power, track_az=self.track_az,
+                 track_el=self.track_el, retention=self.retention, points=self.points,
+                 recent_days=self.recent / np.timedelta64(1, 'D'), spill_directory=str(self.spill_directory or ''))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load retrievals saved by `save`, with the retention settings they were saved with. Files saved without them
+        load with the default settings.
+
+        :param path: file path
+        :return: ResultsStore
+        """
+        with np.load(path) as saved:
+            if 'retention' in saved.files:
+                store = cls(str(saved['retention']), int(saved['points']), float(saved['recent_days']),
+                            str(saved['spill_directory']) or None)
+            else:
+                store = cls()
+            store.records = saved['records']
+            store.freq = saved['freq']
+            store.power = saved['power']
+            store.track_az = saved['track_az']
+            store.track_el = saved['track_el']
+        return store
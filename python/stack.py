@@ -0,0 +1,219 @@
+"""
+Spectral stacking: one reflector height per time window and azimuth sector from the average of the periodograms of
+its retrievals.
+
+The spectra of the retrievals are interpolated onto a shared reflector height grid and averaged per group, the groups
+being those of aggregate.bin_groups: each time window and sector, and each time window for all the sectors together.
+The peak of the stacked spectrum is picked as for a single track, above the minimum reflector height. Noise that is
+not common to the tracks averages out in the stack, so its peak is steadier than the heights of the single tracks.
+
+The spectra are read straight from the contiguous spectra block of the ResultsStore and interpolated a chunk of spectra
+at a time with a single np.interp call, then summed per group with np.add.reduceat, so memory stays bounded by the
+chunk.
+Only the retrievals keep their spectrum in the store, so the stack is made of the tracks passing the quality gates.
+Stacking needs whole spectra: with the 'peak' or 'heights' retention only the retrievals of the last `recent_days` days
+are stacked.
+
+usage
+    >>> rows, grid, stacked = stack_heights(processor, '6h')
+"""
+import csv
+
+import numpy as np
+
+from aggregate import bin_groups, bin_width
+
+STACK_CHUNK = 256  # spectra interpolated at a time
+
+stack_dt = np.dtype([
+    ('time', 'datetime64[us]'), ('sector', int), ('count', int), ('reflector_height', float),
+    ('peak_amplitude', float), ('peak_noise', float),
+])
+
+
+def height_grid(max_height, step):
+    """
+    :param max_height: highest reflector height in meters
+    :param step: grid spacing in meters
+    :return: reflector heights from 0 to max_height
+    """
+    return np.arange(int(round(max_height / step)) + 1) * step
+
+
+def covered_range(freq, starts, sizes, grid):
+    """
+    Grid heights within the heights of each spectrum.
+
+    :param freq: reflector heights of the spectra, increasing within each spectrum
+    :param starts: start of each spectrum in freq
+    :param sizes: size of each spectrum
+    :param grid: shared reflector height grid
+    :return: (first, last + 1) grid index covered by each spectrum, equal for empty spectra
+    """
+    if len(freq) == 0:
+        # no spectrum holds any height, e.g. under the 'heights' retention
+        empty = np.zeros(len(sizes), dtype=int)
+        return empty, empty
+    filled = sizes > 0
+    last = len(freq) - 1
+    low = np.searchsorted(grid, np.where(filled, freq[np.minimum(starts, last)], np.inf), 'left')
+    high = np.searchsorted(grid, np.where(filled, freq[np.clip(starts + sizes - 1, 0, last)], -np.inf), 'right')
+    return low, np.maximum(high, low)
+
+
+def interpolate_spectra(freq, power, starts, sizes, grid):
+    """
+    Interpolate spectra onto a shared grid, with one np.interp call.
+
+    :param freq: reflector heights of the spectra, increasing within each spectrum, e.g. ResultsStore.freq
+    :param power: power of the spectra, e.g. ResultsStore.power
+    :param starts: start of each spectrum in freq and power
+    :param sizes: size of each spectrum
+    :param grid: shared reflector height grid
+    :return: (n spectra, n grid) array of the interpolated power, 0 outside the heights of each spectrum
+    """
+    filled = sizes > 0
+    if not filled.any():
+        return np.zeros((len(sizes), len(grid)))
+    ends = np.cumsum(sizes)
+    positions = np.arange(ends[-1]) + np.repeat(starts - (ends - sizes), sizes)
+    freq, power = freq[positions], power[positions]
+    starts = ends - sizes
+
+    # each spectrum on its own stretch of the key axis, far enough apart for none to reach the next one
+    span = max(freq.max(), grid[-1]) - min(freq.min(), grid[0]) + 2
+    offsets = np.arange(len(sizes)) * span
+    # a zero on the last grid height before and the first one after each spectrum, so the power is 0 outside of it
+    low, high = covered_range(freq, starts, sizes, grid)
+    padded = np.append(grid, grid[-1] + 1)
+    before = np.where(low > 0, padded[low - 1], freq[np.minimum(starts, len(freq) - 1)] - 1) + offsets
+    after = np.where(high < len(grid), padded[high], freq[np.maximum(ends - 1, 0)] + 1) + offsets
+    # the zeros after a spectrum are listed first, to go before the zeros of the next one at the same position
+    zeros = np.concatenate((ends[filled], starts[filled]))
+    keys = np.insert(freq + np.repeat(offsets, sizes), zeros, np.concatenate((after[filled], before[filled])))
+    return np.interp(grid + offsets[:, None], keys, np.insert(power, zeros, 0))
+
+
+def stack_spectra(freq, power, starts, sizes, groups, n_groups, grid, chunk=STACK_CHUNK):
+    """
+    Average power of the spectra of each group on a shared grid.
+
+    :param freq: reflector heights of the spectra, e.g. ResultsStore.freq
+    :param power: power of the spectra, e.g. ResultsStore.power
+    :param starts: start of each spectrum in freq and power
+    :param sizes: size of each spectrum
+    :param groups: group of each spectrum, 0 to n_groups - 1
+    :param n_groups: number of groups
+    :param grid: shared reflector height grid
+    :param chunk: number of spectra interpolated at a time
+    :return: (n_groups, n grid) average power, NaN where no spectrum of the group covers the height
+    """
+    starts, sizes = np.asarray(starts), np.asarray(sizes)
+    order = np.argsort(groups, kind='stable')
+    total = np.zeros((n_groups, len(grid)))
+    for first in range(0, len(order), chunk):
+        members = order[first:first + chunk]
+        values = interpolate_spectra(freq, power, starts[members], sizes[members], grid)
+        # the members are sorted by group, so each group of the chunk is one run of rows
+        member_groups = groups[members]
+        runs = np.flatnonzero(np.diff(member_groups, prepend=-1))
+        total[member_groups[runs]] += np.add.reduceat(values, runs)
+    # number of spectra covering each grid height, from +1 at the first and -1 after the last height of each spectrum
+    low, high = covered_range(freq, starts, sizes, grid)
+    covered = np.zeros((n_groups, len(grid) + 1))
+    np.add.at(covered, (groups, low), 1)
+    np.add.at(covered, (groups, high), -1)
+    covered = np.cumsum(covered[:, :-1], axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / np.where(covered > 0, covered, np.nan)
+
+
+def stack_peaks(grid, stacked, min_rh, noise_range):
+    """
+    Peak of each stacked spectrum above the minimum reflector height, and its peak to noise ratio as `peak2noise`.
+
+    :param grid: shared reflector height grid
+    :param stacked: stacked spectra, one per row
+    :param min_rh: minimum reflector height in meters
+    :param noise_range: (high, low), the power above high or below low is the noise
+    :return: (reflector heights, peak amplitudes, peak to noise ratios), NaN for empty stacks
+    """
+    searched = np.where(grid > min_rh, stacked, np.nan)
+    empty = np.isnan(searched).all(axis=1)
+    peak = np.argmax(np.where(np.isnan(searched), -np.inf, searched), axis=1)
+    amplitude = np.where(empty, np.nan, searched[np.arange(len(stacked)), peak])
+    noise = np.where((grid > noise_range[0]) | (grid < noise_range[1]), stacked, np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        noise = np.nansum(noise, axis=1) / np.sum(~np.isnan(noise), axis=1)
+        return np.where(empty, np.nan, grid[peak]), amplitude, amplitude / noise
+
+
+def stack_store(store, width, azimuth_bins, grid, min_rh, noise_range, indices=None):
+    """
+    Stack the spectra of the retrievals of a store per time window and sector. The retrievals whose spectrum was
+    reduced by the retention policy of the store (see ResultsStore.whole) are left out, with a warning.
+
+    :param store: ResultsStore
+    :param width: time window width, see aggregate.bin_width
+    :param azimuth_bins: list of (min, max) azimuth ranges in degrees
+    :param grid: shared reflector height grid
+    :param min_rh: minimum reflector height of the stacked peaks in meters
+    :param noise_range: see `stack_peaks`
+    :param indices: optional record indices, all retrievals by default
+    :return: (stack_dt array sorted by time then sector with ALL_SECTORS first, stacked spectra, one row per stack)
+    """
+    indices = np.arange(len(store)) if indices is None else np.asarray(indices, dtype=int)
+    whole = store.whole(indices)
+    if not whole.all():
+        print("Warning: {} of {} retrievals are left out of the stacks, the {!r} retention kept only part of their "
+              "spectra.".format(np.count_nonzero(~whole), len(indices), store.retention))
+        indices = indices[whole]
+    members, groups, times, sectors = bin_groups(store['time'][indices], store['azimuth'][indices], bin_width(width),
+                                                 azimuth_bins)
+    members = indices[members]
+    stacked = stack_spectra(store.freq, store.power, store['spectrum_start'][members], store['spectrum_size'][members],
+                            groups, len(times), grid)
+
+    rows = np.zeros(len(times), dtype=stack_dt)
+    rows['time'] = times
+    rows['sector'] = sectors
+    rows['count'] = np.bincount(groups, minlength=len(times))
+    rows['reflector_height'], rows['peak_amplitude'], rows['peak_noise'] = stack_peaks(grid, stacked, min_rh,
+                                                                                        noise_range)
+    return rows, stacked
+
+
+def stack_heights(processor, width):
+    """
+    Stacked reflector heights of the retrievals of a processor, on a grid of its max_height and desired_precision and
+    with its azimuth bins, minimum reflector height and noise range.
+
+    :param processor: GNSSProcessor
+    :param width: time window width, see aggregate.bin_width
+    :return: (stack_dt array, reflector height grid, stacked spectra)
+    """
+    from process_gnss import NOISE_RANGE
+    grid = height_grid(processor.max_height, processor.desired_precision)
+    rows, stacked = stack_store(processor.store, width, processor.azimuth_bins, grid, processor.min_rh, NOISE_RANGE)
+    return rows, grid, stacked
+
+
+def write_csv(rows, path, azimuth_bins):
+    """
+    Write stacked heights to a CSV file with a header line, window start times as ISO 8601 wall clock times. The rows of
+    all the sectors together have sector -1 and azimuths 0 to 360.
+
+    :param rows: stack_dt array
+    :param path: file path
+    :param azimuth_bins: list of (min, max) azimuth ranges of the sectors
+    :return: number of rows written
+    """
+    ranges = np.array(list(azimuth_bins) + [(0, 360)], dtype=float)[rows['sector']]
+    columns = {'time': np.datetime_as_string(rows['time'], unit='s'), 'sector': rows['sector'],
+               'azimuth_min': ranges[:, 0], 'azimuth_max': ranges[:, 1]}
+    columns.update((name, rows[name]) for name in stack_dt.names[2:])
+    with open(path, 'w', newline='') as fid:
+        writer = csv.writer(fid)
+        writer.writerow(columns)
+        writer.writerows(zip(*(values.tolist() for values in columns.values())))
+    return len(rows)
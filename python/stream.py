@@ -0,0 +1,275 @@
+"""
+Streaming processing of GNSS logs as they are written.
+
+`StreamProcessor` consumes NMEA lines one at a time, with the same sentence rules as `readGNSS`, and keeps the samples
+of every satellite inside the elevation window in a rolling arc. When a satellite leaves the window, or stops being
+reported, its arc is closed and processed with `process_track` straight away, so a reflector height is available
+minutes after the satellite set or rose instead of after a rerun over the whole file.
+
+usage - from the python folder
+        python stream.py ../data/25052202.LOG            # tail a log, printing retrievals as arcs close
+        python stream.py ../data/25052202.LOG --no-follow  # process what the log holds and stop
+"""
+import argparse
+import math
+import os
+import string
+import time
+
+import numpy as np
+
+from arcs import MAX_GAP, split_arcs
+from gnss_systems import SYSTEMS, ALL_SYSTEMS, gsv_heads
+from process_gnss import GNSSProcessor, process_track
+from readGPS import dt, interp_elevation, _to_float
+from utils import epoch_seconds
+
+# degrees kept on each side of the elevation window, so the elevation interpolation of an arc has samples past its
+# edges
+WINDOW_MARGIN = 1
+
+
+def follow(path, poll=1.0, idle_timeout=None):
+    """
+    Yield the lines of a file as they are written, like `tail -f`. A line is yielded once its newline is written, and
+    the file is read again from the start if it gets truncated.
+
+    :param path: path to the log file
+    :param poll: seconds to wait before checking for new data at the end of the file
+    :param idle_timeout: stop after this many seconds without new data, None to follow forever and 0 to stop at the
+                         end of the file
+    :return: generator of lines without their line ending
+    """
+    partial = ''
+    with open(path, 'r') as fid:
+        idle = 0.0
+        while True:
+            line = fid.readline()
+            if line:
+                idle = 0.0
+                partial += line
+                if partial.endswith('\n'):
+                    yield partial.rstrip()
+                    partial = ''
+                continue
+
+            if os.path.getsize(path) < fid.tell():
+                fid.seek(0)
+                partial = ''
+                continue
+            if idle_timeout is not None and idle >= idle_timeout:
+                return
+            time.sleep(poll)
+            idle += poll
+
+
+def _checksum_ok(sentence):
+    """
+    :param sentence: NMEA sentence without its line ending
+    :return: True if the two hexadecimal digits after '*' are the XOR of every character between the leading '$' and
+             the '*', as nmea_bytes.checksums_ok
+    """
+    body, star, given = sentence.partition('*')
+    if not star or len(given) != 2 or any(c not in string.hexdigits for c in given):
+        return False
+    value = 0
+    for byte in body[1:].encode() if body.startswith('$') else body.encode():
+        value ^= byte
+    return int(given, 16) == value
+
+
+class StreamProcessor:
+    def __init__(self, processor, systems=ALL_SYSTEMS, validate=True):
+        """
+        :param processor: GNSSProcessor giving the processing parameters and storing the retrievals
+        :param systems: NMEA talker ids of the constellations to process
+        :param validate: if True, the observations of GSV sentences with a missing or wrong checksum are skipped, as
+                         readGNSS does
+        """
+        self.processor = processor
+        self.validate = validate
+        self.params = processor.track_params()
+        self.systems = tuple(systems)
+        self.heads = gsv_heads(self.systems)
+        self.low = processor.emin - WINDOW_MARGIN
+        self.high = processor.emax + WINDOW_MARGIN
+
+        # sentence state, as in readGNSS
+        self.new_block = False
+        self.gsv_open = None
+        self.gsv_done = False
+        self.block_count = 0
+        self.hms = (0, 0, 0)
+        self.time_float = 0.0
+
+        # observations of the current block as (system index, prn, el, az, snr), time stamped by the next RMC
+        self.pending = []
+        # (system index, prn) -> list of rows of the open arc, and seconds of its last sample
+        self.arcs = {}
+        self.last_seen = {}
+
+    def feed(self, line):
+        """
+        Consume one NMEA line.
+
+        :param line: sentence, with or without its line ending
+        :return: list of retrievals of the arcs closed by this line, see `close_arc`
+        """
+        line = line.rstrip()
+        head = line[:6]
+
+        system = self.heads.get(head)
+        if system is not None:
+            self._read_gsv(line, head, system)
+            return []
+
+        self.gsv_open = None
+        if head == "$GNGGA" or head == "$GPGGA":
+            self.new_block = True
+            self.time_float = float(line.split(',')[1])
+            hour = math.floor(self.time_float/10000)
+            minute = math.floor((self.time_float - hour * 10000)/100)
+            second = round(self.time_float - math.floor(self.time_float/100)*100)
+            self.hms = (hour, minute, second)
+
+        elif head == "$GNRMC" or head == "$GPRMC":
+            stamp = line.split(',')[9]
+            date = (2000 + int(stamp[4:6])) * 10000 + int(stamp[2:4]) * 100 + int(stamp[:2])
+            retrievals = self._end_block(date)
+            self.hms = (0, 0, 0)
+            self.block_count += 1
+            self.new_block = False
+            return retrievals
+        return []
+
+    def run(self, lines):
+        """
+        Consume lines, e.g. from `follow`, yielding each retrieval as soon as its arc closes. The arcs still open when
+        the lines run out are closed at the end.
+
+        :param lines: iterable of NMEA lines
+        :return: generator of retrievals, see `close_arc`
+        """
+        for line in lines:
+            yield from self.feed(line)
+        yield from self.flush()
+
+    def flush(self):
+        """
+        Close every open arc. The observations of a block not yet followed by an RMC sentence are dropped, as their
+        date is not known.
+
+        :return: list of retrievals
+        """
+        self.pending = []
+        return [retrieval for key in list(self.arcs) for retrieval in self.close_arc(key)]
+
+    def close_arc(self, key):
+        """
+        Process the samples of an arc and store its retrieval in the processor, if it gives one.
+
+        :param key: (system index, prn) of the satellite
+        :return: list of the retrieval dicts of `process_track` with 'system' and 'prn' added, one per arc of
+                 `arcs.split_arcs` when the processor segments arcs and at most one otherwise
+        """
+        rows = self.arcs.pop(key)
+        del self.last_seen[key]
+        system, prn = self.systems[key[0]], key[1]
+
+        arc = np.array(rows, dtype=dt)
+        interp_elevation(arc)
+        # the arc may still turn over at the top of the window, or cross azimuth bins
+        arcs = split_arcs(arc, self.processor.azimuth_bins) if self.processor.segment_arcs else [arc]
+        retrievals = []
+        for arc in arcs:
+            result = process_track(arc, SYSTEMS[system][2], self.params)
+            if result is None:
+                continue
+            self.processor.add_retrieval(result, system, prn)
+            result['system'] = system
+            result['prn'] = prn
+            retrievals.append(result)
+        return retrievals
+
+    def _read_gsv(self, line, head, system):
+        """
+        Keep the observations of a GSV sentence, with the group rules of readGNSS.
+        """
+        if not self.new_block:
+            return
+        data = line.split(',')
+        num_messages = int(data[1])
+        message_number = int(data[2])
+        if self.gsv_open != head:
+            if message_number != 1:
+                self.gsv_open = None
+                return
+            self.gsv_done = False
+        self.gsv_open = head if message_number < num_messages else None
+        if self.gsv_done:
+            return
+
+        index, signal, prn_min, prn_max = system
+        if (len(data) - 4) % 4 == 1:  # trailing signal id
+            signal_id = data[-1].split('*')[0]
+            if signal_id and int(signal_id, 16) != signal:
+                return
+
+        # a sentence failing its checksum still ends its group when short, only its observations are dropped
+        keep = not self.validate or _checksum_ok(line)
+        for k in (4, 8, 12, 16):
+            if k >= len(data):
+                break
+            field = data[k]
+            if "*" in field:
+                self.gsv_done = True
+                break
+            if keep and field.isdigit() and prn_min <= int(field) <= prn_max:
+                self.pending.append((index, int(field), _to_float(data[k + 1]), _to_float(data[k + 2]),
+                                     _to_float(data[k + 3].split('*')[0])))
+
+    def _end_block(self, date):
+        """
+        Date and time stamp the observations of the block ended by an RMC sentence, add them to the arcs of their
+        satellites and close the arcs that left the elevation window or went silent.
+        """
+        utc = self.hms[0] * 3600 + self.hms[1] * 60 + self.hms[2]
+        now = float(epoch_seconds(date, utc))
+        if np.isnan(now):
+            self.pending = []
+            return []
+
+        retrievals = []
+        count = self.block_count
+        for index, prn, el, az, snr in self.pending:
+            key = (index, prn)
+            if key in self.arcs and now - self.last_seen[key] > MAX_GAP:
+                retrievals += self.close_arc(key)
+            if np.isnan(el):
+                continue
+            if self.low <= el <= self.high:
+                self.arcs.setdefault(key, []).append((count, el, az, snr, utc, date))
+                self.last_seen[key] = now
+            elif key in self.arcs:
+                retrievals += self.close_arc(key)
+        self.pending = []
+
+        for key in [key for key, seen in self.last_seen.items() if now - seen > MAX_GAP]:
+            retrievals += self.close_arc(key)
+        return retrievals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process a GNSS log as it is written.")
+    parser.add_argument("file", help="LOG file to follow")
+    parser.add_argument("--poll", type=float, default=1.0, help="seconds between checks for new data")
+    parser.add_argument("--no-follow", action="store_true", help="stop at the end of the file")
+    args = parser.parse_args()
+
+    azimuth_bins = [(0, 90), (90, 180), (180, 270), (270, 360)]
+    stream = StreamProcessor(GNSSProcessor(azimuth_bins))
+    lines = follow(args.file, args.poll, idle_timeout=0 if args.no_follow else None)
+    for retrieval in stream.run(lines):
+        print("{} {}{:02d}  height {:.3f} m  azimuth {:.1f}  peak/noise {:.1f}".format(
+            np.datetime_as_string(retrieval['time'], unit='s').replace('T', ' '), retrieval['system'], retrieval['prn'],
+            retrieval['reflector_height'], retrieval['azimuth'], retrieval['peak_noise']))
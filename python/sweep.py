@@ -0,0 +1,324 @@
+"""
+Parameter sweeps.
+
+Tuning the processing parameters for a new site means processing the same logs with many parameter sets. `sweep`
+parses each log once and evaluates every parameter set on it, sharing the intermediate products of the sets whose
+upstream parameters match:
+
+    - the samples inside the elevation window and azimuth bins, keyed by WINDOW_PARAMS,
+    - the linear SNR of each track, shared by every set,
+    - the detrended track, keyed by WINDOW_PARAMS and DETREND_PARAMS,
+    - the periodogram and its peak, keyed by WINDOW_PARAMS, DETREND_PARAMS and SPECTRUM_PARAMS.
+
+Only the quality gates, which are cheap, are checked for every set. With `prefilter = on`, the fast periodogram the
+tracks are screened with is shared in the same way, and the exact periodogram is only computed for the tracks some set
+needs it for. The retrievals of each set are those `GNSSProcessor.process_gnss` finds with the same parameters.
+
+The logs are processed in parallel as in batch.process_files. When there are fewer logs than workers, the parameter
+sets of a log are also split between workers, keeping the sets that share a detrended track together.
+
+usage - from the python folder
+        python sweep.py ../sample_data/farm/*.LOG -p pvf 2 3 -p snr_thresh 33 36 -p pcrit 3.5 4.1 -o sweep.csv
+
+    >>> from sweep import parameter_grid, sweep, write_table
+    >>> grid = parameter_grid(pvf=[2, 3], snr_thresh=[33, 36], pcrit=[3.5, 4.1], min_el=[5, 6])
+    >>> rows = sweep(["../sample_data/farm/25052202.LOG"], grid)
+    >>> write_table(rows, "sweep.csv")
+"""
+import csv
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+from arcs import split_tracks
+from cache import config_cache
+from gnss_systems import wavelengths
+from process_gnss import (GNSSProcessor, TRACK_PARAMS, PREFILTER_MODES, window_samples, window_gate, detrend_samples,
+                          prefilter, screen_peak, track_spectrum, height_gate, retrieval)
+from readGPS import readGNSS
+
+# parameters each shared product depends on, the other TRACK_PARAMS only gate the retrievals
+WINDOW_PARAMS = ('azimuth_bins', 'emin', 'emax')
+DETREND_PARAMS = ('av_time', 'snr_thresh', 'pvf')
+SPECTRUM_PARAMS = ('max_height', 'desired_precision', 'lomb_method', 'peak_search')
+# names of the elevation limits as GNSSProcessor takes them
+PARAM_ALIASES = {'min_el': 'emin', 'max_el': 'emax'}
+# height statistics of each row of the sweep table
+STAT_COLUMNS = ('retrievals', 'height_mean', 'height_median', 'height_std', 'height_min', 'height_max',
+                'peak_noise_median')
+
+
+def parameter_grid(**values):
+    """
+    Every combination of parameter values.
+
+    :param values: parameter name -> list of values, e.g. pvf=[2, 3], azimuth_bins=[[(0, 360)], [(90, 270)]]
+    :return: list of dicts of parameter name -> value
+    """
+    names = list(values)
+    return [dict(zip(names, combination)) for combination in itertools.product(*values.values())]
+
+
+def _key(value):
+    """
+    Hashable form of a parameter value, azimuth bins are lists of pairs.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(_key(v) for v in value)
+    return value
+
+
+def track_params(processor, overrides):
+    """
+    Processing parameters of one parameter set.
+
+    :param processor: GNSSProcessor giving the parameters that are not swept
+    :param overrides: dict of parameter name -> value, names of TRACK_PARAMS or of PARAM_ALIASES
+    :return: dict of parameter name -> value, as GNSSProcessor.track_params
+    """
+    params = processor.track_params()
+    for name, value in overrides.items():
+        name = PARAM_ALIASES.get(name, name)
+        if name not in TRACK_PARAMS:
+            raise ValueError("Unknown parameter {!r}, expected one of {}".format(name, TRACK_PARAMS + tuple(
+                PARAM_ALIASES)))
+        params[name] = value
+    return params
+
+
+def sweep_observations(gnss_data, satellites, param_sets, segment_arcs=False):
+    """
+    Retrievals of every parameter set on the observations of one log.
+
+    :param gnss_data: tracks read by `readGNSS`
+    :param satellites: satellite table of the tracks
+    :param param_sets: list of processing parameter dicts, see `track_params`
+    :param segment_arcs: split the tracks into arcs in the azimuth bins of each set, see GNSSProcessor
+    :return: list with, for each parameter set, a dict of the 'reflector_height', 'peak_noise', 'peak_amplitude' and
+             'time' arrays of its retrievals
+    """
+    carrier = wavelengths(satellites)
+    candidates = {}  # azimuth bins -> (tracks, carrier wavelengths)
+    windows, detrended, screens, spectra, linear = {}, {}, {}, {}, {}
+    results = []
+    for params in param_sets:
+        if params['prefilter'] not in PREFILTER_MODES:
+            raise ValueError("Unknown prefilter mode {!r}, expected one of {}".format(params['prefilter'],
+                                                                                   PREFILTER_MODES))
+        bins = _key(params['azimuth_bins'])
+        if bins not in candidates:
+            if segment_arcs:
+                tracks, _, track_carrier = split_tracks(gnss_data, satellites, carrier, params['azimuth_bins'])
+                candidates[bins] = tracks, track_carrier
+            else:
+                candidates.setdefault(None, (gnss_data, carrier))
+                candidates[bins] = candidates[None]
+        tracks, track_carrier = candidates[bins]
+        # tracks only differ between azimuth bins when they are split into arcs
+        tracks_key = bins if segment_arcs else None
+        window_key = tuple(_key(params[name]) for name in WINDOW_PARAMS)
+        detrend_key = window_key + tuple(params[name] for name in DETREND_PARAMS)
+        spectrum_key = detrend_key + tuple(params[name] for name in SPECTRUM_PARAMS)
+
+        found = []
+        for n, (group, cf) in enumerate(zip(tracks, track_carrier)):
+            if group.size == 0:
+                continue
+            i = windows.get((n,) + window_key)
+            if i is None:
+                i = windows[(n,) + window_key] = window_samples(group, params)
+            if window_gate(group, i, params) is not None:
+                continue
+            if (n,) + detrend_key not in detrended:
+                if (tracks_key, n) not in linear:
+                    linear[tracks_key, n] = 10**(group['snr'] / 20)
+                detrended[(n,) + detrend_key] = detrend_samples(group, i, params, linear[tracks_key, n])
+            track = detrended[(n,) + detrend_key]
+            if track is None:
+                continue
+            key = (n,) + spectrum_key
+
+            def screen(track, cf, params):
+                if key not in screens:
+                    screens[key] = screen_peak(track, cf, params)
+                return screens[key]
+            # in verify mode process_gnss keeps every retrieval, as with the prefilter off
+            if params['prefilter'] == 'on' and prefilter(track, cf, params, screen) is not None:
+                continue
+            if key not in spectra:
+                spectra[key] = track_spectrum(track, cf, params)
+            spectrum = spectra[key]
+            if height_gate(track, spectrum, params) is not None:
+                continue
+            found.append(retrieval(group, track, spectrum))
+        results.append({name: np.array([result[name] for result in found], dtype=dtype) for name, dtype in (
+            ('reflector_height', float), ('peak_noise', float), ('peak_amplitude', float),
+            ('time', 'datetime64[us]'))})
+    return results
+
+
+def sweep_file(file, param_sets, segment_arcs=False, cache=None):
+    """
+    Parse one log and evaluate every parameter set on it, see `sweep_observations`.
+
+    :param file: path to the .LOG file
+    :param param_sets: list of processing parameter dicts
+    :param segment_arcs: split the tracks into arcs, see GNSSProcessor
+    :param cache: optional ObservationCache the parsed observations are read from and stored in
+    :return: list of the retrieval arrays of each parameter set
+    """
+    if cache is None:
+        gnss_data, satellites = readGNSS(file, True)
+    else:
+        gnss_data, satellites = cache.read(file, True)
+    return sweep_observations(gnss_data, satellites, param_sets, segment_arcs)
+
+
+def split_sets(param_sets, chunks):
+    """
+    Split parameter sets between workers, the sets sharing a detrended track staying together.
+
+    :param param_sets: list of processing parameter dicts
+    :param chunks: number of chunks wanted
+    :return: list of lists of indices into param_sets
+    """
+    groups = {}
+    for n, params in enumerate(param_sets):
+        key = tuple(_key(params[name]) for name in WINDOW_PARAMS + DETREND_PARAMS)
+        groups.setdefault(key, []).append(n)
+    groups = sorted(groups.values(), key=len, reverse=True)
+    chunks = [[] for _ in range(min(chunks, len(groups)))]
+    for group in groups:
+        min(chunks, key=len).extend(group)
+    return [sorted(chunk) for chunk in chunks]
+
+
+def height_stats(results):
+    """
+    Retrieval count and reflector height statistics of one parameter set.
+
+    :param results: dict of retrieval arrays, as returned by `sweep_observations`
+    :return: dict of STAT_COLUMNS -> value, NaN for the statistics of a set without retrievals
+    """
+    heights = results['reflector_height']
+    if heights.size == 0:
+        return dict.fromkeys(STAT_COLUMNS, np.nan) | {'retrievals': 0}
+    return {
+        'retrievals': int(heights.size),
+        'height_mean': float(np.mean(heights)),
+        'height_median': float(np.median(heights)),
+        'height_std': float(np.std(heights)),
+        'height_min': float(np.min(heights)),
+        'height_max': float(np.max(heights)),
+        'peak_noise_median': float(np.median(results['peak_noise'])),
+    }
+
+
+def sweep(files, grid, azimuth_bins=((0, 90), (90, 180), (180, 270), (270, 360)), workers=0, config_path=None):
+    """
+    Process log files with every parameter set of a grid.
+
+    :param files: paths to the .LOG files
+    :param grid: list of dicts of parameter name -> value, e.g. from `parameter_grid`. Names are those of
+                 TRACK_PARAMS, or min_el and max_el for the elevation limits, the other parameters are taken from the
+                 configuration file
+    :param azimuth_bins: azimuth bins of the parameter sets that do not set azimuth_bins
+    :param workers: number of worker processes, 0 uses every core and 1 runs in this process
+    :param config_path: configuration file, see GNSSProcessor
+    :return: list of dicts, one row per parameter set in grid order, holding the parameters of the set followed by
+             STAT_COLUMNS over all the files
+    """
+    processor = GNSSProcessor(list(azimuth_bins), config_path=config_path)
+    param_sets = [track_params(processor, overrides) for overrides in grid]
+    cache = config_cache(processor.config)
+    if workers == 0:
+        workers = os.cpu_count() or 1
+
+    # one task per file, or per file and chunk of the parameter sets when there are fewer files than workers
+    chunks = split_sets(param_sets, -(-workers // len(files))) if files and workers > len(files) else [
+        list(range(len(param_sets)))]
+    tasks = [(file, chunk) for file in files for chunk in chunks]
+    if len(chunks) > 1 and cache is not None:
+        # parse each file once, the workers of its chunks read it from the cache
+        for file in files:
+            cache.read(file, True)
+
+    task_sets = [[param_sets[n] for n in chunk] for _, chunk in tasks]
+    task_files = [file for file, _ in tasks]
+    if min(workers, len(tasks)) <= 1:
+        outputs = map(sweep_file, task_files, task_sets, repeat(processor.segment_arcs), repeat(cache))
+        outputs = list(outputs)
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            outputs = list(pool.map(sweep_file, task_files, task_sets, repeat(processor.segment_arcs),
+                                    repeat(cache)))
+
+    # gather the retrievals of each parameter set over the files
+    per_set = [[] for _ in param_sets]
+    for (_, chunk), output in zip(tasks, outputs):
+        for n, results in zip(chunk, output):
+            per_set[n].append(results)
+    rows = []
+    for overrides, results in zip(grid, per_set):
+        merged = {name: np.concatenate([r[name] for r in results]) for name in results[0]} if results else {
+            'reflector_height': np.zeros(0), 'peak_noise': np.zeros(0)}
+        rows.append(dict(overrides) | height_stats(merged))
+    return rows
+
+
+def write_table(rows, path):
+    """
+    Write the rows of `sweep` to a CSV file with a header line.
+
+    :param rows: list of dicts returned by `sweep`
+    :param path: file path
+    :return: None
+    """
+    columns = list(dict.fromkeys(name for row in rows for name in row))
+    with open(path, 'w', newline='') as fid:
+        writer = csv.DictWriter(fid, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _value(text):
+    """
+    Parameter value of the command line: int, float or str.
+    """
+    for parse in (int, float):
+        try:
+            return parse(text)
+        except ValueError:
+            pass
+    return text
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Process GNSS logs with every combination of parameter values.")
+    parser.add_argument("files", nargs="+", help="LOG files")
+    parser.add_argument("-p", "--param", nargs="+", action="append", default=[], metavar=("NAME", "VALUE"),
+                        help="parameter and its values, e.g. -p pvf 2 3, repeat for several parameters")
+    parser.add_argument("--azimuth", nargs=2, type=float, action="append", metavar=("MIN", "MAX"),
+                        help="azimuth range in degrees, repeat for several ranges (default 4 bins of 90 degrees)")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes, 0 uses every core")
+    parser.add_argument("--config", default=None, help="configuration file (default config.ini)")
+    parser.add_argument("-o", "--output", default=None, help="CSV file the table is written to")
+    args = parser.parse_args()
+    if any(len(values) < 2 for values in args.param):
+        parser.error("--param needs a name and at least one value")
+
+    grid = parameter_grid(**{values[0]: [_value(v) for v in values[1:]] for values in args.param})
+    bins = [tuple(r) for r in args.azimuth] if args.azimuth else [(0, 90), (90, 180), (180, 270), (270, 360)]
+    rows = sweep(args.files, grid, bins, args.workers, args.config)
+    columns = list(rows[0])
+    print("  ".join("{:>14}".format(name) for name in columns))
+    for row in rows:
+        print("  ".join("{:>14.4g}".format(v) if isinstance(v, float) else "{:>14}".format(v) for v in row.values()))
+    if args.output:
+        write_table(rows, args.output)
+        print("Sweep table written to", args.output)
@@ -0,0 +1,129 @@
+"""
+Synthetic GNSS logs for benchmarks.
+
+The logs follow the sentences written by the station logger (RMC, VTG, GGA, the GSV sentences of each constellation,
+GLL, then blank lines), one block per epoch. Each satellite makes repeated passes over the station, and its SNR holds
+the interference pattern of a flat reflector `height` meters below the antenna, so the logs give retrievals.
+
+usage - from the python folder
+        python synthetic.py ../data/synthetic.LOG --days 1 --rate 5
+"""
+import argparse
+import datetime
+from functools import reduce
+from operator import xor
+
+import numpy as np
+
+from gnss_systems import SYSTEMS
+
+DEFAULT_SATELLITES = {'GP': 32, 'GL': 24, 'GA': 30, 'GB': 30}
+START = datetime.datetime(2025, 5, 22, 1, 56, 40)
+
+
+def checksum(sentence):
+    """
+    NMEA checksum of a sentence body (between '$' and '*').
+
+    :return: two hex digits
+    """
+    return '%02X' % reduce(xor, sentence.encode(), 0)
+
+
+def satellite_passes(satellites, seed):
+    """
+    Random pass geometry of each satellite.
+
+    :return: dict of pass parameters, one array entry per satellite
+    """
+    rng = np.random.default_rng(seed)
+    systems, prns = [], []
+    for system, count in satellites.items():
+        prn_min, prn_max = SYSTEMS[system][3:]
+        systems += [system] * count
+        prns += list(range(prn_min, min(prn_min + count, prn_max + 1)))
+    n = len(prns)
+    return {
+        'system': np.array(systems[:n]),
+        'prn': np.array(prns),
+        'wavelength': np.array([SYSTEMS[system][2] for system in systems[:n]]),
+        'start': rng.uniform(-3, 12, n) * 3600,  # seconds from the start of the log of a first pass
+        'duration': rng.uniform(3, 6, n) * 3600,
+        'period': rng.uniform(11.5, 14, n) * 3600,  # time between passes, about half a sidereal day for GPS
+        'az0': rng.uniform(0, 360, n),
+        'daz': rng.uniform(-6, 6, n),  # azimuth change over a pass
+        'peak': rng.uniform(20, 80, n),  # highest elevation of a pass
+    }
+
+
+def write_log(path, days=0.25, satellites=None, rate=1, height=2.0, seed=0, start=START):
+    """
+    Write a synthetic log.
+
+    :param path: path of the .LOG file to write
+    :param days: length of the log in days
+    :param satellites: dict of talker id -> number of satellites, DEFAULT_SATELLITES if None
+    :param rate: seconds between epochs
+    :param height: reflector height in meters
+    :param seed: random seed, the same arguments always give the same log
+    :param start: datetime of the first epoch
+    :return: number of epochs written
+    """
+    sats = satellite_passes(DEFAULT_SATELLITES if satellites is None else satellites, seed)
+    rng = np.random.default_rng(seed + 1)
+    signals = {system: SYSTEMS[system][1] for system in set(sats['system'])}
+    order = [system for system in SYSTEMS if system in signals]
+
+    seconds = np.arange(0, int(days * 86400), rate)
+    with open(path, 'w') as fid:
+        for second in seconds:
+            now = start + datetime.timedelta(seconds=int(second))
+            stamp = now.strftime('%H%M%S.00')
+            rmc = 'GNRMC,{},A,4442.99498,S,16910.70723,E,0.046,,{},,,A,V'.format(stamp, now.strftime('%d%m%y'))
+            gga = 'GNGGA,{},4442.99498,S,16910.70723,E,1,12,0.55,342.3,M,4.6,M,,'.format(stamp)
+            lines = ['$' + rmc + '*' + checksum(rmc), '$GNVTG,,T,,M,0.046,N,0.085,K,A*32',
+                     '$' + gga + '*' + checksum(gga)]
+
+            # position in the current pass of every satellite, visible between 0 and 1
+            x = ((second - sats['start']) % sats['period']) / sats['duration']
+            el = sats['peak'] * np.sin(np.pi * np.minimum(x, 1))
+            visible = (x <= 1) & (el >= 0.5)
+            el = el[visible]
+            az = (sats['az0'][visible] + sats['daz'][visible] * x[visible]) % 360
+            wavelength = sats['wavelength'][visible]
+            linear = (300 + 200 * np.cos(4 * np.pi * height * np.sin(np.radians(el)) / wavelength) * np.exp(-el / 30)
+                      + rng.normal(0, 3, el.size))
+            snr = np.rint(20 * np.log10(np.maximum(linear, 1)) - 10 + el * 0.1).astype(int)
+            dropped = (el < 3) & (rng.random(el.size) < 0.5)  # low satellites often have no SNR
+
+            system = sats['system'][visible]
+            prn = sats['prn'][visible]
+            for talker in order:
+                fields = ['%02d,%02d,%03d,%s' % (prn[k], el[k], az[k], '' if dropped[k] else '%02d' % snr[k])
+                          for k in np.flatnonzero(system == talker)]
+                n_messages = (len(fields) + 3) // 4
+                for message in range(n_messages):
+                    body = '{}GSV,{},{},{:02d},{},{}'.format(talker, n_messages, message + 1, len(fields),
+                                                             ','.join(fields[message * 4:message * 4 + 4]),
+                                                             signals[talker])
+                    lines.append('$' + body + '*' + checksum(body))
+
+            lines.append('$GNGLL,4442.99498,S,16910.70723,E,{},A,A*6F'.format(stamp))
+            fid.write('\n'.join(lines) + '\n\n\n')
+    return len(seconds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic GNSS log.")
+    parser.add_argument("file", help="LOG file to write")
+    parser.add_argument("--days", type=float, default=0.25, help="length of the log in days")
+    parser.add_argument("--rate", type=int, default=1, help="seconds between epochs")
+    parser.add_argument("--satellites", type=int, default=None,
+                        help="satellites per constellation, the default is a full constellation each")
+    parser.add_argument("--height", type=float, default=2.0, help="reflector height in meters")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    satellites = None if args.satellites is None else {system: args.satellites for system in DEFAULT_SATELLITES}
+    epochs = write_log(args.file, args.days, satellites, args.rate, args.height, args.seed)
+    print("Wrote {} epochs to {}".format(epochs, args.file))
@@ -0,0 +1,101 @@
+"""
+Robust bin statistics and incremental aggregates checked against a brute force computation.
+
+usage - from the python folder
+        python -m pytest test_aggregate.py
+"""
+import numpy as np
+
+from aggregate import ALL_SECTORS, MAD_SCALE, Aggregator, aggregate_rows, robust_stats, sector_index, time_bins
+from results import ResultsStore
+
+AZIMUTH_BINS = [(0, 90), (90, 180), (180, 270), (270, 360)]
+
+
+def brute_stats(values, threshold=3.0):
+    """
+    Statistics of one group with plain numpy calls, as robust_stats should compute them.
+    """
+    median = np.median(values)
+    mad = MAD_SCALE * np.median(np.abs(values - median))
+    kept = values[np.abs(values - median) <= threshold * mad]
+    kept_median = np.median(kept)
+    return {'count': len(kept), 'rejected': len(values) - len(kept), 'median': kept_median,
+            'mad': MAD_SCALE * np.median(np.abs(kept - kept_median)), 'mean': kept.mean()}
+
+
+def retrievals(n, days, seed=0):
+    """
+    :return: (times, azimuths, heights) of random retrievals over a number of days, in time order, with outliers
+    """
+    rng = np.random.default_rng(seed)
+    times = np.datetime64('2025-01-01', 'us') + (np.sort(rng.uniform(0, days, n)) * 86400e6).astype('timedelta64[us]')
+    azimuth = rng.uniform(0, 360, n)
+    heights = 2.0 + np.array([0.0, 0.05, -0.03, 0.1])[(azimuth // 90).astype(int)] + rng.normal(0, 0.02, n)
+    heights[rng.random(n) < 0.05] += 1.5
+    return times, azimuth, heights
+
+
+def append(store, times, azimuth, heights):
+    """
+    Append retrievals without spectra or tracks to a store.
+    """
+    for time, az, height in zip(times, azimuth, heights):
+        store.append({'time': time, 'reflector_height': height, 'peak_amplitude': 1.0, 'azimuth': az,
+                      'elevation': 10.0, 'peak_noise': 3.0, 'freq': [], 'power': [], 'track': {'az': [], 'el': []}},
+                     'GP', 1)
+    return store
+
+
+def test_robust_stats_matches_brute_force():
+    rng = np.random.default_rng(1)
+    n_groups = 40
+    groups = rng.integers(0, n_groups, 5000)
+    values = rng.normal(2, 0.1, groups.size)
+    values[rng.random(groups.size) < 0.05] += 3
+    # group 7 is empty, group 3 has a single value and group 5 only equal values
+    groups[groups == 7] = 8
+    groups[groups == 3] = 4
+    groups[0] = 3
+    values[groups == 5] = 1.25
+
+    stats = robust_stats(groups, values, n_groups)
+    for group in range(n_groups):
+        if group == 7:
+            assert stats['count'][group] == stats['rejected'][group] == 0
+            assert np.isnan(stats['median'][group]) and np.isnan(stats['mean'][group])
+            continue
+        expected = brute_stats(values[groups == group])
+        assert stats['count'][group] == expected['count'] and stats['rejected'][group] == expected['rejected']
+        for name in ('median', 'mad', 'mean'):
+            assert np.isclose(stats[name][group], expected[name]), (group, name)
+
+
+def test_aggregate_rows_match_brute_force():
+    times, azimuth, heights = retrievals(20000, 10)
+    rows = aggregate_rows(times, azimuth, heights, np.timedelta64(6, 'h'), AZIMUTH_BINS)
+    bins, sectors = time_bins(times, np.timedelta64(6, 'h')), sector_index(azimuth, AZIMUTH_BINS)
+    assert len(rows) == 10 * 4 * 5
+    for row in rows:
+        members = (bins == row['time']) & ((sectors == row['sector']) | (row['sector'] == ALL_SECTORS))
+        expected = brute_stats(heights[members])
+        assert row['count'] == expected['count'] and row['rejected'] == expected['rejected']
+        assert np.allclose([row['median'], row['mad'], row['mean']],
+                           [expected['median'], expected['mad'], expected['mean']])
+
+
+def test_update_recomputes_only_new_bins():
+    times, azimuth, heights = retrievals(6000, 20, seed=2)
+    whole = Aggregator('1d', AZIMUTH_BINS)
+    whole.update(append(ResultsStore(), times, azimuth, heights))
+
+    cut = np.searchsorted(times, np.datetime64('2025-01-15', 'us'))
+    store = append(ResultsStore(), times[:cut], azimuth[:cut], heights[:cut])
+    growing = Aggregator('1d', AZIMUTH_BINS)
+    growing.update(store)
+    assert growing.update(store) == 0
+    append(store, times[cut:], azimuth[cut:], heights[cut:])
+    # the bins of the days from the first new retrieval on
+    assert growing.update(store) == 6 * 5
+    for name in whole.table.dtype.names:
+        assert np.array_equal(whole.table[name], growing.table[name], equal_nan=True), name
@@ -0,0 +1,94 @@
+"""
+Batch GSV decoding checked against the original per sentence read_gpgsv on handcrafted sentences.
+
+usage - from the python folder
+        python -m pytest test_gsv.py
+"""
+from functools import reduce
+
+import numpy as np
+
+from read_gpgsv import decode_gsv, read_gpgsv
+
+
+def with_checksum(body):
+    """
+    :param body: sentence between the '$' and the '*'
+    :return: sentence with its checksum
+    """
+    return "${}*{:02X}".format(body, reduce(lambda a, b: a ^ b, body.encode(), 0))
+
+
+# the logger ends the satellites of a sentence with a signal id, or cuts the last sentence of a group short after a PRN
+SENTENCES = [
+    # 4 satellites, one with an empty SNR
+    with_checksum("GPGSV,3,1,11,01,40,083,46,02,17,308,,03,07,344,39,04,22,228,45,1"),
+    # 1 to 3 satellites, empty elevation and azimuth fields
+    with_checksum("GPGSV,3,2,11,05,,,33,1"),
+    with_checksum("GPGSV,3,2,11,06,10,100,30,07,20,,31,1"),
+    with_checksum("GPGSV,3,3,11,08,62,117,48,09,11,285,,10,,,,1"),
+    # PRNs that are empty, not a number or above 32 are skipped
+    with_checksum("GPGSV,2,1,07,,12,100,20,1A,30,200,40,33,45,180,41,11,05,010,22,1"),
+    # cut short after the PRN of a satellite that is not reported
+    with_checksum("GPGSV,2,2,07,12,15,040,35,13"),
+    # no satellite at all
+    with_checksum("GPGSV,1,1,00,1"),
+    # another signal id
+    with_checksum("GPGSV,1,1,04,14,33,050,44,15,18,120,37,16,70,300,50,17,03,200,12,8"),
+]
+BAD_CHECKSUM = SENTENCES[0][:-2] + "00"
+NO_CHECKSUM = SENTENCES[0].split('*')[0]
+
+
+def brute_decode(sentences):
+    """
+    Observations of each sentence on its own with read_gpgsv, which never checks the checksums.
+
+    :return: (sentence index, prn, el, az, snr) of every observation
+    """
+    observations = []
+    for index, sentence in enumerate(sentences):
+        observations += [(index,) + values for values in zip(*read_gpgsv([sentence.split(',')]))]
+    return tuple(np.array(values) for values in zip(*observations))
+
+
+def same_observations(decoded, expected):
+    index, prn, el, az, snr = expected
+    return (np.array_equal(decoded['sentence'], index) and np.array_equal(decoded['prn'], prn)
+            and all(np.array_equal(decoded[name], values, equal_nan=True)
+                    for name, values in (('el', el), ('az', az), ('snr', snr))))
+
+
+def test_matches_read_gpgsv():
+    decoded = decode_gsv(SENTENCES)
+    assert same_observations(decoded, brute_decode(SENTENCES))
+    assert decoded['checksum_ok'].all()
+    # after fewer than 4 satellites the last field is where both a signal id and the PRN cutting a sentence short go,
+    # so those sentences are flagged as ending their group and their last field is also read as a signal id
+    assert np.array_equal(decoded['short'], [False, True, True, True, False, True, True, False])
+    assert np.array_equal(decoded['signal'], [1, 1, 1, 1, 1, 0x13, 1, 8])
+    # bytes and line endings decode the same
+    assert same_observations(decode_gsv([(sentence + "\r\n").encode() for sentence in SENTENCES]),
+                             brute_decode(SENTENCES))
+
+
+def test_checksums_checked_in_the_same_pass():
+    sentences = [BAD_CHECKSUM, SENTENCES[1], NO_CHECKSUM, SENTENCES[2]]
+    decoded = decode_gsv(sentences, validate=True)
+    assert np.array_equal(decoded['checksum_ok'], [False, True, False, True])
+    index, prn, el, az, snr = brute_decode(sentences)
+    kept = np.isin(index, [1, 3])
+    assert same_observations(decoded, (index[kept], prn[kept], el[kept], az[kept], snr[kept]))
+
+    # without validation the sentences failing their checksum are read as read_gpgsv reads them
+    decoded = decode_gsv(sentences, validate=False)
+    assert np.array_equal(decoded['checksum_ok'], [False, True, False, True])
+    assert same_observations(decoded, brute_decode(sentences))
+
+
+def test_signal_and_prn_range():
+    decoded = decode_gsv(SENTENCES, signal=8)
+    assert np.array_equal(decoded['prn'], [14, 15, 16, 17])
+    # per sentence PRN ranges, e.g. of the satellite systems of the talker ids
+    decoded = decode_gsv(SENTENCES[:2], prn_min=[2, 1], prn_max=[3, 4])
+    assert np.array_equal(decoded['prn'], [2, 3])
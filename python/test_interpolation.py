@@ -0,0 +1,72 @@
+"""
+Pass by pass elevation interpolation checked against one np.interp call per pass.
+
+usage - from the python folder
+        python -m pytest test_interpolation.py
+"""
+import numpy as np
+
+from arcs import MAX_GAP
+from readGPS import MIN_CHANGES, interpolated_elevations
+
+
+def brute_elevations(el, seconds, starts):
+    """
+    Elevations interpolated one pass at a time, between the samples just before each change of the elevation.
+    """
+    out = np.array(el, dtype=float)
+    bounds = set(starts) | {0, len(el)}
+    bounds |= {i for i in range(1, len(el)) if not 0 <= seconds[i] - seconds[i - 1] <= MAX_GAP}
+    bounds = sorted(bounds)
+    for first, end in zip(bounds[:-1], bounds[1:]):
+        anchors = [i for i in range(first, end - 1) if abs(el[i + 1] - el[i]) > 0.1]
+        if len(anchors) > MIN_CHANGES:
+            out[first:end] = np.interp(seconds[first:end], seconds[anchors], out[anchors])
+    return out
+
+
+def satellites(n_satellites, seed=0):
+    """
+    :return: (whole degree elevations, times in seconds, first observation of each satellite) of satellites seen in
+             one or more passes, each satellite's observations together and in time order
+    """
+    rng = np.random.default_rng(seed)
+    el, seconds, starts = [], [], []
+    for _ in range(n_satellites):
+        starts.append(sum(len(e) for e in el))
+        time = rng.uniform(0, 3600)
+        for _ in range(rng.integers(1, 4)):
+            # a pass rising and setting, sometimes with a short dropout, then a long time below the horizon
+            n = int(rng.integers(5, 400))
+            t = time + np.cumsum(rng.choice([1, 1, 1, 2, MAX_GAP], n, p=[0.6, 0.2, 0.1, 0.09, 0.01]))
+            peak = rng.uniform(5, 80)
+            el.append(np.round(peak * np.sin(np.linspace(0.1, np.pi - 0.1, n))))
+            seconds.append(t)
+            time = t[-1] + rng.uniform(MAX_GAP + 1, 20000)
+    return np.concatenate(el), np.concatenate(seconds), np.array(starts)
+
+
+def test_matches_one_interp_per_pass():
+    el, seconds, starts = satellites(40)
+    # the passes are offset on one time axis, which rounds the last bits of the times
+    assert np.allclose(interpolated_elevations(el, seconds, starts), brute_elevations(el, seconds, starts),
+                       rtol=0, atol=1e-9)
+
+
+def test_passes_do_not_share_anchors():
+    # the same satellite seen twice, the second pass starting where the first one ended
+    first = np.repeat(np.arange(30, 10, -1), 10)
+    second = np.repeat(np.arange(10, 30), 10)
+    el = np.concatenate((first, second)).astype(float)
+    seconds = np.concatenate((np.arange(first.size), first.size + 2 * MAX_GAP + np.arange(second.size))).astype(float)
+    interpolated = interpolated_elevations(el, seconds)
+    assert np.allclose(interpolated, brute_elevations(el, seconds, [0]), rtol=0, atol=1e-9)
+    # the first samples of the second pass keep the elevation of its first anchor
+    assert np.all(interpolated[first.size:first.size + 10] == 10)
+
+
+def test_few_changes_keep_whole_degrees():
+    el = np.repeat(np.arange(10, 10 + MIN_CHANGES), 20).astype(float)
+    seconds = np.arange(el.size, dtype=float)
+    assert np.array_equal(interpolated_elevations(el, seconds), el)
+    assert interpolated_elevations(np.zeros(0), np.zeros(0)).size == 0
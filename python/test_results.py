@@ -0,0 +1,150 @@
+"""
+Retention policies of the results store checked against the spectra and tracks of a store keeping everything.
+
+usage - from the python folder
+        python -m pytest test_results.py
+"""
+import pickle
+
+import numpy as np
+import pytest
+
+import results
+from results import ResultsStore
+
+N = 600
+DAYS = 30
+POINTS = 16
+
+
+def retrievals(seed=0):
+    """
+    :return: list of (result, system, prn) of random retrievals over DAYS days, spectra and tracks of random sizes
+    """
+    rng = np.random.default_rng(seed)
+    items = []
+    for k in range(N):
+        n_freq, n_track = (int(size) for size in rng.integers(0, 200, 2))
+        items.append(({'time': np.datetime64('2025-01-01', 'us') + np.timedelta64(int(k * DAYS * 86400e6 / N), 'us'),
+                       'reflector_height': rng.uniform(1, 3), 'peak_amplitude': 1.0, 'azimuth': rng.uniform(0, 360),
+                       'elevation': 10.0, 'peak_noise': 3.0, 'freq': np.linspace(0.2, 8, n_freq),
+                       'power': rng.random(n_freq),
+                       'track': {'az': rng.random(n_track), 'el': np.arange(n_track) * 0.5}},
+                      'GP', k % 32 + 1))
+    return items
+
+
+ITEMS = retrievals()
+
+
+def build(items=ITEMS, **settings):
+    store = ResultsStore(**settings)
+    for item in items:
+        store.append(*item)
+    store['time']  # merge the pending retrievals
+    return store
+
+
+def expected_peak(store, full, index, points=POINTS):
+    """
+    :return: True if a retrieval keeps the `points` heights around the peak of its spectrum and `points`
+             evenly spaced track samples, the first and last included
+    """
+    freq, power = full.spectrum(index)
+    kept = min(points, len(power))
+    first = min(max(int(np.argmax(power)) - points // 2, 0), len(power) - kept) if len(power) else 0
+    track, full_track = store.track(index), full.track(index)
+    size = len(full_track['el'])
+    samples = min(points, size)
+    positions = np.arange(samples) * (size - 1) // max(samples - 1, 1)
+    return (np.array_equal(store.spectrum(index)[0], freq[first:first + kept])
+            and np.array_equal(store.spectrum(index)[1], power[first:first + kept])
+            and np.array_equal(track['az'], full_track['az'][positions])
+            and np.array_equal(track['el'], full_track['el'][positions]))
+
+
+def is_whole(store, full, index):
+    return (all(np.array_equal(a, b) for a, b in zip(store.spectrum(index), full.spectrum(index)))
+            and all(np.array_equal(store.track(index)[name], full.track(index)[name]) for name in ('az', 'el')))
+
+
+@pytest.fixture(scope='module')
+def full():
+    return build()
+
+
+@pytest.fixture(params=[False, True], ids=['memory', 'spill'])
+def spill(request, tmp_path):
+    return tmp_path / 'spill' if request.param else None
+
+
+def test_heights_survive_every_retention(full, spill):
+    for retention in results.RETENTIONS:
+        store = build(retention=retention, points=POINTS, recent_days=3, spill_directory=spill)
+        names = [name for name in results.record_dt.names if name not in ('spectrum_start', 'spectrum_size',
+                                                                          'track_start', 'track_size')]
+        for name in names:
+            assert np.array_equal(store[name], full[name]), (retention, name)
+
+
+def test_peak_retention(full, spill, monkeypatch):
+    # small merges, so retrievals age out over many merges and the arrays get compacted
+    monkeypatch.setattr(results, 'MERGE_EVERY', 50)
+    store = build(retention='peak', points=POINTS, recent_days=3, spill_directory=spill)
+    recent = full['time'] >= full['time'].max() - np.timedelta64(3, 'D')
+    assert np.array_equal(store.whole(), recent)
+    for index in range(N):
+        assert (is_whole if recent[index] else expected_peak)(store, full, index), index
+    # what no record refers to any more does not pile up
+    assert len(store.freq) <= 2 * store['spectrum_size'].sum()
+    assert len(store.track_az) <= 2 * store['track_size'].sum()
+    if spill is not None:
+        assert isinstance(store.freq, np.memmap)
+
+
+def test_peak_retention_without_recent_days(full):
+    store = build(retention='peak', points=POINTS)
+    assert not store.whole().any()
+    assert all(expected_peak(store, full, index) for index in range(N))
+    assert len(store.freq) == store['spectrum_size'].sum()
+
+
+def test_heights_retention(full, spill):
+    store = build(retention='heights', recent_days=3, spill_directory=spill)
+    recent = store.whole()
+    assert recent.any() and not recent.all()
+    assert not store['spectrum_size'][~recent].any() and not store['track_size'][~recent].any()
+    assert all(is_whole(store, full, index) for index in np.flatnonzero(recent))
+
+
+def test_extend_matches_appending(full, spill):
+    store = build(ITEMS[:N // 2], retention='peak', points=POINTS, recent_days=3, spill_directory=spill)
+    store.extend(build(ITEMS[N // 2:]))
+    reference = build(retention='peak', points=POINTS, recent_days=3)
+    for index in range(N):
+        assert is_whole(store, reference, index), index
+
+
+def test_save_load_and_pickle(full, spill, tmp_path):
+    store = build(retention='peak', points=POINTS, recent_days=3, spill_directory=spill)
+    store.save(tmp_path / 'store.npz')
+    for copy in (ResultsStore.load(tmp_path / 'store.npz'), pickle.loads(pickle.dumps(store))):
+        assert (copy.retention, copy.points, copy.recent) == ('peak', POINTS, store.recent)
+        assert np.array_equal(copy.records, store.records)
+        assert all(is_whole(copy, store, index) for index in range(N))
+    assert str(ResultsStore.load(tmp_path / 'store.npz').spill_directory or '') == str(spill or '')
+
+
+def test_spill_folder_removed(tmp_path):
+    spill = tmp_path / 'spill'
+    store = build(retention='peak', points=POINTS, recent_days=3, spill_directory=spill)
+    assert len(list(spill.iterdir())) == 1
+    del store
+    assert not list(spill.iterdir())
+
+
+def test_invalid_settings():
+    with pytest.raises(ValueError):
+        ResultsStore(retention='spectra')
+    with pytest.raises(ValueError):
+        ResultsStore(retention='peak', points=0)
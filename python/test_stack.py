@@ -0,0 +1,92 @@
+"""
+Spectral stacking checked against interpolating and averaging the spectra one at a time.
+
+usage - from the python folder
+        python -m pytest test_stack.py
+"""
+import warnings
+
+import numpy as np
+
+from aggregate import bin_groups, bin_width
+from results import ResultsStore
+from stack import height_grid, interpolate_spectra, stack_spectra, stack_store
+
+AZIMUTH_BINS = [(0, 90), (90, 180), (180, 270), (270, 360)]
+STEP = 0.01
+GRID = height_grid(8, STEP)
+
+
+def spectra(n, seed=0):
+    """
+    :return: (list of reflector heights, list of powers) of random spectra over different height ranges, some empty
+    """
+    rng = np.random.default_rng(seed)
+    freqs, powers = [], []
+    for size in rng.integers(0, 300, n):
+        freq = np.linspace(rng.uniform(0, 0.5), rng.uniform(5, 9), size)
+        freqs.append(freq)
+        powers.append(10 * np.exp(-(freq - 3) ** 2 / 0.01) + rng.random(size))
+    return freqs, powers
+
+
+def brute_interpolate(freq, power, grid=GRID):
+    """
+    One spectrum on the grid, NaN outside its heights.
+    """
+    if len(freq) == 0:
+        return np.full(len(grid), np.nan)
+    return np.interp(grid, freq, power, left=np.nan, right=np.nan)
+
+
+def test_interpolate_spectra_matches_one_interp_per_spectrum():
+    freqs, powers = spectra(200)
+    sizes = np.array([len(f) for f in freqs])
+    # the spectra are read out of order from a block with a gap between them
+    starts = np.cumsum(sizes + 3) - sizes
+    freq, power = np.zeros(starts[-1] + sizes[-1]), np.zeros(starts[-1] + sizes[-1])
+    for start, f, p in zip(starts, freqs, powers):
+        freq[start:start + len(f)], power[start:start + len(p)] = f, p
+    order = np.random.default_rng(1).permutation(len(sizes))
+
+    values = interpolate_spectra(freq, power, starts[order], sizes[order], GRID)
+    for row, index in zip(values, order):
+        expected = brute_interpolate(freqs[index], powers[index])
+        assert np.allclose(row, np.nan_to_num(expected))
+
+
+def test_stack_store_matches_average_per_group():
+    rng = np.random.default_rng(2)
+    freqs, powers = spectra(1000, seed=3)
+    store = ResultsStore()
+    for k, (freq, power) in enumerate(zip(freqs, powers)):
+        time = np.datetime64('2025-01-01', 'us') + np.timedelta64(int(rng.uniform(0, 5) * 86400e6), 'us')
+        store.append({'time': time, 'reflector_height': 3.0, 'peak_amplitude': 1.0, 'azimuth': rng.uniform(0, 360),
+                      'elevation': 10.0, 'peak_noise': 3.0, 'freq': freq, 'power': power,
+                      'track': {'az': [], 'el': []}}, 'GP', k % 32)
+
+    rows, stacked = stack_store(store, '6h', AZIMUTH_BINS, GRID, 0.4, (6, 2))
+    members, groups, times, _ = bin_groups(store['time'], store['azimuth'], bin_width('6h'), AZIMUTH_BINS)
+    assert np.array_equal(rows['count'], np.bincount(groups, minlength=len(times)))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # mean of heights no spectrum of a group covers
+        for group in range(len(times)):
+            curves = [brute_interpolate(freqs[index], powers[index]) for index in members[groups == group]]
+            assert np.allclose(stacked[group], np.nanmean(curves, axis=0), equal_nan=True)
+    # the peak at 3 m stands out of the noise of every stack holding a spectrum that covers it
+    covered = ~np.isnan(rows['reflector_height'])
+    assert np.allclose(rows['reflector_height'][covered], 3.0, atol=2 * STEP)
+
+
+def test_empty_spectra_block():
+    # e.g. a store under the 'heights' retention, which keeps no spectrum
+    groups = np.array([0, 1, 1])
+    stacked = stack_spectra(np.zeros(0), np.zeros(0), np.zeros(3, dtype=int), np.zeros(3, dtype=int), groups, 2, GRID)
+    assert stacked.shape == (2, len(GRID)) and np.isnan(stacked).all()
+
+    store = ResultsStore(retention='heights')
+    store.append({'time': np.datetime64('2025-01-01T06', 'us'), 'reflector_height': 3.0, 'peak_amplitude': 1.0,
+                  'azimuth': 45.0, 'elevation': 10.0, 'peak_noise': 3.0, 'freq': GRID, 'power': np.ones(len(GRID)),
+                  'track': {'az': [], 'el': []}}, 'GP', 1)
+    rows, stacked = stack_store(store, '1d', AZIMUTH_BINS, GRID, 0.4, (6, 2))
+    assert len(rows) == 0 and stacked.shape == (0, len(GRID))
@@ -1,4 +1,3 @@
-from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
 import numpy as np
@@ -72,14 +71,66 @@ def peak2noise(f, p, frange):
     maxRHAmp = float(p[ij])
     maxRH = float(f[ij])
 
-    mask = np.where((f > frange[0]) | (f < frange[1]))[0]
-
-    noisey = float(np.mean(p[mask]))
+    noisey = noise_level(f, p, frange)
     pknoise = maxRHAmp / noisey
     return maxRH, maxRHAmp, pknoise
 
+def noise_level(f, p, frange):
+    """
+    Mean power/amplitude outside of a range, the noise level of `peak2noise`.
+
+    :param f: 1D array of x-axis values.
+    :param p: 1D array of power/amplitude values (same length as f).
+    :param frange: 2-tuple/list (high, low), the values above high or below low are averaged.
+    :return: mean of p outside of the range
+    """
+    mask = np.where((f > frange[0]) | (f < frange[1]))[0]
+    return float(np.mean(p[mask]))
+
+# GPS time is ahead of UTC by the leap seconds since 1980
+GPS_UTC_OFFSET = np.timedelta64(18, 's')
+TIMEZONE = ZoneInfo("Pacific/Auckland")
+
+
+def date_to_datetime64(date_value):
+    """
+    Vectorized conversion of YYYYMMDD integer dates, as in the reader's 'date' field.
+
+    :param date_value: integer or array of integers
+    :return: datetime64[D] array, NaT where the date is not set (0)
+    """
+    date_value = np.asarray(date_value, dtype=np.int64)
+    years = (date_value // 10000 - 1970).astype('datetime64[Y]')
+    months = years.astype('datetime64[M]') + (date_value // 100 % 100 - 1)
+    days = months.astype('datetime64[D]') + (date_value % 100 - 1)
+    return np.where(date_value > 0, days, np.datetime64('NaT'))
+
+
+def epoch_seconds(date_value, seconds):
+    """
+    Seconds since 1970-01-01 of dates and seconds of day.
+
+    :param date_value: YYYYMMDD integer or array of integers
+    :param seconds: seconds of the day, number or array
+    :return: float array, NaN where the date is not set
+    """
+    days = date_to_datetime64(date_value)
+    return np.where(np.isnat(days), np.nan, days.astype(np.int64) * 86400.0) + seconds
+
+
+def gps_to_datetime64(date_value, gps_seconds):
+    """
+    Vectorized `gps_to_nz`: GPS dates and seconds of day to wall clock times, without a time zone attached. The time
+    zone is only applied for display, see `results.ResultsStore.datetimes`.
+
+    :param date_value: YYYYMMDD integer or array of integers
+    :param gps_seconds: GPS seconds of the day, number or array
+    :return: datetime64[us] array, NaT where the date is not set
+    """
+    microseconds = np.round(np.asarray(gps_seconds, dtype=float) * 1e6).astype(np.int64)
+    days = date_to_datetime64(date_value).astype('datetime64[us]')
+    return days + microseconds.astype('timedelta64[us]') - GPS_UTC_OFFSET
+
+
 def gps_to_nz(date_value, gps_seconds):
-    base_date = datetime.strptime(str(int(date_value)), "%Y%m%d")
-    gps_datetime = base_date + timedelta(seconds=float(gps_seconds))
-    utc_datetime = gps_datetime - timedelta(seconds=18)
-    return utc_datetime.replace(tzinfo=ZoneInfo("Pacific/Auckland"))
\ No newline at end of file
+    return gps_to_datetime64(date_value, gps_seconds).item().replace(tzinfo=TIMEZONE)